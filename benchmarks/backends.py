@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+#    Copyright 2017 Tobias Mueller <muelli@cryptobitch.de>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+"""Measures how long the backends take for the common operations
+
+The same operations are run with every backend against the keys in
+tests/fixtures and against keys generated for the benchmark with
+1, 10, and 50 UIDs and 10, 1000, and 50000 third party signatures.
+The third party signatures are made up: they look like signatures to
+gpg, but they are not valid.  That is fine, because gpg cannot check
+them without the issuers' keys, anyway.
+
+Every case runs in a fresh Python process, so that its peak RSS can be
+measured.  The results are written as JSON, e.g.
+
+    python benchmarks/backends.py --output before.json
+    python benchmarks/backends.py --backends gpgme --uids 1,10 --sigs 10
+
+You need gpg >= 2.1 to generate the keys.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+from subprocess import PIPE, Popen, check_output
+import struct
+import sys
+import tempfile
+import time
+
+thisdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.join(thisdir, "..")
+sys.path.insert(0, parentdir)
+
+from keysign import openpgp
+
+log = logging.getLogger(__name__)
+
+FIXTURES = ("pubkey-1.asc", "pubkey-2-uids.asc", "alpha.asc")
+OPERATIONS = ("openpgpkey_from_data", "get_usable_keys", "minimise_key",
+              "UIDExport", "sign_keydata_and_encrypt")
+BACKENDS = ("gpgme", "monkeysign")
+PERCENTILES = (50, 90, 99)
+
+
+def gpg(homedir, *args, **kwargs):
+    cmd = ["gpg", "--homedir", homedir, "--batch", "--quiet",
+           "--pinentry-mode", "loopback", "--passphrase", ""] + list(args)
+    return check_output(cmd, **kwargs)
+
+
+def new_homedir(basedir, name):
+    homedir = os.path.join(basedir, name)
+    os.mkdir(homedir, 0o700)
+    return homedir
+
+
+def packet(tag, body):
+    "Returns a new format packet"
+    length = len(body)
+    if length < 192:
+        header = struct.pack(">BB", 0xc0 | tag, length)
+    elif length < 8384:
+        length -= 192
+        header = struct.pack(">BBB", 0xc0 | tag, (length >> 8) + 192,
+                             length & 0xff)
+    else:
+        header = struct.pack(">BBI", 0xc0 | tag, 0xff, length)
+    return header + body
+
+
+def fake_certification(created):
+    "Returns a signature packet which looks like an EdDSA certification"
+    hashed = struct.pack(">BBI", 5, openpgp.SUBPACKET_CREATION_TIME, created)
+    unhashed = struct.pack(">BB", 9, openpgp.SUBPACKET_ISSUER) + os.urandom(8)
+    body = struct.pack(">BBBBH", 4, 0x10, 22, 8, len(hashed)) + hashed
+    body += struct.pack(">H", len(unhashed)) + unhashed
+    body += os.urandom(2)
+    # The two MPIs of an EdDSA signature
+    for _ in range(2):
+        body += struct.pack(">H", 256) + b"\x80" + os.urandom(31)
+    return packet(openpgp.TAG_SIGNATURE, body)
+
+
+def add_certifications(keydata, count):
+    "Adds count made up certifications to the first UID of the key"
+    keyblock = openpgp.parse_keyblock(keydata)
+    created = int(time.time())
+    sigs = b"".join(fake_certification(created - i) for i in range(count))
+    packets = list(keyblock.primary) + keyblock.uids[0]
+    data = openpgp._join(packets) + sigs
+    data += openpgp._join([p for packets in keyblock.uids[1:] for p in packets])
+    data += openpgp._join([p for packets in keyblock.subkeys for p in packets])
+    return data
+
+
+def generate_key(basedir, uids, sigs):
+    "Returns the binary data of a new key with that many UIDs and signatures"
+    homedir = new_homedir(basedir, "gen-%d-%d" % (uids, sigs))
+    gpg(homedir, "--quick-gen-key", "Bench Mark 0 <bench0@example.org>",
+        "ed25519", "sign", "0")
+    fpr = fingerprints(homedir)[0]
+    gpg(homedir, "--quick-add-key", fpr, "cv25519", "encr", "0")
+    for i in range(1, uids):
+        gpg(homedir, "--quick-add-uid", fpr,
+            "Bench Mark %d <bench%d@example.org>" % (i, i))
+    keydata = gpg(homedir, "--export", fpr)
+    return add_certifications(keydata, sigs)
+
+
+def fingerprints(homedir, secret=False):
+    listing = gpg(homedir, "--with-colons",
+                  "--list-secret-keys" if secret else "--list-keys")
+    return [line.split(b":")[9].decode("ascii")
+            for line in listing.splitlines() if line.startswith(b"fpr")]
+
+
+def prepare(basedir, uid_counts, sig_counts):
+    """Creates the keys and homedirs the cases need
+
+    Returns the signer's homedir and a list of (name, keyfile, homedir)
+    with the homedir containing just that key.
+    """
+    signer_homedir = new_homedir(basedir, "signer")
+    gpg(signer_homedir, "--quick-gen-key", "Signer <signer@example.org>",
+        "ed25519", "sign", "0")
+
+    keys = []
+    for fixture in FIXTURES:
+        with open(os.path.join(parentdir, "tests", "fixtures", fixture), "rb") as f:
+            keys.append(("fixture:" + fixture, f.read()))
+    for uids in uid_counts:
+        for sigs in sig_counts:
+            log.info("Generating key with %d UIDs and %d signatures",
+                     uids, sigs)
+            keys.append(("uids=%d,sigs=%d" % (uids, sigs),
+                         generate_key(basedir, uids, sigs)))
+
+    prepared = []
+    for i, (name, keydata) in enumerate(keys):
+        keyfile = os.path.join(basedir, "key-%d.gpg" % i)
+        with open(keyfile, "wb") as f:
+            f.write(keydata)
+        homedir = new_homedir(basedir, "keyring-%d" % i)
+        try:
+            gpg(homedir, "--import", keyfile, stderr=PIPE)
+        except Exception as e:
+            # gpg >= 2.2.17 imports overly large keys with their
+            # self signatures only and then exits with an error
+            log.warning("Could not fully import %s: %s", name, e)
+        prepared.append((name, keyfile, homedir))
+    return signer_homedir, prepared
+
+
+def percentile(sorted_values, p):
+    "Returns the p-th percentile using the nearest rank method"
+    rank = max(1, int(-(-p * len(sorted_values) // 100)))
+    return sorted_values[rank - 1]
+
+
+def summarise(timings):
+    values = sorted(timings)
+    summary = {
+        "min": values[0],
+        "max": values[-1],
+        "mean": sum(values) / len(values),
+    }
+    for p in PERCENTILES:
+        summary["p%d" % p] = percentile(values, p)
+    return summary
+
+
+
+def operation(backend_name, name, keydata, homedir, signer_homedir):
+    """Returns a function which performs the operation once
+
+    The backends' caches are cleared before every run, because
+    we want to know what the operation costs, not the cache.
+    """
+    from keysign import gpgbackend
+    from keysign.keycache import key_cache, keyring_cache
+    backend = gpgbackend.load(backend_name)
+
+    def uncached(f):
+        def run():
+            key_cache.clear()
+            keyring_cache.invalidate()
+            return f()
+        return run
+
+    if name == "openpgpkey_from_data":
+        return uncached(lambda: backend.openpgpkey_from_data(keydata))
+    elif name == "get_usable_keys":
+        return uncached(lambda: backend.get_usable_keys(homedir=homedir))
+    elif name == "minimise_key":
+        if backend_name == "gpgme":
+            return uncached(lambda: backend.minimise_key(keydata))
+        return uncached(lambda: backend.MinimalExport(keydata))
+    elif name == "UIDExport":
+        if backend_name == "gpgme":
+            return uncached(lambda: backend.UIDExport(keydata, 1))
+        uid = backend.openpgpkey_from_data(keydata).uidslist[0].uid
+        return uncached(lambda: backend.UIDExport(uid, keydata))
+    elif name == "sign_keydata_and_encrypt":
+        return uncached(lambda: list(backend.sign_keydata_and_encrypt(
+            keydata, homedir=signer_homedir)))
+    raise ValueError("Unknown operation %r" % name)
+
+
+def run_case(case):
+    "Runs a single case in this process and returns its result"
+    with open(case["keyfile"], "rb") as f:
+        keydata = f.read()
+    # The monkeysign backend uses the default homedir for some things
+    os.environ["GNUPGHOME"] = case["signer_homedir"]
+    result = dict(case)
+    try:
+        run = operation(case["backend"], case["operation"], keydata,
+                        case["homedir"], case["signer_homedir"])
+        # Warm up, e.g. to import the backend's modules
+        run()
+        timings = []
+        for _ in range(case["iterations"]):
+            start = time.time()
+            run()
+            timings.append(time.time() - start)
+        result["latency"] = summarise(timings)
+    except Exception as e:
+        log.exception("Case %r failed", case)
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+    # ru_maxrss is in kilobytes on Linux
+    result["peak_rss_kb"] = \
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result["peak_rss_children_kb"] = \
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return result
+
+
+def spawn_case(case):
+    "Runs the case in a new process and returns its result"
+    cmd = [sys.executable, os.path.abspath(__file__),
+           "--run-case", json.dumps(case)]
+    proc = Popen(cmd, stdout=PIPE)
+    out, _ = proc.communicate()
+    try:
+        return json.loads(out.decode("utf-8").splitlines()[-1])
+    except (ValueError, IndexError):
+        result = dict(case)
+        result["error"] = "Process exited with %d" % proc.returncode
+        return result
+
+
+def environment():
+    "Returns what we know about the machine the benchmark is run on"
+    gpg_version = check_output(["gpg", "--version"]).decode("utf-8")
+    return {
+        "python": sys.version,
+        "platform": platform.platform(),
+        "gpg": gpg_version.splitlines()[0],
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def parse_counts(s):
+    return [int(i) for i in s.split(",") if i]
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--operations", default=",".join(OPERATIONS))
+    parser.add_argument("--uids", default="1,10,50", type=parse_counts)
+    parser.add_argument("--sigs", default="10,1000,50000", type=parse_counts)
+    parser.add_argument("--iterations", default=10, type=int)
+    parser.add_argument("--output", help="File to write the results to")
+    parser.add_argument("--keep", action="store_true",
+                        help="Keep the generated keys and homedirs")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    args = parser.parse_args(args)
+
+    if args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case))))
+        return 0
+
+    logging.basicConfig(level=logging.INFO)
+    basedir = tempfile.mkdtemp(prefix="keysign-bench-")
+    try:
+        signer_homedir, keys = prepare(basedir, args.uids, args.sigs)
+        results = []
+        for backend in args.backends.split(","):
+            for op in args.operations.split(","):
+                for name, keyfile, homedir in keys:
+                    case = {
+                        "backend": backend,
+                        "operation": op,
+                        "key": name,
+                        "key_bytes": os.path.getsize(keyfile),
+                        "keyfile": keyfile,
+                        "homedir": homedir,
+                        "signer_homedir": signer_homedir,
+                        "iterations": args.iterations,
+                    }
+                    log.info("Running %s %s on %s", backend, op, name)
+                    result = spawn_case(case)
+                    for k in ("keyfile", "homedir", "signer_homedir"):
+                        result.pop(k, None)
+                    results.append(result)
+    finally:
+        if args.keep:
+            log.info("Keeping %s", basedir)
+        else:
+            shutil.rmtree(basedir, ignore_errors=True)
+
+    report = {"environment": environment(), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+#    Copyright 2017 Tobias Mueller <muelli@cryptobitch.de>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+"""Puts the keyserver under the load of many simultaneous downloaders
+
+A ServeKeyThread serving made up keys of the given sizes is started
+in a child process, so that the CPU time it takes can be measured
+separately from ours.  Its keys are not announced via Avahi, so
+neither D-Bus nor Avahi are needed.  Then, the given number of
+downloaders fetch the keys as fast as they can, optionally over
+persistent connections, gzipped, or conditionally, i.e. with the
+ETag they got before.  The results are written as JSON, e.g.
+
+    python benchmarks/keyserver.py --engine pooled --clients 50
+    python benchmarks/keyserver.py --sizes 3000,300000 --conditional 0.5
+
+The downloaders are threads competing for our interpreter, so for
+high loads the server's CPU time per request is the more telling
+number than the throughput.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import socket
+from subprocess import PIPE, Popen
+import sys
+from threading import Event, Thread
+import time
+try:
+    from http.client import HTTPConnection, HTTPException
+except ImportError:
+    from httplib import HTTPConnection, HTTPException
+
+thisdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.join(thisdir, "..")
+sys.path.insert(0, parentdir)
+
+from keysign import openpgp
+
+from backends import summarise
+
+log = logging.getLogger(__name__)
+
+ENGINES = ("threaded", "asyncio", "pooled")
+
+
+class NullPublisher(object):
+    "Stands in for the AvahiPublisher"
+    def __init__(self, **kwargs):
+        pass
+
+    def add_service(self):
+        pass
+
+    def remove_service(self):
+        pass
+
+
+def make_key(size):
+    "Returns armored data of about size bytes and a made up fingerprint"
+    # Armoring makes the data a third bigger
+    data = openpgp.armor(os.urandom(max(1, size * 3 // 4)))
+    fpr = "".join("%02X" % c for c in bytearray(os.urandom(20)))
+    return data, fpr
+
+
+def cpu_times():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime, usage.ru_stime
+
+
+def serve(config):
+    '''Serves the keys until stdin is closed.  Run in the child.
+    Prints the port and the fingerprints when ready and
+    the CPU time taken and the server's metrics when done.'''
+    from keysign.Keyserver import create_keyserver
+    keys = [make_key(size) for size in config["sizes"]]
+    server = create_keyserver(engine=config["engine"],
+                              publisher=NullPublisher, **config["pool"])
+    for data, fpr in keys:
+        server.add_key(data, fpr)
+    server.start()
+    user, system = cpu_times()
+    print(json.dumps({"port": server.port,
+                      "fingerprints": [fpr for _, fpr in keys]}))
+    sys.stdout.flush()
+
+    # Our parent closes stdin when it is done
+    sys.stdin.read()
+    end_user, end_system = cpu_times()
+    server.shutdown()
+    print(json.dumps({
+        "cpu_user": end_user - user,
+        "cpu_system": end_system - system,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "metrics": server.metrics(),
+    }))
+
+
+class Downloader(Thread):
+    '''Fetches keys until told to stop and records how long it took'''
+
+    def __init__(self, host, port, fingerprints, options, stop):
+        super(Downloader, self).__init__()
+        self.daemon = True
+        self.host = host
+        self.port = port
+        self.fingerprints = fingerprints
+        self.options = options
+        self.stop = stop
+        self.timings = []
+        self.statuses = {}
+        self.errors = 0
+        self.bytes_received = 0
+        # fingerprint -> ETag
+        self.etags = {}
+        self.random = random.Random()
+
+    def request(self, conn, fpr):
+        headers = {}
+        if not self.options["keep_alive"]:
+            headers["Connection"] = "close"
+        if self.options["gzip"]:
+            headers["Accept-Encoding"] = "gzip"
+        etag = self.etags.get(fpr)
+        if etag and self.random.random() < self.options["conditional"]:
+            headers["If-None-Match"] = etag
+        conn.request("GET", "/" + fpr, headers=headers)
+        response = conn.getresponse()
+        body = response.read()
+        if response.status == 200:
+            self.etags[fpr] = response.getheader("ETag")
+        return response.status, len(body)
+
+    def run(self):
+        conn = None
+        i = self.random.randrange(len(self.fingerprints))
+        while not self.stop.is_set():
+            fpr = self.fingerprints[i % len(self.fingerprints)]
+            i += 1
+            start = time.time()
+            try:
+                if conn is None:
+                    conn = HTTPConnection(self.host, self.port, timeout=30)
+                status, size = self.request(conn, fpr)
+            except (HTTPException, socket.error) as e:
+                log.debug("Request failed: %s", e)
+                self.errors += 1
+                if conn is not None:
+                    conn.close()
+                conn = None
+                continue
+            self.timings.append(time.time() - start)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.bytes_received += size
+            if not self.options["keep_alive"]:
+                conn.close()
+                conn = None
+        if conn is not None:
+            conn.close()
+
+
+def spawn_server(config, verbose=False):
+    "Starts the server in a child and returns it with its port and keys"
+    cmd = [sys.executable, os.path.abspath(__file__),
+           "--serve", json.dumps(config)]
+    # The request handler logs every request to stderr
+    stderr = None if verbose else open(os.devnull, "w")
+    proc = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=stderr)
+    ready = json.loads(proc.stdout.readline().decode("utf-8"))
+    return proc, ready["port"], ready["fingerprints"]
+
+
+def stop_server(proc):
+    "Stops the server and returns what it reported"
+    out, _ = proc.communicate()
+    try:
+        return json.loads(out.decode("utf-8").splitlines()[-1])
+    except (ValueError, IndexError):
+        return {"error": "Process exited with %d" % proc.returncode}
+
+
+def run(args):
+    pool = {}
+    if args.engine == "pooled":
+        # All our downloaders come from the same address
+        pool["max_per_client"] = args.max_per_client or args.clients
+        if args.workers:
+            pool["workers"] = args.workers
+    config = {
+        "engine": args.engine,
+        "sizes": args.sizes * args.keys,
+        "pool": pool,
+    }
+    proc, port, fingerprints = spawn_server(config, args.verbose)
+    options = {
+        "keep_alive": args.keep_alive,
+        "gzip": args.gzip,
+        "conditional": args.conditional,
+    }
+    stop = Event()
+    downloaders = [Downloader(args.host, port, fingerprints, options, stop)
+                   for _ in range(args.clients)]
+    start = time.time()
+    for d in downloaders:
+        d.start()
+    time.sleep(args.duration)
+    stop.set()
+    for d in downloaders:
+        d.join()
+    elapsed = time.time() - start
+    server = stop_server(proc)
+
+    timings = [t for d in downloaders for t in d.timings]
+    statuses = {}
+    for d in downloaders:
+        for status, count in d.statuses.items():
+            statuses[status] = statuses.get(status, 0) + count
+    received = sum(d.bytes_received for d in downloaders)
+    result = {
+        "engine": args.engine,
+        "clients": args.clients,
+        "key_sizes": config["sizes"],
+        "options": options,
+        "pool": pool,
+        "duration": elapsed,
+        "requests": len(timings),
+        "errors": sum(d.errors for d in downloaders),
+        "statuses": statuses,
+        "throughput_rps": len(timings) / elapsed,
+        "received_mb_per_s": received / elapsed / 1e6,
+        "server": server,
+    }
+    if timings:
+        result["latency"] = summarise(timings)
+    cpu = server.get("cpu_user", 0) + server.get("cpu_system", 0)
+    if timings:
+        result["server_cpu_ms_per_request"] = cpu * 1000 / len(timings)
+    return result
+
+
+def environment():
+    return {
+        "python": sys.version,
+        "platform": platform.platform(),
+        "cpus": os.sysconf("SC_NPROCESSORS_ONLN"),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def parse_counts(s):
+    return [int(i) for i in s.split(",") if i]
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--engine", default="threaded", choices=ENGINES)
+    parser.add_argument("--clients", default=20, type=int,
+                        help="The number of simultaneous downloaders")
+    parser.add_argument("--duration", default=10.0, type=float,
+                        help="Seconds to download for")
+    parser.add_argument("--sizes", default="3000", type=parse_counts,
+                        help="The sizes of the keys in bytes")
+    parser.add_argument("--keys", default=1, type=int,
+                        help="How many keys of each size to serve")
+    parser.add_argument("--no-keep-alive", dest="keep_alive",
+                        action="store_false",
+                        help="Use a new connection for every request")
+    parser.add_argument("--gzip", action="store_true",
+                        help="Ask for gzipped keys")
+    parser.add_argument("--conditional", default=0.0, type=float,
+                        help="The share of requests with If-None-Match")
+    parser.add_argument("--workers", type=int,
+                        help="The number of workers of the pooled engine")
+    parser.add_argument("--max-per-client", type=int,
+                        help="The pooled engine's limit of connections "
+                             "per client, by default the number of clients")
+    parser.add_argument("--host", default="::1")
+    parser.add_argument("--output", help="File to write the results to")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Show what the server logs")
+    parser.add_argument("--serve", help=argparse.SUPPRESS)
+    args = parser.parse_args(args)
+
+    if args.serve:
+        logging.basicConfig(level=logging.WARNING)
+        serve(json.loads(args.serve))
+        return 0
+
+    logging.basicConfig(level=logging.INFO)
+    log.info("Running %d clients against the %s engine for %gs",
+             args.clients, args.engine, args.duration)
+    report = {"environment": environment(), "result": run(args)}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+#    Copyright 2017 Tobias Mueller <muelli@cryptobitch.de>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+"""A Keyserver engine serving all connections on one asyncio event loop
+
+Rather than spawning a thread per connection, the connections are
+handled by the event loop of the ServeKeyThread's thread.  The loop
+sleeps until there is something to do, so that shutting down does
+not have to wait for a polling interval.
+
+Connections persist as per HTTP/1.1 and may pipeline requests.
+
+This needs Python 3.4 or later.
+"""
+
+import asyncio
+from email.utils import formatdate
+import logging
+import socket
+from threading import Event
+import time
+
+from .Keyserver import KEEPALIVE_TIMEOUT, METRICS_PATH, SERVER_VERSION
+from .Keyserver import ServeKeyThread, end_of_head
+from . import metrics as _metrics
+
+log = logging.getLogger(__name__)
+
+
+# We don't want to buffer arbitrary amounts of data for a request
+MAX_REQUEST_SIZE = 8192
+# The number of connections the kernel queues for us
+LISTEN_BACKLOG = 1024
+
+RESPONSES = {
+    200: 'OK',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    431: 'Request Header Fields Too Large',
+}
+
+
+def build_response(status, body=b'', ctype='text/plain', with_body=True,
+                   close=True):
+    "Returns the bytes of an HTTP/1.1 response"
+    head = [
+        'HTTP/1.1 %d %s' % (status, RESPONSES[status]),
+        'Server: %s' % SERVER_VERSION,
+        'Date: %s' % formatdate(usegmt=True),
+        'Content-Type: %s' % ctype,
+        'Content-Length: %d' % len(body),
+    ]
+    if close:
+        head.append('Connection: close')
+    head += ['', '']
+    response = '\r\n'.join(head).encode('ascii')
+    return response + body if with_body else response
+
+
+def parse_headers(lines):
+    "Returns a dict of the header lines with the names in lower case"
+    headers = {}
+    for line in lines:
+        name, sep, value = line.partition(':')
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return headers
+
+
+def wants_keep_alive(version, headers):
+    "Returns whether the client wants the connection to persist"
+    tokens = [t.strip().lower()
+              for t in headers.get('connection', '').split(',')]
+    if version == 'HTTP/1.1':
+        return 'close' not in tokens
+    return 'keep-alive' in tokens
+
+
+class KeyServerProtocol(asyncio.Protocol):
+    '''Answers the requests for keys of the KeyStore on a connection
+
+    Pipelined requests are answered in order.  We stop reading while
+    the client does not read our responses.  If we are given Metrics,
+    the requests are counted and local clients can get the numbers
+    from /metrics.
+    '''
+
+    def __init__(self, keystore, loop, timeout=KEEPALIVE_TIMEOUT,
+                 connections=None, metrics=None):
+        self.keystore = keystore
+        self.loop = loop
+        self.timeout = timeout
+        self.metrics = metrics
+        # The set of open connections we are to be part of
+        self.connections = connections if connections is not None else set()
+        self.transport = None
+        self.buffer = b''
+        self.closing = False
+        self.paused = False
+        self.idle_handle = None
+        self.host = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.host = transport.get_extra_info('peername')[0]
+        self.connections.add(self)
+        if self.metrics is not None:
+            self.metrics.connection_opened()
+        self.reset_idle_timer()
+
+    def connection_lost(self, exc):
+        self.closing = True
+        self.connections.discard(self)
+        if self.metrics is not None:
+            self.metrics.connection_closed()
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+
+    def reset_idle_timer(self):
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+        if self.timeout:
+            self.idle_handle = self.loop.call_later(self.timeout,
+                                                    self.transport.close)
+
+    def pause_writing(self):
+        self.paused = True
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.paused = False
+        if self.closing:
+            return
+        self.transport.resume_reading()
+        self.process()
+
+    def data_received(self, data):
+        self.buffer += data
+        self.reset_idle_timer()
+        self.process()
+
+    def process(self):
+        "Answers the complete requests in the buffer"
+        while not self.closing and not self.paused:
+            # Empty lines before a request are to be ignored
+            self.buffer = self.buffer.lstrip(b'\r\n')
+            head, sep, rest = self.buffer.partition(b'\r\n\r\n')
+            started = time.time()
+            if not sep:
+                if len(self.buffer) > MAX_REQUEST_SIZE:
+                    parts = [build_response(431)]
+                    self.respond(parts, close=True)
+                    self.record(431, parts, None, started)
+                return
+            self.buffer = rest
+            lines = head.decode('latin-1').split('\r\n')
+            status, parts, close, fingerprint = self.handle(
+                lines[0], parse_headers(lines[1:]))
+            self.respond(parts, close)
+            self.record(status, parts, fingerprint, started)
+
+    def handle(self, request_line, headers=None):
+        '''Returns the status and the buffers making up the response
+        to the request, whether the connection is to be closed
+        afterwards, and the fingerprint of the key being sent'''
+        if headers is None:
+            headers = {}
+        try:
+            method, path, version = request_line.split()
+        except ValueError:
+            return 400, [build_response(400)], True, None
+        if method not in ('GET', 'HEAD'):
+            # We do not know what to make of the request's body, if any
+            return 405, [build_response(405)], True, None
+        close = not wants_keep_alive(version, headers)
+        with_body = method == 'GET'
+        if path.split('?', 1)[0] == METRICS_PATH and \
+                self.metrics is not None and _metrics.is_local(self.host):
+            body = self.metrics.render().encode('utf-8')
+            return 200, [build_response(200, body, _metrics.CTYPE,
+                                        with_body=with_body,
+                                        close=close)], close, None
+        served = self.keystore.get_served_for_path(path)
+        if served is None:
+            return 404, [build_response(404, b'No such key',
+                                        with_body=with_body,
+                                        close=close)], close, None
+        status, head, body = served.response(headers)
+        log.debug("Serving %d bytes for %s", len(body), path)
+        parts = [head, end_of_head(close)]
+        if with_body:
+            parts.append(body)
+        return status, parts, close, served.fingerprint
+
+    def record(self, status, parts, fingerprint, started):
+        if self.metrics is not None:
+            self.metrics.record(status, sum(len(part) for part in parts),
+                                fingerprint, time.time() - started)
+
+    def respond(self, parts, close):
+        self.transport.writelines(parts)
+        if close:
+            # The transport sends whatever is buffered before closing
+            self.closing = True
+            self.transport.close()
+            self.buffer = b''
+
+
+def create_socket(server_address, backlog=LISTEN_BACKLOG):
+    "Returns a socket listening on both IPv6 and IPv4"
+    sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, False)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+        sock.bind(server_address)
+        sock.listen(backlog)
+    except (socket.error, OSError):
+        sock.close()
+        raise
+    return sock
+
+
+class AsyncKeyserver(object):
+    '''Serves the keys of the keystore on an asyncio event loop
+
+    It behaves like the servers of the socketserver module, i.e.
+    serve_forever() serves in the calling thread until another
+    thread calls shutdown().
+    '''
+
+    def __init__(self, server_address, keystore, backlog=LISTEN_BACKLOG,
+                 metrics=None):
+        self.keystore = keystore
+        self.metrics = metrics
+        self.socket = create_socket(server_address, backlog)
+        self.server_address = self.socket.getsockname()
+        self.stopped = Event()
+        self.connections = set()
+        # The loop is not bound to this thread, so we can
+        # set the server up here and run the loop elsewhere.
+        self.loop = loop = asyncio.new_event_loop()
+        self.server = loop.run_until_complete(loop.create_server(
+            lambda: KeyServerProtocol(self.keystore, loop,
+                                      connections=self.connections,
+                                      metrics=self.metrics),
+            sock=self.socket))
+
+    def serve_forever(self, poll_interval=None):
+        '''Serves until shutdown() is called.
+        The poll_interval is ignored as we do not poll.'''
+        self.stopped.clear()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.stopped.set()
+
+    def shutdown(self):
+        '''Stops serve_forever() and waits for it to have stopped'''
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.stopped.wait()
+
+    def server_close(self):
+        '''Closes the listening socket and the loop.
+        Call it after serve_forever() has returned.'''
+        loop = self.loop
+        self.server.close()
+        # Idle persistent connections would keep us waiting
+        for protocol in list(self.connections):
+            protocol.transport.close()
+        loop.run_until_complete(self.server.wait_closed())
+        loop.close()
+
+
+class AsyncServeKeyThread(ServeKeyThread):
+    '''A ServeKeyThread which serves the keys with an AsyncKeyserver'''
+
+    def create_server(self, server_address, **kwargs):
+        return AsyncKeyserver(server_address, self.keystore,
+                              metrics=self.counters, **kwargs)
@@ -18,10 +18,14 @@
 #    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+from Queue import Empty, Queue
+from threading import Lock, Thread
+import time
 from urlparse import urlparse, parse_qs, ParseResult
 
 import requests
-from requests.exceptions import ConnectionError
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
 
 from .compat import gtkbutton
 from .SignPages import ScanFingerprintPage, SignKeyPage, PostSignPage
@@ -39,6 +43,12 @@ from gi.repository import GstVideo
 Gst.init([])
 
 FPR_PREFIX = "OPENPGP4FPR:"
+# Seconds a single download may stall
+DOWNLOAD_TIMEOUT = 5
+# Seconds we wait for any of the peers to give us the key
+DOWNLOAD_DEADLINE = 10
+# Seconds the peers announcing the fingerprint get before we ask the others
+HEAD_START = 1
 progress_bar_text = ["Step 1: Scan QR Code or type fingerprint and click on 'Download' button",
                      "Step 2: Compare the received fpr with the owner's fpr and click 'Sign'",
                      "Step 3: Key was succesfully signed and an email was sent to the owner."]
@@ -49,7 +59,7 @@ progress_bar_text = ["Step 1: Scan QR Code or type fingerprint and click on 'Dow
 log = logging.getLogger(__name__)
 
 
-from .gpgmh import openpgpkey_from_data, fingerprint_from_keydata
+from .gpgbackend import openpgpkey_from_data, fingerprint_from_keydata
 
 
 
@@ -113,6 +123,11 @@ class GetKeySection(Gtk.VBox):
         # be cleaned up on exit...
         self.tmpfiles = []
 
+        # (address, port) -> requests.Session, so that downloading
+        # from the same peer again reuses the connection
+        self.sessions = {}
+        self.sessions_lock = Lock()
+
     def switch_page(self, notebook, page, page_num):
         if page_num == 0:
             self.backButton.set_sensitive(False)
@@ -198,31 +213,122 @@ class GetKeySection(Gtk.VBox):
                 fingerprint, message, image, parsed_barcode=parsed)
 
 
-    def download_key_http(self, address, port):
+    def get_session(self, address, port):
+        '''Returns the Session with the connection pool for the peer'''
+        with self.sessions_lock:
+            session = self.sessions.get((address, port))
+            if session is None:
+                session = requests.Session()
+                # All requests go to the one peer
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+                session.mount('http://', adapter)
+                self.sessions[(address, port)] = session
+            return session
+
+    def prune_sessions(self, clients):
+        '''Closes the sessions of the peers which are not among clients'''
+        peers = set((address, port) for _, address, port, _ in clients)
+        with self.sessions_lock:
+            for peer in [p for p in self.sessions if p not in peers]:
+                self.log.debug("Closing the session with %s", peer)
+                self.sessions.pop(peer).close()
+
+    def download_key_http(self, address, port, fingerprint=None):
         url = ParseResult(
             scheme='http',
             # This seems to work well enough with both IPv6 and IPv4
             netloc="[[%s]]:%d" % (address, port),
-            path='/',
+            # A keyserver may serve many keys, so we ask for ours.
+            # Those serving only one key ignore the path, anyway.
+            path='/' + (fingerprint or ''),
             params='',
             query='',
             fragment='')
         self.log.debug("Starting HTTP request")
-        data = requests.get(url.geturl(), timeout=5).content
+        session = self.get_session(address, port)
+        response = session.get(url.geturl(), timeout=DOWNLOAD_TIMEOUT)
+        # A keyserver not having our key is not worth verifying
+        response.raise_for_status()
+        data = response.content
         self.log.debug("finished downloading %d bytes", len(data))
         return data
 
-    def try_download_keys(self, clients):
+    def start_downloads(self, clients, fingerprint, results):
+        '''Downloads the key from each of the clients in a thread of its
+        own.  Puts (client, keydata) into results when a download is
+        done, with keydata being None if it failed.
+        Returns the number of downloads started.'''
+        def download(client):
+            name, address, port, fpr = client
+            keydata = None
+            try:
+                keydata = self.download_key_http(address, port, fingerprint)
+            except RequestException as e:
+                self.log.info("Could not download key from %s %i: %s",
+                              address, port, e)
+            finally:
+                # Even if it blew up, we must not wait for it in vain
+                results.put((client, keydata))
+
         for client in clients:
             self.log.debug("Getting key from client %s", client)
-            name, address, port, fpr = client
+            t = Thread(target=download, args=(client,))
+            t.daemon = True
+            t.start()
+        return len(clients)
+
+    def await_verified_key(self, results, pending, until, fingerprint,
+                           mac=None):
+        '''Verifies the results of the pending downloads as they arrive
+        until one verifies or until the given time.
+        Returns the keydata or None and the number of downloads
+        still pending.'''
+        while pending > 0:
+            remaining = until - time.time()
+            if remaining <= 0:
+                break
             try:
-                keydata = self.download_key_http(address, port)
-                yield keydata
-            except ConnectionError as e:
-                # FIXME : We probably have other errors to catch
-                self.log.exception("While downloading key from %s %i",
-                                    address, port)
+                client, keydata = results.get(timeout=remaining)
+            except Empty:
+                break
+            pending -= 1
+            if keydata is not None and \
+                    self.verify_downloaded_key(keydata, fingerprint, mac):
+                self.log.debug("Got the key from %s", client)
+                return keydata, pending
+        return None, pending
+
+    def race_download_keys(self, clients, fingerprint, mac=None,
+                           deadline=DOWNLOAD_DEADLINE, head_start=HEAD_START):
+        '''Downloads the key from the clients at once and returns
+        the first keydata which verifies or None.
+
+        The clients announcing the fingerprint are asked first.  The
+        others are only asked if those have not given us the key
+        within head_start seconds.  The results are verified as they
+        arrive.  Once one has verified, the remaining downloads are
+        left to finish in the background and their results are
+        ignored.  We stop waiting after deadline seconds.
+        '''
+        results = Queue()
+        end = time.time() + deadline
+        matching = [c for c in clients if c[3] == fingerprint]
+        others = [c for c in clients if c[3] != fingerprint]
+
+        pending = self.start_downloads(matching, fingerprint, results)
+        if matching and others:
+            until = min(end, time.time() + head_start)
+            keydata, pending = self.await_verified_key(
+                results, pending, until, fingerprint, mac)
+            if keydata is not None:
+                return keydata
+        pending += self.start_downloads(others, fingerprint, results)
+        keydata, _ = self.await_verified_key(results, pending, end,
+                                             fingerprint, mac)
+        if keydata is None:
+            self.log.info("None of the %d clients gave us the key in time",
+                          len(clients))
+        return keydata
 
     def verify_downloaded_key(self, downloaded_data, fingerprint, mac=None):
         log.info("Verifying key %r with mac %r", fingerprint, mac)
@@ -251,23 +357,30 @@ class GetKeySection(Gtk.VBox):
         return sorted_clients
 
     def obtain_key_async(self, fingerprint, callback=None, data=None, mac=None, error_cb=None):
+        '''Downloads the key in a thread of its own, so that
+        the UI stays responsive.  The callback or error_cb are
+        called from the main loop.'''
         self.log.debug("Obtaining key %r with mac %r", fingerprint, mac)
-        other_clients = self.app.discovered_services
+        other_clients = list(self.app.discovered_services)
         self.log.debug("The clients found on the network: %s", other_clients)
 
         other_clients = self.sort_clients(other_clients, fingerprint)
+        self.prune_sessions(other_clients)
 
-        for keydata in self.try_download_keys(other_clients):
-            if self.verify_downloaded_key(keydata, fingerprint, mac):
-                is_valid = True
-            else:
-                is_valid = False
+        t = Thread(target=self.obtain_key,
+                   args=(fingerprint, other_clients, callback, data, mac,
+                         error_cb))
+        t.daemon = True
+        t.start()
 
-            if is_valid:
-                # FIXME: make it to exit the entire process of signing
-                # if fingerprint was different ?
-                break
-        else:
+        # If this function is added itself via idle_add, then idle_add will
+        # keep adding this function to the loop until this func ret False
+        return False
+
+    def obtain_key(self, fingerprint, other_clients, callback=None, data=None,
+                   mac=None, error_cb=None):
+        keydata = self.race_download_keys(other_clients, fingerprint, mac)
+        if keydata is None:
             self.log.error("Could not find fingerprint %s " +\
                            "with the available clients (%s)",
                            fingerprint, other_clients)
@@ -276,16 +389,11 @@ class GetKeySection(Gtk.VBox):
 
             if error_cb:
                 GLib.idle_add(error_cb, data)
-            # FIXME : don't return here
             return
 
         self.log.debug('Adding %s as callback', callback)
         GLib.idle_add(callback, fingerprint, keydata, data)
 
-        # If this function is added itself via idle_add, then idle_add will
-        # keep adding this function to the loop until this func ret False
-        return False
-
 
 
     def sign_keydata_and_send(self, keydata, callback=None):
@@ -37,7 +37,7 @@ if  __name__ == "__main__" and __package__ is None:
     __package__ = str('keysign')
 
 from .__init__ import __version__
-from .gpgmh import get_public_key_data
+from .gpgbackend import get_public_key_data
 from .QRCode import QRImage
 from .util import mac_verify, mac_generate
 from .util import format_fingerprint
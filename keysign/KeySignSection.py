@@ -25,7 +25,7 @@ from gi.repository import Gtk
 from .KeyPresent import KeyPresentPage
 from . import Keyserver
 from .KeysPage import KeysPage
-from .gpgmh import get_public_key_data
+from .gpgbackend import get_public_key_data
 from .util import mac_generate
 
 log = logging.getLogger(__name__)
@@ -153,8 +153,8 @@ class KeySignSection(Gtk.VBox):
         announces the fingerprint as TXT record using Avahi
         """
         self.log.info('Serving now')
-        self.log.debug('About to call %r', Keyserver.ServeKeyThread)
-        self.keyserver = Keyserver.ServeKeyThread(str(keydata), fingerprint)
+        self.log.debug('About to call %r', Keyserver.create_keyserver)
+        self.keyserver = Keyserver.create_keyserver(keydata, fingerprint)
         self.log.info('Starting thread %r', self.keyserver)
         self.keyserver.start()
         self.log.info('Finsihed serving')
@@ -26,7 +26,8 @@ import logging
 from gi.repository import Gtk, GLib
 from gi.repository import GObject
 
-from .gpgmh import get_usable_secret_keys, get_usable_keys
+from .gpgbackend import get_usable_secret_keys, get_usable_keys
+from .gpgbackend import signature_index
 
 # These are relative imports
 from __init__ import __version__
@@ -81,6 +82,11 @@ class KeysPage(Gtk.VBox):
             for uid in uidslist:
                 self.store.append((uid.name, uid.email, fingerprint))
 
+        # One gpg call for all the keys rather than one per selection,
+        # which not all backends can provide, though.
+        self.signature_index = signature_index(
+            [key.fingerprint for key in keys])
+
         if len(self.store) == 0:
             self.pack_start(Gtk.Label("You don't have a private key"), True, True, 0)
         else:
@@ -174,16 +180,23 @@ class KeysPage(Gtk.VBox):
             pane.remove(child)
         ctx = {'keyid':fingerprint[-8:], 'expiry':expiry,
                'sigs':'', 'fingerprint':fingerprint}
+        if self.signature_index is not None:
+            # We count the signatures made by others, not the self signatures
+            sigs = [sig for sig in self.signature_index.signatures(fingerprint)
+                    if not fingerprint.endswith(sig[0])]
+            ctx['sigs'] = len(sigs)
         keyid_label = Gtk.Label(label='Key {keyid}'.format(**ctx))
         expiration_label = Gtk.Label(label='Expires: {expiry}'.format(**ctx))
-        #signatures_label = Gtk.Label(label='{sigs} signatures'.format(**ctx))
+        signatures_label = Gtk.Label(label='{sigs} signatures'.format(**ctx))
         publish_button = Gtk.Button(label='Go ahead!'.format(**ctx))
         publish_button.connect('clicked', self.on_publish_button_clicked, key)
         for w in (keyid_label
                   , expiration_label
-                  #, signatures_label
+                  , signatures_label
                   , publish_button
                   ):
+            if w is signatures_label and self.signature_index is None:
+                continue
             pane.add(w)
         pane.show_all()
 
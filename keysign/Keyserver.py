@@ -24,10 +24,18 @@ try:
 except ImportError:
     from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
     from SocketServer import ThreadingMixIn
+from collections import OrderedDict
+from email.utils import formatdate
+import gzip
+from hashlib import sha256
+from io import BytesIO
+import errno
 import logging
 import os
 import socket
-from threading import Thread
+from threading import Lock, Thread, current_thread
+import time
+import zlib
 
 # This is probably really bad...  But doing relative imports only
 # works for modules.  However, I want to be able to call this Keyserver.py
@@ -45,27 +53,366 @@ if  __name__ == "__main__" and __package__ is None:
     __package__ = str('keysign')
 
 from .__init__ import __version__
-from .network.AvahiPublisher import AvahiPublisher
 
-from .gpgmh import fingerprint_from_keydata
+from .gpgbackend import fingerprint_from_keydata
+from .keycache import key_cache
+from . import metrics as _metrics
 
 log = logging.getLogger(__name__)
 
+SERVER_VERSION = 'GNOME-Keysign/' + '%s' % __version__
+
+# As per RFC 2015 Section 7
+# https://tools.ietf.org/html/rfc2015#section-7
+KEY_CTYPE = 'application/pgp-keys'
+
+# The content codings we can send the keys in, most preferred first
+ENCODINGS = ('gzip', 'deflate')
+
+# Seconds after which an idle persistent connection is closed
+KEEPALIVE_TIMEOUT = 15
+
+# Where the Metrics are served to local clients
+METRICS_PATH = '/metrics'
+
+
+def normalise_fingerprint(fpr):
+    "Returns the fingerprint in upper case and without spaces"
+    return ''.join(fpr.split()).upper()
+
+
+def gzip_compress(data):
+    "Returns the data gzipped without a timestamp, so that it is stable"
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def encode_head(status, headers):
+    """Returns the status line and the header lines as bytes
+
+    The Date and the empty line ending the head are not included,
+    see end_of_head().
+    """
+    lines = ['HTTP/1.1 %d %s' % (status,
+                                 BaseHTTPRequestHandler.responses[status][0])]
+    lines += ['%s: %s' % header for header in headers]
+    lines.append('')
+    return '\r\n'.join(lines).encode('ascii')
+
+
+# (second, end of head keeping the connection, end of head closing it)
+# as last formatted
+_end_of_head = (None, b'', b'')
+
+def end_of_head(close=False):
+    """Returns the Date line, a Connection: close if the connection
+    is to be closed, and the empty line.  It is formatted once a second."""
+    global _end_of_head
+    now = int(time.time())
+    second, keep, closing = _end_of_head
+    if second != now:
+        date = 'Date: %s\r\n' % formatdate(now, usegmt=True)
+        keep = (date + '\r\n').encode('ascii')
+        closing = (date + 'Connection: close\r\n\r\n').encode('ascii')
+        _end_of_head = (now, keep, closing)
+    return closing if close else keep
+
+
+def send_parts(sock, parts):
+    """Sends the buffers without joining them first
+
+    If the platform can, the buffers are handed to the kernel
+    in a single system call.
+    """
+    sendmsg = getattr(sock, 'sendmsg', None)
+    if sendmsg is None:
+        for part in parts:
+            sock.sendall(part)
+        return
+    parts = [memoryview(part) for part in parts if len(part)]
+    while parts:
+        sent = sendmsg(parts)
+        while parts and sent >= len(parts[0]):
+            sent -= len(parts[0])
+            parts.pop(0)
+        if sent:
+            parts[0] = parts[0][sent:]
+
+
+def parse_accept_encoding(value):
+    "Returns a dict mapping the codings of an Accept-Encoding to their q"
+    codings = {}
+    for item in (value or '').split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, v = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+
+class ServedKey(object):
+    '''A key as the Keyserver serves it
+
+    The compressed variants and their strong ETags, derived from the
+    SHA-256 of the keydata, are computed once rather than per request.
+    So are the heads of the responses, such that serving a request
+    only means picking the variant and sending the buffers.
+    '''
+    # Set by the KeyStore
+    fingerprint = None
+
+    def __init__(self, keydata):
+        if not isinstance(keydata, bytes):
+            keydata = keydata.encode('utf-8')
+        self.keydata = keydata
+        digest = sha256(keydata).hexdigest()
+        # encoding -> (body, ETag), None being the identity
+        self.variants = OrderedDict()
+        self.variants[None] = (keydata, '"%s"' % digest)
+        compressed = {
+            'gzip': gzip_compress(keydata),
+            'deflate': zlib.compress(keydata, 9),
+        }
+        for encoding in ENCODINGS:
+            body = compressed[encoding]
+            # Tiny keys do not necessarily get smaller
+            if len(body) < len(keydata):
+                self.variants[encoding] = (body, '"%s-%s"' % (digest, encoding))
+        self.etags = set(etag for _, etag in self.variants.values())
+
+        # (status, encoding) -> (head, body)
+        self.responses = {}
+        for encoding, (body, etag) in self.variants.items():
+            headers = [
+                ('Server', SERVER_VERSION),
+                ('ETag', etag),
+                ('Vary', 'Accept-Encoding'),
+            ]
+            self.responses[(304, encoding)] = (encode_head(304, headers),
+                                               memoryview(b''))
+            headers.append(('Content-Type', KEY_CTYPE))
+            if encoding:
+                headers.append(('Content-Encoding', encoding))
+            headers.append(('Content-Length', str(len(body))))
+            self.responses[(200, encoding)] = (encode_head(200, headers),
+                                               memoryview(body))
+
+    def select(self, accept_encoding=None):
+        "Returns the encoding, body, and ETag to send given Accept-Encoding"
+        accepted = parse_accept_encoding(accept_encoding)
+        best, best_q = None, 0
+        for encoding in self.variants:
+            if encoding is None:
+                continue
+            q = accepted.get(encoding, accepted.get('*', 0))
+            if q > best_q:
+                best, best_q = encoding, q
+        body, etag = self.variants[best]
+        return best, body, etag
+
+    def matches(self, if_none_match):
+        "Returns whether the client has the key already as per If-None-Match"
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            # If-None-Match uses the weak comparison
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag in self.etags:
+                return True
+        return False
+
+    def response(self, headers):
+        '''Returns the status, the head, and the body of the response.
+        The head lacks the end_of_head().  headers are the request's
+        headers and need to provide get() with lower case names.'''
+        encoding, _, _ = self.select(headers.get('accept-encoding'))
+        status = 304 if self.matches(headers.get('if-none-match')) else 200
+        head, body = self.responses[(status, encoding)]
+        return status, head, body
+
+
+class KeyStore(object):
+    """The keys a Keyserver serves, indexed by their fingerprints
+
+    The first key added is the default key, i.e. the one being
+    served when no fingerprint is requested.  If the default key
+    is removed, the next remaining one becomes the default.
+    Keys can be added and removed while the server is running.
+    """
+    def __init__(self):
+        self.keys = OrderedDict()
+        self.lock = Lock()
+
+    def add(self, keydata, fpr=None):
+        "Adds the key and returns its fingerprint"
+        if fpr is None:
+            fpr = fingerprint_from_keydata(keydata)
+        fpr = normalise_fingerprint(fpr)
+        served = ServedKey(keydata)
+        served.fingerprint = fpr
+        with self.lock:
+            self.keys[fpr] = served
+        return fpr
+
+    def remove(self, fpr):
+        "Removes the key and returns its data or None if we didn't have it"
+        with self.lock:
+            served = self.keys.pop(normalise_fingerprint(fpr), None)
+        return served.keydata if served else None
+
+    def get_served(self, fpr=None):
+        "Returns the ServedKey for the fingerprint or the default key"
+        with self.lock:
+            if fpr:
+                return self.keys.get(normalise_fingerprint(fpr))
+            for served in self.keys.values():
+                return served
+        return None
+
+    def get(self, fpr=None):
+        "Returns the keydata for the fingerprint or the default key"
+        served = self.get_served(fpr)
+        return served.keydata if served else None
+
+    def get_served_for_path(self, path):
+        "Returns the ServedKey for a request's path or None"
+        return self.get_served(path.split('?', 1)[0].strip('/'))
+
+    def get_for_path(self, path):
+        "Returns the keydata for a request's path or None"
+        served = self.get_served_for_path(path)
+        return served.keydata if served else None
+
+    def fingerprints(self):
+        with self.lock:
+            return list(self.keys.keys())
+
+    def __contains__(self, fpr):
+        with self.lock:
+            return normalise_fingerprint(fpr) in self.keys
+
+    def __len__(self):
+        with self.lock:
+            return len(self.keys)
+
+
+
 class KeyRequestHandlerBase(BaseHTTPRequestHandler):
-    '''This is the "base class" which needs to be given access
-    to the key to be served. So you will not use this class,
-    but create a use one inheriting from this class. The subclass
-    must also define a keydata field.
+    '''Serves the keys of the server's KeyStore.
+
+    /<fingerprint> yields the key with that fingerprint and /
+    yields the default key.  For compatibility, a subclass may
+    still define a keydata field which is then served for /.
+
+    Clients may ask for the key gzipped or deflated and get
+    a 304 if their If-None-Match has the key's ETag.  Connections
+    persist as per HTTP/1.1 until they are idle for the timeout.
+
+    If the server has Metrics, the requests are counted and
+    local clients can get the numbers from /metrics.
     '''
-    server_version = 'GNOME-Keysign/' + '%s' % __version__
+    server_version = SERVER_VERSION
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
+
+    ctype = KEY_CTYPE
 
-    # As per RFC 2015 Section 7
-    # https://tools.ietf.org/html/rfc2015#section-7
-    ctype = 'application/pgp-keys'
+    keydata = None
+
+    # When we started to read the current request
+    started = None
+    # The fingerprint of the key we are sending
+    fingerprint = None
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.metrics = getattr(self.server, 'metrics', None)
+        if self.metrics is not None:
+            self.metrics.connection_opened()
+
+    def finish(self):
+        try:
+            BaseHTTPRequestHandler.finish(self)
+        finally:
+            if self.metrics is not None:
+                self.metrics.connection_closed()
+
+    def parse_request(self):
+        self.started = time.time()
+        self.fingerprint = None
+        return BaseHTTPRequestHandler.parse_request(self)
+
+    def log_request(self, code='-', size='-'):
+        BaseHTTPRequestHandler.log_request(self, code, size)
+        if self.metrics is not None:
+            seconds = time.time() - self.started if self.started else None
+            self.metrics.record(int(code), size if size != '-' else 0,
+                                self.fingerprint, seconds)
+
+    def get_served_key(self):
+        "Returns the ServedKey for the requested path or None"
+        if self.keydata and not self.path.split('?', 1)[0].strip('/'):
+            return key_cache.get(self.keydata, 'served', ServedKey)
+        keystore = getattr(self.server, 'keystore', None)
+        if keystore is None:
+            return None
+        return keystore.get_served_for_path(self.path)
+
+    def get_keydata(self):
+        "Returns the keydata for the requested path or None"
+        served = self.get_served_key()
+        return served.keydata if served else None
 
     def do_GET(self):
-        f = self.send_head(self.keydata)
-        self.wfile.write(self.keydata)
+        if self.path.split('?', 1)[0] == METRICS_PATH:
+            self.send_metrics()
+        else:
+            self.send_key()
+
+    def send_metrics(self):
+        if self.metrics is None or \
+                not _metrics.is_local(self.client_address[0]):
+            self.send_error(404, "No such key")
+            return
+        body = self.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', _metrics.CTYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.send_key(with_body=False)
+
+    def send_key(self, with_body=True):
+        served = self.get_served_key()
+        if served is None:
+            self.send_error(404, "No such key")
+            return
+        self.fingerprint = served.fingerprint
+        status, head, body = served.response(self.headers)
+        parts = [head, end_of_head(self.close_connection)]
+        if with_body:
+            parts.append(body)
+        # Nothing should be buffered, but we write around the wfile
+        self.wfile.flush()
+        send_parts(self.connection, parts)
+        self.log_request(status, sum(len(part) for part in parts))
 
     def send_head(self, keydata=None):
         kd = keydata if keydata else self.keydata
@@ -78,10 +425,15 @@ class KeyRequestHandlerBase(BaseHTTPRequestHandler):
 class ThreadedKeyserver(ThreadingMixIn, HTTPServer):
     '''The keyserver in a threaded fashion'''
     address_family = socket.AF_INET6
+    # Idle persistent connections must not keep us from shutting down
+    daemon_threads = True
 
     def __init__(self, server_address, *args, **kwargs):
+        self.keystore = kwargs.pop('keystore', None)
+        self.metrics = kwargs.pop('metrics', None)
         if issubclass(self.__class__, object):
-            super(ThreadedKeyserver, self).__init__(*args, **kwargs)
+            super(ThreadedKeyserver, self).__init__(server_address,
+                                                    *args, **kwargs)
         else:
             HTTPServer.__init__(self, server_address, *args, **kwargs)
             # WTF? There is no __init__..?
@@ -95,20 +447,110 @@ class ThreadedKeyserver(ThreadingMixIn, HTTPServer):
 
 
 
+def avahi_publisher(**kwargs):
+    '''Returns an AvahiPublisher for the service.
+    It is imported only now, because it needs D-Bus.'''
+    from .network.AvahiPublisher import AvahiPublisher
+    return AvahiPublisher(**kwargs)
+
+
 class ServeKeyThread(Thread):
     '''Serves requests and manages the server in separates threads.
     You can create an object and call start() to let it run.
     If you want to stop serving, call shutdown().
+
+    The first key is the one given to the constructor, if any.
+    You can serve more keys with add_key() and stop serving
+    them with remove_key(), even while the server is running.
+    Each key is announced as a service of its own.
+    What the server does is counted; see metrics().
     '''
 
-    def __init__(self, data, fpr, port=9001, *args, **kwargs):
-        '''Initializes the server to serve the data'''
-        self.keydata = data
-        self.fpr = fpr
+    def __init__(self, data=None, fpr=None, port=0, *args, **kwargs):
+        '''Initializes the server to serve the data.
+        With port 0, the kernel picks a free port when starting.
+        A publisher keyword argument replaces avahi_publisher()
+        for announcing the keys.'''
+        self.publisher = kwargs.pop('publisher', None) or avahi_publisher
+        self.keystore = KeyStore()
+        if data:
+            self.keystore.add(data, fpr)
         self.port = port
+        self.counters = _metrics.Metrics()
         super(ServeKeyThread, self).__init__(*args, **kwargs)
         self.daemon = True
         self.httpd = None
+        self.avahi_publishers = {}
+
+
+    @property
+    def keydata(self):
+        "The default key"
+        return self.keystore.get()
+
+    @property
+    def fpr(self):
+        "The fingerprint of the default key"
+        fprs = self.keystore.fingerprints()
+        return fprs[0] if fprs else None
+
+
+    def create_server(self, server_address, **kwargs):
+        '''Returns the server listening on server_address.
+        It needs to provide serve_forever(), shutdown(), and socket
+        like the servers of the socketserver module.'''
+        return ThreadedKeyserver(server_address, KeyRequestHandlerBase,
+                                 keystore=self.keystore,
+                                 metrics=self.counters, **kwargs)
+
+
+    def metrics(self):
+        '''Returns a dict with what the server has done so far, e.g.
+        the number of requests and the latencies per fingerprint'''
+        return self.counters.snapshot()
+
+
+    def add_key(self, keydata, fpr=None):
+        '''Serves keydata at /<fpr> from now on and announces it.
+        The fingerprint is determined from the keydata if not given.
+        Returns the fingerprint.'''
+        fpr = self.keystore.add(keydata, fpr)
+        if self.httpd is not None and fpr not in self.avahi_publishers:
+            self.publish(fpr, self.port)
+        return fpr
+
+
+    def remove_key(self, fpr):
+        '''Stops serving and announcing the key'''
+        fpr = normalise_fingerprint(fpr)
+        self.unpublish(fpr)
+        return self.keystore.remove(fpr)
+
+
+    def publish(self, fpr, port):
+        '''Announces the key with the fingerprint via Avahi'''
+        service_txt = {
+            'fingerprint': fpr,
+            'version': __version__,
+        }
+        log.info('Requesting Avahi with txt: %s', service_txt)
+        self.avahi_publishers[fpr] = ap = self.publisher(
+            service_port = port,
+            service_name = 'HTTP Keyserver %s' % fpr,
+            service_txt = service_txt,
+            # self.keydata is too big for Avahi; it crashes
+            service_type = '_gnome-keysign._tcp',
+        )
+        log.info('Trying to add Avahi Service')
+        ap.add_service()
+
+
+    def unpublish(self, fpr):
+        '''Withdraws the announcement of the key'''
+        ap = self.avahi_publishers.pop(fpr, None)
+        if ap is not None:
+            log.info("Removing Avahi Service for %s", fpr)
+            ap.remove_service()
 
 
     def start(self, data=None, fpr=None, port=None, *args, **kwargs):
@@ -121,59 +563,33 @@ class ServeKeyThread(Thread):
         in order for this work.
         '''
 
-        port = port or self.port or 9001
-        fpr = fpr or self.fpr
-
-        tries = 10
-
-        kd = data if data else self.keydata
-
-        class KeyRequestHandler(KeyRequestHandlerBase):
-            '''You will need to create this during runtime'''
-            keydata = kd
-        HandlerClass = KeyRequestHandler
-
-        for port_i in (port + p for p in range(tries)):
-            try:
-                log.info('Trying port %d', port_i)
-                server_address = ('', port_i)
-                self.httpd = ThreadedKeyserver(server_address, HandlerClass, **kwargs)
+        if port is None:
+            port = self.port
+        if data:
+            self.keystore.add(data, fpr)
 
-                ###
-                # This is a bit of a hack, it really should be
-                # in some lower layer, such as the place were
-                # the socket is created and listen()ed on.
-                service_txt = {
-                    'fingerprint': fpr,
-                    'version': __version__,
-                }
+        self.httpd = self.bind(port)
+        # The port the kernel has chosen, if we have asked it to
+        self.port = self.httpd.socket.getsockname()[1]
+        log.info('Listening on port %d', self.port)
 
+        # Only now that we know we can serve, we announce the keys
+        for key_fpr in self.keystore.fingerprints():
+            self.publish(key_fpr, self.port)
 
-                log.info('Requesting Avahi with txt: %s', service_txt)
-
-                self.avahi_publisher = ap = AvahiPublisher(
-                    service_port = port_i,
-                    service_name = 'HTTP Keyserver %s' % fpr,
-                    service_txt = service_txt,
-                    # self.keydata is too big for Avahi; it crashes
-                    service_type = '_gnome-keysign._tcp',
-                )
-                log.info('Trying to add Avahi Service')
-                ap.add_service()
-
-            except socket.error as value:
-                errno = value.errno
-                if errno == 10054 or errno == 32:
-                    # This seems to be harmless
-                    break
-            else:
-                break
-
-            finally:
-                pass
+        super(ServeKeyThread, self).start(*args, **kwargs)
 
 
-        super(ServeKeyThread, self).start(*args, **kwargs)
+    def bind(self, port):
+        '''Returns the server listening on port.
+        If the port is taken, the kernel picks another one.'''
+        try:
+            return self.create_server(('', port))
+        except socket.error as e:
+            if not port or e.errno != errno.EADDRINUSE:
+                raise
+            log.warning('Port %d is in use, using another one', port)
+            return self.create_server(('', 0))
 
 
     def serve_key(self, poll_interval=0.15):
@@ -189,7 +605,8 @@ class ServeKeyThread(Thread):
             self.httpd.serve_forever(poll_interval=poll_interval)
         finally:
             log.info('finished serving')
-            #httpd.dispose()
+            # Closes the socket and lets the engine stop its threads
+            self.httpd.server_close()
 
 
 
@@ -200,16 +617,45 @@ class ServeKeyThread(Thread):
 
 
     def shutdown(self):
-        '''Sends shutdown to the underlying httpd'''
-        log.info("Removing Avahi Service")
-        self.avahi_publisher.remove_service()
+        '''Sends shutdown to the underlying httpd and waits
+        for the server to have closed its socket'''
+        log.info("Removing Avahi Services")
+        for fpr in list(self.avahi_publishers.keys()):
+            self.unpublish(fpr)
         log.info("Shutting down httpd %r", self.httpd)
         self.httpd.shutdown()
+        if self.is_alive() and current_thread() is not self:
+            self.join()
+
+
+# The engines that can serve the keys
+ENGINES = ('threaded', 'asyncio', 'pooled')
+
+
+def create_keyserver(data=None, fpr=None, engine=None, *args, **kwargs):
+    '''Returns a ServeKeyThread using the given engine.
+    If no engine is given, KEYSIGN_KEYSERVER_ENGINE determines it.
+    The asyncio engine serves all connections on a single thread,
+    but needs Python 3.  The pooled engine serves them with a fixed
+    number of threads and turns clients away when they are all busy.'''
+    engine = engine or os.environ.get('KEYSIGN_KEYSERVER_ENGINE', 'threaded')
+    if engine == 'asyncio':
+        from .AsyncKeyserver import AsyncServeKeyThread
+        cls = AsyncServeKeyThread
+    elif engine == 'pooled':
+        from .PooledKeyserver import PooledServeKeyThread
+        cls = PooledServeKeyThread
+    elif engine == 'threaded':
+        cls = ServeKeyThread
+    else:
+        raise ValueError("Unknown keyserver engine %r. Choose one of %s"
+                         % (engine, ", ".join(ENGINES)))
+    return cls(data, fpr, *args, **kwargs)
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
-    import dbus, time
+    import dbus
     dbus.mainloop.glib.DBusGMainLoop (set_as_default=True)
     def stop_thread(t, seconds=5):
         log.info('Sleeping %d seconds, then stopping', seconds)
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+#    Copyright 2017 Tobias Mueller <muelli@cryptobitch.de>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+"""A Keyserver engine serving connections with a fixed pool of threads
+
+When a whole room downloads the key at once, spawning a thread per
+connection makes the presenting machine slow for everybody.  Here, a
+fixed number of workers serve the connections queued by the accepting
+thread.  Connections which cannot be queued, or which would exceed the
+number of connections per client, are turned away with a 503.
+A connection may take header_timeout seconds to send its request and
+body_timeout seconds to receive the response.  Otherwise, it is shut
+down, so that slow clients cannot occupy the workers.
+"""
+
+try:
+    from http.server import HTTPServer
+    from queue import Empty, Full, Queue
+except ImportError:
+    from BaseHTTPServer import HTTPServer
+    from Queue import Empty, Full, Queue
+import logging
+import socket
+from threading import Event, Lock, Thread
+import time
+
+from .Keyserver import KeyRequestHandlerBase, ServeKeyThread
+from .Keyserver import SERVER_VERSION, encode_head, end_of_head
+from .metrics import REJECTED, TIMED_OUT
+
+log = logging.getLogger(__name__)
+
+
+# The number of threads serving connections
+WORKERS = 8
+# The number of accepted connections waiting for a worker
+QUEUE_SIZE = 32
+# The number of connections the kernel queues for us to accept
+LISTEN_BACKLOG = 64
+# The number of connections a single client may have with us
+MAX_PER_CLIENT = 4
+# Seconds a client may take to send a request, including being idle
+# between two requests on a persistent connection
+HEADER_TIMEOUT = 5
+# Seconds a client may take to receive a response
+BODY_TIMEOUT = 30
+
+
+def shutdown_socket(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
+
+
+class Watchdog(Thread):
+    '''Shuts down the connections which are busy past their deadline
+
+    Shutting a socket down makes the worker blocked on it return,
+    whereas a socket timeout would only bound a single recv or send.
+    '''
+    def __init__(self, interval=0.5, metrics=None):
+        super(Watchdog, self).__init__(name='Keyserver watchdog')
+        self.daemon = True
+        self.interval = interval
+        self.metrics = metrics
+        self.deadlines = {}
+        self.lock = Lock()
+        self.stopped = Event()
+        self.expired = 0
+        # Once closing, every connection is shut down right away
+        self.closing = False
+
+    def set(self, sock, timeout):
+        "Shuts sock down if it is still busy after timeout seconds"
+        with self.lock:
+            self.deadlines[sock] = time.time() + timeout
+            closing = self.closing
+        if closing:
+            self.expire_all()
+
+    def clear(self, sock):
+        with self.lock:
+            self.deadlines.pop(sock, None)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            now = time.time()
+            with self.lock:
+                expired = [s for s, d in self.deadlines.items() if d <= now]
+                for sock in expired:
+                    del self.deadlines[sock]
+                self.expired += len(expired)
+            if expired and self.metrics is not None:
+                self.metrics.inc(TIMED_OUT, len(expired))
+            for sock in expired:
+                log.info("Shutting down %r as it took too long", sock)
+                shutdown_socket(sock)
+
+    def expire_all(self):
+        "Shuts all connections down now and any set from now on, too"
+        with self.lock:
+            self.closing = True
+            socks = list(self.deadlines.keys())
+            self.deadlines.clear()
+        for sock in socks:
+            shutdown_socket(sock)
+
+    def stop(self):
+        self.stopped.set()
+
+
+class PooledKeyRequestHandler(KeyRequestHandlerBase):
+    '''Serves the keys within the deadlines the server sets'''
+
+    # The watchdog bounds the time we wait for a request
+    timeout = None
+
+    def handle_one_request(self):
+        watchdog = self.server.watchdog
+        watchdog.set(self.connection, self.server.header_timeout)
+        try:
+            KeyRequestHandlerBase.handle_one_request(self)
+        finally:
+            watchdog.clear(self.connection)
+
+    def send_key(self, with_body=True):
+        self.server.watchdog.set(self.connection, self.server.body_timeout)
+        KeyRequestHandlerBase.send_key(self, with_body)
+
+
+class PooledKeyserver(HTTPServer):
+    '''Serves the keys of the keystore with a fixed pool of workers'''
+    address_family = socket.AF_INET6
+
+    def __init__(self, server_address, RequestHandlerClass=None,
+                 keystore=None, metrics=None, workers=WORKERS,
+                 queue_size=QUEUE_SIZE, backlog=LISTEN_BACKLOG,
+                 max_per_client=MAX_PER_CLIENT,
+                 header_timeout=HEADER_TIMEOUT, body_timeout=BODY_TIMEOUT):
+        self.keystore = keystore
+        self.metrics = metrics
+        # Used by server_activate() to listen()
+        self.request_queue_size = backlog
+        self.max_per_client = max_per_client
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        # The old style classes of Python 2 do not know super()
+        HTTPServer.__init__(self, server_address,
+                            RequestHandlerClass or PooledKeyRequestHandler)
+
+        self.lock = Lock()
+        # client address -> number of its connections we have
+        self.active = {}
+        self.rejected = 0
+        self.queue = Queue(queue_size)
+        self.watchdog = Watchdog(metrics=metrics)
+        self.watchdog.start()
+        self.workers = []
+        for i in range(workers):
+            worker = Thread(target=self.work, name='Keyserver worker %d' % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def server_bind(self):
+        # We want to listen to both IPv4 and IPv6
+        self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, False)
+        HTTPServer.server_bind(self)
+
+    def process_request(self, request, client_address):
+        "Queues the connection for a worker or rejects it"
+        host = client_address[0]
+        with self.lock:
+            if self.active.get(host, 0) >= self.max_per_client:
+                reason = "too many connections from the client"
+            else:
+                try:
+                    self.queue.put_nowait((request, client_address))
+                except Full:
+                    reason = "all workers are busy"
+                else:
+                    self.active[host] = self.active.get(host, 0) + 1
+                    return
+            self.rejected += 1
+        if self.metrics is not None:
+            self.metrics.inc(REJECTED)
+        log.info("Rejecting connection from %s: %s", host, reason)
+        self.reject(request)
+
+    def reject(self, request):
+        "Tells the client to come back later and closes the connection"
+        response = encode_head(503, [
+            ('Server', SERVER_VERSION),
+            ('Retry-After', '1'),
+            ('Content-Length', '0'),
+        ]) + end_of_head(close=True)
+        try:
+            # We must not block the accepting thread
+            request.setblocking(False)
+            request.send(response)
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+    def release(self, client_address):
+        host = client_address[0]
+        with self.lock:
+            count = self.active.get(host, 0) - 1
+            if count > 0:
+                self.active[host] = count
+            else:
+                self.active.pop(host, None)
+
+    def work(self):
+        "Serves the queued connections until it gets None"
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except socket.error as e:
+                # Most likely, the watchdog has shut the connection down
+                log.debug("Connection with %s failed: %s", client_address, e)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                self.release(client_address)
+
+    def stats(self):
+        "Returns the numbers of rejected and timed out connections"
+        with self.lock:
+            active = sum(self.active.values())
+            rejected = self.rejected
+        return {
+            'active': active,
+            'rejected': rejected,
+            'timed_out': self.watchdog.expired,
+        }
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        # Idle persistent connections would keep the workers
+        # waiting for a request until the header_timeout
+        self.watchdog.expire_all()
+        # Close the connections no worker has taken yet, so that
+        # there is room in the queue for the workers to stop
+        while True:
+            try:
+                request, client_address = self.queue.get_nowait()
+            except Empty:
+                break
+            self.shutdown_request(request)
+            self.release(client_address)
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join(self.body_timeout)
+        self.watchdog.stop()
+
+
+class PooledServeKeyThread(ServeKeyThread):
+    '''A ServeKeyThread which serves the keys with a PooledKeyserver
+
+    The keyword arguments of PooledKeyserver, e.g. workers or
+    max_per_client, can be given to the constructor.
+    '''
+
+    POOL_OPTIONS = ('workers', 'queue_size', 'backlog', 'max_per_client',
+                    'header_timeout', 'body_timeout')
+
+    def __init__(self, *args, **kwargs):
+        self.pool_options = dict((name, kwargs.pop(name))
+                                 for name in self.POOL_OPTIONS
+                                 if name in kwargs)
+        super(PooledServeKeyThread, self).__init__(*args, **kwargs)
+
+    def create_server(self, server_address, **kwargs):
+        options = dict(self.pool_options, **kwargs)
+        return PooledKeyserver(server_address, keystore=self.keystore,
+                               metrics=self.counters, **options)
+
+    def stats(self):
+        return self.httpd.stats()
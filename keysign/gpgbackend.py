@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+#    Copyright 2017 Tobias Mueller <muelli@cryptobitch.de>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+"""The OpenPGP backends and the choice between them
+
+A backend is a module providing the functions in INTERFACE.
+The backend is imported when one of the functions of this module
+is called for the first time, not when this module is imported.
+Which backend is used is determined by the KEYSIGN_BACKEND
+environment variable.  It names a backend or is "auto" to have the
+fastest of the available backends chosen.  If not set, DEFAULT_BACKEND
+is used.  The choice made by "auto" is remembered in the user's cache
+directory.  Until it has been made, the default backend is used and
+the backends are benchmarked in a thread of their own, so that the
+first start does not block whoever asked for the backend, e.g. the UI.
+"""
+
+from collections import OrderedDict
+from importlib import import_module
+import json
+import logging
+import os
+import shutil
+from subprocess import call
+import sys
+import tempfile
+from threading import Lock, Thread
+import time
+
+from .keycache import keyring_cache
+
+log = logging.getLogger(__name__)
+
+
+# The functions a backend has to provide
+INTERFACE = (
+    "openpgpkey_from_data",
+    "fingerprint_from_keydata",
+    "get_public_key_data",
+    "get_usable_keys",
+    "get_usable_secret_keys",
+    "sign_keydata_and_encrypt",
+)
+
+DEFAULT_BACKEND = "monkeysign"
+AUTO = "auto"
+# How often each backend lists the keyring when benchmarking
+BENCHMARK_ROUNDS = 3
+
+# name -> module name, relative to this package
+_backends = OrderedDict()
+_backend = None
+_lock = Lock()
+# The thread benchmarking the backends for the auto mode, if any
+_benchmark = None
+
+
+def register(name, module):
+    "Makes the backend implemented in module available as name"
+    _backends[name] = module
+
+register("gpgme", ".gpgmeh")
+register("monkeysign", ".gpgmh")
+
+
+def backend_names():
+    "Returns the names of the registered backends"
+    return list(_backends.keys())
+
+
+def load(name):
+    """Imports the backend called name and returns its module
+
+    Raises ValueError if there is no such backend and ImportError
+    if it cannot be imported, e.g. because its dependencies
+    are missing.
+    """
+    try:
+        module_name = _backends[name]
+    except KeyError:
+        raise ValueError("Unknown backend %r. Choose one of %s"
+                         % (name, ", ".join(backend_names())))
+    module = import_module(module_name, __name__.rpartition(".")[0])
+    missing = [f for f in INTERFACE if not hasattr(module, f)]
+    if missing:
+        raise ValueError("Backend %r lacks %s" % (name, ", ".join(missing)))
+    return module
+
+
+def available_backends():
+    "Returns the loaded modules of the backends which can be imported"
+    backends = OrderedDict()
+    for name in backend_names():
+        try:
+            backends[name] = load(name)
+        except ImportError as e:
+            log.info("Backend %s is not available: %s", name, e)
+    return backends
+
+
+def requested_backend(environ=os.environ):
+    "Returns the name of the backend the user asked for"
+    name = environ.get("KEYSIGN_BACKEND")
+    if name:
+        return name
+    # The variable we used to have before there were more backends
+    if int(environ.get("KEYSIGN_GPGME", 0) or 0):
+        return "gpgme"
+    return DEFAULT_BACKEND
+
+
+def get_cache_file():
+    "Returns the file in which the choice of the auto mode is stored"
+    cachedir = os.environ.get("XDG_CACHE_HOME") or \
+        os.path.expanduser("~/.cache")
+    return os.path.join(cachedir, "gnome-keysign", "backend.json")
+
+
+def cache_key(backends):
+    """Returns something that changes when the result of the benchmark
+    might change, i.e. when Python or the backends change
+    """
+    return {
+        "python": sys.version,
+        "backends": list(backends.keys()),
+        "modules": [getattr(module, "__file__", None)
+                    for module in backends.values()],
+    }
+
+
+def read_cached_choice(key, fname=None):
+    "Returns the backend chosen earlier for key or None"
+    fname = fname or get_cache_file()
+    try:
+        with open(fname) as f:
+            cached = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        log.debug("No cached backend choice in %s: %s", fname, e)
+        return None
+    if not isinstance(cached, dict) or cached.get("key") != key:
+        return None
+    return cached.get("backend")
+
+
+def write_cached_choice(key, name, timings, fname=None):
+    "Remembers name as the choice for key"
+    fname = fname or get_cache_file()
+    try:
+        dirname = os.path.dirname(fname)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmpname = fname + ".tmp"
+        with open(tmpname, "w") as f:
+            json.dump({"key": key, "backend": name, "timings": timings}, f)
+        os.rename(tmpname, fname)
+    except (IOError, OSError) as e:
+        log.info("Could not store the backend choice in %s: %s", fname, e)
+
+
+def benchmark(module, rounds=BENCHMARK_ROUNDS):
+    """Returns the best time in seconds the backend takes to list the keys
+
+    Listing the keys is what every backend function does in one way
+    or another, so it tells us how costly talking to gpg is.  We list
+    an empty temporary keyring, so that the benchmark stays cheap and
+    leaves the snapshots of the user's keyring alone.
+    """
+    homedir = tempfile.mkdtemp(prefix="keysign-benchmark-")
+    try:
+        best = None
+        for _ in range(rounds):
+            # Otherwise we would measure the cache rather than the backend
+            keyring_cache.invalidate(homedir)
+            start = time.time()
+            module.get_usable_keys(homedir=homedir)
+            module.get_usable_secret_keys(homedir=homedir)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+    finally:
+        keyring_cache.invalidate(homedir)
+        kill_agents(homedir)
+        shutil.rmtree(homedir, ignore_errors=True)
+
+
+def kill_agents(homedir):
+    "Stops the gpg-agent and friends which gpg may have started for homedir"
+    try:
+        with open(os.devnull, "w") as devnull:
+            call(["gpgconf", "--homedir", homedir, "--kill", "all"],
+                 stdout=devnull, stderr=devnull)
+    except OSError:
+        log.debug("Could not run gpgconf to kill agents for %r", homedir)
+
+
+def choose_fastest(backends, cache_file=None):
+    """Returns the name of the fastest of the given backends
+
+    backends maps names to the loaded modules.
+    """
+    names = list(backends.keys())
+    if not names:
+        raise ImportError("None of the backends %s can be imported"
+                          % ", ".join(backend_names()))
+    if len(names) == 1:
+        return names[0]
+
+    name = cached_choice(backends, cache_file)
+    if name is not None:
+        return name
+
+    timings = {}
+    for name, module in backends.items():
+        try:
+            timings[name] = benchmark(module)
+        except Exception as e:
+            log.warning("Benchmarking backend %s failed: %s", name, e)
+    if not timings:
+        return names[0]
+    name = min(timings, key=timings.get)
+    log.info("Chose backend %s (timings: %s)", name, timings)
+    write_cached_choice(cache_key(backends), name, timings, cache_file)
+    return name
+
+
+def cached_choice(backends, cache_file=None):
+    "Returns the name of the backend chosen earlier or None"
+    name = read_cached_choice(cache_key(backends), cache_file)
+    if name not in backends:
+        return None
+    log.debug("Using the previously chosen backend %s", name)
+    return name
+
+
+def choose_auto(backends, cache_file=None):
+    """Returns the name of the backend to use in the auto mode
+
+    Unlike choose_fastest, this does not benchmark the backends in
+    the calling thread.  If they have not been benchmarked yet, that
+    is started in the background and the default backend is used.
+    """
+    global _benchmark
+    names = list(backends.keys())
+    if len(names) < 2:
+        return choose_fastest(backends, cache_file)
+    name = cached_choice(backends, cache_file)
+    if name is not None:
+        return name
+
+    if _benchmark is None or not _benchmark.is_alive():
+        log.info("Benchmarking the backends in the background")
+        _benchmark = Thread(target=choose_fastest,
+                            args=(backends, cache_file),
+                            name="Backend benchmark")
+        _benchmark.daemon = True
+        _benchmark.start()
+    return DEFAULT_BACKEND if DEFAULT_BACKEND in backends else names[0]
+
+
+def get_backend():
+    "Returns the module of the backend in use, importing it if necessary"
+    global _backend
+    if _backend is None:
+        with _lock:
+            if _backend is None:
+                name = requested_backend()
+                if name == AUTO:
+                    name = choose_auto(available_backends())
+                log.info("Using the %s backend", name)
+                _backend = load(name)
+    return _backend
+
+
+def set_backend(name):
+    "Uses the backend called name from now on"
+    global _backend
+    with _lock:
+        _backend = load(name)
+
+
+
+def openpgpkey_from_data(keydata):
+    "Creates an OpenPGP object from given data"
+    return get_backend().openpgpkey_from_data(keydata)
+
+
+def fingerprint_from_keydata(keydata):
+    "Returns the OpenPGP Fingerprint for a given key"
+    return get_backend().fingerprint_from_keydata(keydata)
+
+
+def get_public_key_data(fpr, homedir=None):
+    "Returns keydata for a given fingerprint"
+    return get_backend().get_public_key_data(fpr, homedir=homedir)
+
+
+def get_usable_keys(pattern="", homedir=None):
+    "Returns the keys which are not revoked, expired, disabled, or invalid"
+    return get_backend().get_usable_keys(pattern=pattern, homedir=homedir)
+
+
+def get_usable_secret_keys(pattern="", homedir=None):
+    "Returns all secret keys which can be used to sign a key"
+    return get_backend().get_usable_secret_keys(pattern=pattern,
+                                                homedir=homedir)
+
+
+def sign_keydata_and_encrypt(keydata, error_cb=None, homedir=None):
+    """Signs OpenPGP keydata with your regular GnuPG secret keys
+    and encrypts the result under the given key
+    """
+    return get_backend().sign_keydata_and_encrypt(
+        keydata, error_cb=error_cb, homedir=homedir)
+
+
+def signature_index(keyids):
+    """Returns the signatures on the keys indexed by fingerprint
+
+    Not every backend can provide that, in which case None is returned.
+    """
+    cls = getattr(get_backend(), "SignatureIndex", None)
+    if cls is None:
+        return None
+    return cls(keyids)
@@ -17,16 +17,24 @@
 #    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import unicode_literals
 
+import atexit
 import logging
+import mmap
 import os  # The SigningKeyring uses os.symlink for the agent
+import shutil
+from subprocess import call
 import sys
-from tempfile import mkdtemp
+from tempfile import gettempdir, mkdtemp, TemporaryFile
+from threading import Lock
+import time
 
 import gpg
 from gpg.constants import PROTOCOL_OpenPGP
 
 
 from .gpgkey import Key, UID
+from .keycache import key_cache, keyring_cache
+from . import openpgp
 
 texttype = unicode if sys.version_info.major < 3 else str
 
@@ -76,127 +84,246 @@ class GenEdit:
         log.info("edit_cb data: %r", data)
         return texttype(data)
 
-def del_uids(uids):
-    status, arg = yield None
-    log.info("status args: %r %r", status, arg)
-    #log.info("sinkdata: %s", sinkdata)
-    #uids = [l for l in sinkdata.splitlines() if l.startswith('uid:')]
-    #log.info("UIDs: %s", uids)
-    status, arg = yield "list"
-    log.info("status args: %r %r", status, arg)
-    for uid in uids:
-        status, arg = yield "uid %d" % uid
-        log.info("status args: %r %r", status, arg)
-    if uids:
-        status, arg = yield "deluid"
-        log.info("status args: %r %r", status, arg)
-        assert status == gpg.constants.STATUS_GET_BOOL, "%r %r" % (status, arg)
-        assert arg == 'keyedit.remove.uid.okay'
-        status, arg = yield "Y"
-        log.info("status args: %r %r", status, arg)
-    yield 'save'
-
-
 def sign_key(uid=0, sign_cmd=u"sign", expire=False, check=3,
              error_cb=None):
+    """The edit FSM for signing a key
+
+    uid can be the index of the UID to sign, 0 meaning all UIDs,
+    or a list of indices."""
     status, prompt = yield None
     assert status == gpg.constants.STATUS_GET_LINE
     assert prompt == u"keyedit.prompt"
 
-    status, prompt = yield u"uid %d" % uid
-    # We ignore GOT_IT...
-    # assert status == gpg.constants.STATUS_GOT_IT
+    uids = uid if isinstance(uid, (list, tuple)) else [uid]
+    for uid in uids:
+        status, prompt = yield u"uid %d" % uid
+        # We ignore GOT_IT...
+        # assert status == gpg.constants.STATUS_GOT_IT
 
-    #status, prompt = yield None
-    assert status == gpg.constants.STATUS_GET_LINE
+        #status, prompt = yield None
+        assert status == gpg.constants.STATUS_GET_LINE
 
     status, prompt = yield sign_cmd
     # We ignore GOT_IT...
     # assert status == gpg.constants.STATUS_GOT_IT
 
     while prompt != 'keyedit.prompt':
-        if prompt == 'keyedit.sign_all.okay':
-            status, prompt = yield 'Y'
-        elif prompt == 'sign_uid.expire':
-            status, prompt = yield '%s' % ('Y' if expire else 'N')
-        elif prompt == 'sign_uid.class':
-            status, prompt = yield '%d' % check
-        elif prompt == 'sign_uid.okay':
-            status, prompt = yield 'Y'
-        elif status == gpg.constants.STATUS_INV_SGNR:
-            # When does this actually happen?
-            status, prompt = yield None
-        elif status == gpg.constants.STATUS_PINENTRY_LAUNCHED:
-            status, prompt = yield None
-        elif status == gpg.constants.STATUS_GOT_IT:
-            status, prompt = yield None
-        elif status == gpg.constants.STATUS_ALREADY_SIGNED:
-            status, prompt = yield u'Y'
-        elif status == gpg.constants.STATUS_ERROR:
+        status, prompt = yield sign_key_answer(status, prompt, expire,
+                                               check, error_cb)
+
+    yield u"save"
+
+
+def sign_key_answer(status, prompt, expire=False, check=3, error_cb=None):
+    """Returns the answer to what gpg asks while signing a key
+
+    Used by the sign_key FSM once the sign command has been given."""
+    answers = {
+        'keyedit.sign_all.okay': 'Y',
+        'sign_uid.expire': 'Y' if expire else 'N',
+        'sign_uid.class': '%d' % check,
+        'sign_uid.okay': 'Y',
+    }
+    if prompt in answers:
+        return answers[prompt]
+    elif status in (gpg.constants.STATUS_INV_SGNR,
+                    gpg.constants.STATUS_PINENTRY_LAUNCHED,
+                    gpg.constants.STATUS_GOT_IT):
+        # When does INV_SGNR actually happen?
+        return None
+    elif status == gpg.constants.STATUS_ALREADY_SIGNED:
+        return u'Y'
+    elif status == gpg.constants.STATUS_ERROR:
+        if not error_cb:
+            raise RuntimeError("Error signing key: %s" % prompt)
+        error_cb(prompt)
+        return None
+    raise AssertionError("Unexpected state %r %r" % (status, prompt))
+
+
+
+
+# op_keysign appeared in gpg 2.1.12
+KEYSIGN_MIN_VERSION = (2, 1, 12)
+_engine_supports_keysign = None
+
+def parse_version(version):
+    """Turns a version string like "2.1.12-beta3" into a tuple of ints"""
+    parts = []
+    for part in version.split("."):
+        digits = ""
+        for c in part:
+            if not c.isdigit():
+                break
+            digits += c
+        if not digits:
+            break
+        parts.append(int(digits))
+    return tuple(parts)
+
+def engine_supports_keysign():
+    """Whether gpgme and the OpenPGP engine can do op_keysign
+
+    The engine is only probed once per process.
+    """
+    global _engine_supports_keysign
+    if _engine_supports_keysign is None:
+        supported = False
+        if hasattr(gpg.Context, "key_sign"):
+            for engine in gpg.core.get_engine_info():
+                if engine.protocol == PROTOCOL_OpenPGP:
+                    version = parse_version(engine.version or "")
+                    supported = version >= KEYSIGN_MIN_VERSION
+                    log.info("OpenPGP engine version %r supports keysign: %r",
+                             engine.version, supported)
+                    break
+        _engine_supports_keysign = supported
+    return _engine_supports_keysign
+
+
+def export_keys_view(ctx, keys, mode=0):
+    """Exports the keys in binary form and returns a memoryview on the data
+
+    gpgme writes the keys straight into a temporary file which we then
+    map into memory.  That saves us from reading potentially huge keys
+    into a gpg.Data and then copying them into a Python bytes object.
+    Slices of the memoryview can be passed to gpgme's functions
+    without being copied, too.
+    """
+    with TemporaryFile(prefix="gpgme-export-") as f:
+        armor = ctx.armor
+        ctx.armor = False
+        try:
+            ctx.op_export_keys(keys, mode, f)
+        finally:
+            ctx.armor = armor
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(b"")
+        # The mapping stays valid after the file has been closed
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def edit_uid_indices(ctx, key, uids):
+    """Returns the edit-key indices for the given UID strings
+
+    gpg --edit-key numbers the UIDs in the order of the keyblock
+    which is not necessarily the order of key.uids.
+    """
+    wanted = {_text(uid) for uid in uids}
+    keyblock = openpgp.parse_keyblock(export_keys_view(ctx, [key]))
+    indices = [i for i, uid_packets in enumerate(keyblock.uids, start=1)
+               if _text(uid_packets[0].body.tobytes()) in wanted]
+    return indices
+
+
+def certify_key(ctx, key, uids=None, expire=False, error_cb=None):
+    """Signs the key with the signers of the context
+
+    uids is a list of the UID strings to sign.  If it is None,
+    all UIDs are signed.  If expire is True, the signatures will
+    expire together with the key.
+
+    op_keysign is used if the engine supports it.  Otherwise,
+    we drive gpg's edit-key prompts with the sign_key FSM.
+    """
+    if engine_supports_keysign():
+        if expire and key.subkeys[0].expires:
+            expires_in = max(1, key.subkeys[0].expires - int(time.time()))
+        else:
+            expires_in = False
+        try:
+            ctx.key_sign(key, uids=uids, expires_in=expires_in)
+        except gpg.errors.GPGMEError as e:
             if error_cb:
-                error_cb(prompt)
+                error_cb(e)
             else:
-                raise RuntimeError("Error signing key: %s" % prompt)
-            status, prompt = yield None
-        else:
-            raise AssertionError("Unexpected state %r %r" % (status, prompt))
+                raise RuntimeError("Error signing key: %s" % e)
+    else:
+        uid = 0 if uids is None else edit_uid_indices(ctx, key, uids)
+        if uid == []:
+            # gpg would sign all UIDs if we did not select any
+            e = ValueError("None of the UIDs %r are on key %s"
+                           % (uids, key.fpr))
+            if error_cb:
+                error_cb(e)
+                return
+            raise e
+        sink = gpg.Data()
+        edit = GenEdit(sign_key(uid=uid, expire=expire, error_cb=error_cb))
+        ctx.interact(key, edit.edit_cb, sink=sink)
+        if log.isEnabledFor(logging.DEBUG):
+            sink.seek(0, 0)
+            log.debug("Sink after signing: %s", sink.read())
 
-    yield u"save"
 
+def _text(s):
+    "gpgme gives us bytes on Python 2 and str on Python 3"
+    return s.decode('utf-8', 'replace') if isinstance(s, bytes) else s
 
 
+def split_key_uids(ctx, key):
+    """Yields a (uid, uid_data) pair for every UID of a key in the context
 
-def UIDExport(keydata, uid_i):
-    """Export only the UID of a key.
-    Unfortunately, GnuPG does not provide smth like
-    --export-uid-only in order to obtain a UID and its
-    signatures."""
-    log.debug("Deletion of UID %r from %r", uid_i, keydata)
-    if not uid_i >= 1:
-        log.debug("Raising because uid: %r", uid_i)
-        raise ValueError("Expected UID to be >= 1, but is %r", uid_i)
+    The key is exported once and split into one transferable key
+    per UID, each containing the primary key, only that UID with
+    its signatures, and the subkeys.
+    The UIDs are given in the order of key.uids.
+    """
+    keydata = export_keys_view(ctx, [key])
+    uid_datas = {_text(uid): uid_data
+                 for uid, uid_data in openpgp.split_uids(keydata)}
+    for uid in key.uids:
+        try:
+            uid_data = uid_datas[_text(uid.uid)]
+        except KeyError:
+            raise ValueError("Could not find UID %r in the exported key"
+                             % uid.uid)
+        log.debug("UID %r: %r", uid.uid, uid_data)
+        yield (uid, uid_data)
+
+
+def split_uids(keydata):
+    """Yields a (uid, uid_data) pair for every UID of the key
+
+    The keydata is imported exactly once, regardless of the number
+    of UIDs. The uid is gpgme's UID object, so you can check whether
+    it is revoked or invalid.
+    """
     ctx = TempContext()
     ctx.op_import(keydata)
     result = ctx.op_import_result()
+    log.debug("split_uids: Imported %r", result)
     if result.considered != 1 or result.imported != 1:
         raise ValueError("Expected exactly one key in keydata. %r" % result)
     else:
         assert len(result.imports) == 1
         fpr = result.imports[0].fpr
         key = ctx.get_key(fpr)
-        uids_to_remove = {i for i in range(1, len(key.uids)+1)}
-        uids_to_remove.remove(uid_i)
-        if uids_to_remove:
-            sink = gpg.Data()
-            ctx.interact(key,
-                GenEdit(del_uids(uids_to_remove)).edit_cb,
-                fnc_value=sink, sink=sink)
-            sink.seek(0, 0)
-            log.debug("Data after UIDExport: %s", sink.read())
-        uid_data = gpg.Data()
-        ctx.op_export_keys([key], 0, uid_data)
-        uid_data.seek(0, 0)
-        uid_bytes = uid_data.read()
-        log.debug("UID %r: %r", uid_i, uid_bytes)
-        return uid_bytes
+        for uid, uid_data in split_key_uids(ctx, key):
+            yield (uid, uid_data)
+
+
+def UIDExport(keydata, uid_i):
+    """Export only the UID of a key.
+    Unfortunately, GnuPG does not provide smth like
+    --export-uid-only in order to obtain a UID and its
+    signatures."""
+    log.debug("Export of UID %r from %r", uid_i, keydata)
+    if not uid_i >= 1:
+        log.debug("Raising because uid: %r", uid_i)
+        raise ValueError("Expected UID to be >= 1, but is %r", uid_i)
+    for i, (uid, uid_data) in enumerate(split_uids(keydata), start=1):
+        if i == uid_i:
+            return uid_data
+    raise ValueError("Key does not have a UID %r" % uid_i)
 
 def export_uids(keydata):
     """Export each valid and non-revoked UID of a key"""
-    ctx = TempContext()
-    ctx.op_import(keydata)
-    result = ctx.op_import_result()
-    log.debug("ExportUIDs: Imported %r", result)
-    if result.considered != 1 or result.imported != 1:
-        raise ValueError("Expected exactly one key in keydata. %r" % result)
-    else:
-        assert len(result.imports) == 1
-        fpr = result.imports[0].fpr
-        key = ctx.get_key(fpr)
-        for i, uid in enumerate(key.uids, start=1):
-            log.info("Potentially deleting UID %d: %r", i, uid)
-            if not uid.invalid and not uid.revoked:
-                uid_data = UIDExport(keydata, i)
-                yield (uid.uid, uid_data)
+    for uid, uid_data in split_uids(keydata):
+        if not uid.invalid and not uid.revoked:
+            yield (uid.uid, uid_data)
+        else:
+            log.info("Not exporting invalid or revoked UID %r", uid.uid)
 
 
 
@@ -222,17 +349,160 @@ class DirectoryContext(gpg.Context):
         self.set_engine_info(PROTOCOL_OpenPGP, None, homedir)
         self.homedir = homedir
 
+def get_tmpfs_dir():
+    """Returns a directory which is hopefully backed by memory
+
+    The XDG runtime directory is a tmpfs on most systems.
+    We fall back to /dev/shm and then to the regular temporary directory.
+    """
+    candidates = [os.environ.get("XDG_RUNTIME_DIR"), "/dev/shm"]
+    for candidate in candidates:
+        if candidate and os.path.isdir(candidate) \
+           and os.access(candidate, os.W_OK | os.X_OK):
+            return candidate
+    return gettempdir()
+
+
+# We never want the trust of a temporary keyring's keys to be
+# computed, because there is nothing to be learned from it.
+TEMP_GPG_CONF = "trust-model always\n"
+
+
+class HomedirPool(object):
+    """Hands out temporary GnuPG homedirs and recycles them
+
+    A homedir is created lazily on acquire() and emptied on release(),
+    so that the next acquire() can use it again without creating a new
+    directory.  acquire() never waits, so any number of homedirs may be
+    in use at once.  max_kept only limits how many of them are kept
+    for reuse.  The others are removed on release().
+
+    Every homedir comes with a gpg.conf which makes gpg trust all keys,
+    so that gpg never builds or checks a trustdb in it.
+
+    All homedirs are removed by reap() which is run on exit.
+    Releasing a homedir after that does nothing.
+    """
+    def __init__(self, max_kept=16, basedir=None):
+        self.max_kept = max_kept
+        self.basedir = basedir
+        self.homedirs = set()
+        self.free = []
+        self.lock = Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.free:
+                homedir = self.free.pop()
+                log.debug("Acquired homedir %r", homedir)
+                return homedir
+            if len(self.homedirs) >= self.max_kept:
+                log.info("All %d temporary homedirs are in use. "
+                         "Creating another one", len(self.homedirs))
+            basedir = self.basedir or get_tmpfs_dir()
+            homedir = mkdtemp(prefix="gpgme-", dir=basedir)
+            self.homedirs.add(homedir)
+        self.configure(homedir)
+        log.debug("Acquired new homedir %r", homedir)
+        return homedir
+
+    def release(self, homedir):
+        with self.lock:
+            if homedir not in self.homedirs:
+                # It has been reaped or discarded already
+                return
+            keep = len(self.homedirs) <= self.max_kept
+        if not keep:
+            self.discard(homedir)
+            return
+        try:
+            self.reset(homedir)
+        except OSError:
+            log.exception("Could not reset %r. Discarding it", homedir)
+            self.discard(homedir)
+        else:
+            with self.lock:
+                self.free.append(homedir)
+        log.debug("Released homedir %r", homedir)
+
+    def configure(self, homedir):
+        "Writes the gpg.conf for the homedir"
+        with open(os.path.join(homedir, "gpg.conf"), "w") as f:
+            f.write(TEMP_GPG_CONF)
+
+    def reset(self, homedir):
+        "Removes everything from the homedir and configures it anew"
+        self.stop_agents(homedir)
+        for name in os.listdir(homedir):
+            path = os.path.join(homedir, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+        self.configure(homedir)
+
+    def discard(self, homedir):
+        "Removes the homedir entirely and forgets about it"
+        with self.lock:
+            self.homedirs.discard(homedir)
+            if homedir in self.free:
+                self.free.remove(homedir)
+        self.stop_agents(homedir)
+        shutil.rmtree(homedir, ignore_errors=True)
+
+    def stop_agents(self, homedir):
+        "Kills the agents, dirmngr, or keyboxd started for the homedir"
+        # A TempContextWithAgent links the user's agent into the
+        # homedir.  We must not kill that one, so we remove the link
+        # first.  gpgconf does not start an agent for killing it.
+        agent_socket = os.path.join(homedir, "S.gpg-agent")
+        if os.path.islink(agent_socket):
+            os.unlink(agent_socket)
+        try:
+            call(["gpgconf", "--homedir", homedir, "--kill", "all"])
+        except OSError:
+            log.debug("Could not run gpgconf to kill agents for %r", homedir)
+
+    def reap(self):
+        "Removes all homedirs, even those which are still in use"
+        with self.lock:
+            homedirs = list(self.homedirs)
+        for homedir in homedirs:
+            self.discard(homedir)
+
+
+homedir_pool = HomedirPool()
+atexit.register(homedir_pool.reap)
+
+
 class TempContext(DirectoryContext):
-    def __init__(self):
-        self.homedir = mkdtemp()
+    """A context with a throwaway homedir from the homedir_pool
+
+    You can use it as a context manager or call release() to give
+    the homedir back to the pool.  Otherwise, it will be released
+    when the object gets garbage collected.
+    """
+    def __init__(self, pool=None):
+        self.pool = pool or homedir_pool
+        self.homedir = self.pool.acquire()
         super(TempContext, self).__init__(homedir=self.homedir)
 
+    def release(self):
+        "Returns the homedir to the pool. Don't use the context afterwards."
+        homedir = self.__dict__.pop("homedir", None)
+        if homedir:
+            self.pool.release(homedir)
+
+    def __exit__(self, *args):
+        self.release()
+        return super(TempContext, self).__exit__(*args)
+
     def __del__(self):
         try:
-            # shutil.rmtree(self.homedir, ignore_errors=True)
-            pass
+            self.release()
         except:
-            log.exception("During cleanup of %r", self.homedir)
+            log.exception("During cleanup of %r", self.__dict__.get("homedir"))
+        super(TempContext, self).__del__()
 
 class TempContextWithAgent(TempContext):
     def __init__(self, oldctx):
@@ -254,15 +524,13 @@ class TempContextWithAgent(TempContext):
         assert len(list(self.keylist())) == 0
 
         secret_keys = list(oldctx.keylist(secret=True))
-        for key in secret_keys:
-            def export_key(fpr):
-                # FIXME: The Context should really be able to export()
-                public_key = gpg.Data()
-                oldctx.op_export(fpr, 0, public_key)
-                public_key.seek(0, os.SEEK_SET)
-                return public_key
-            keydata = export_key(key.subkeys[0].fpr)
-            self.op_import(keydata)
+        if secret_keys:
+            # We pass the exported public parts on as gpg.Data
+            # rather than copying them out into bytes
+            public_keys = gpg.Data()
+            oldctx.op_export_keys(secret_keys, 0, public_keys)
+            public_keys.seek(0, os.SEEK_SET)
+            self.op_import(public_keys)
             # FIXME: I guess we should assert on the result
 
         assert len(list(self.keylist())) == len(secret_keys)
@@ -278,8 +546,15 @@ class TempContextWithAgent(TempContext):
 
 
 def openpgpkey_from_data(keydata):
+    "Creates an OpenPGP object from given data"
+    return key_cache.get(keydata, "key", _openpgpkey_from_data)
+
+def _openpgpkey_from_data(keydata):
+    # We cannot verify the self signatures natively, so only gpg
+    # can tell us which UIDs and which expiry are genuine.
     c = TempContext()
-    c.op_import(gpg.Data(keydata))
+    # gpgme can read the keydata without copying it into a gpg.Data
+    c.op_import(keydata)
     result = c.op_import_result()
     log.debug("Import Result: %s", result)
     if result.imported != 1:
@@ -295,6 +570,11 @@ def openpgpkey_from_data(keydata):
 
 
 def get_public_key_data(fpr, homedir=None):
+    def export(pattern):
+        return _get_public_key_data(pattern, homedir=homedir)
+    return keyring_cache.get_keydata(homedir, fpr, export)
+
+def _get_public_key_data(fpr, homedir=None):
     c = DirectoryContext(homedir)
     c.armor = True
     sink = gpg.Data()
@@ -312,6 +592,12 @@ def get_public_key_data(fpr, homedir=None):
 
 def fingerprint_from_keydata(keydata):
     '''Returns the OpenPGP Fingerprint for a given key'''
+    try:
+        # The fingerprint is computed from the key material,
+        # so we do not need gpg to trust it.
+        return openpgp.key_fingerprint(keydata)
+    except openpgp.ParseError as e:
+        log.debug("Could not compute the fingerprint natively (%s)", e)
     openpgpkey = openpgpkey_from_data(keydata)
     return openpgpkey.fpr
 
@@ -325,21 +611,29 @@ def get_usable_keys(pattern="", homedir=None):
     '''Uses get_keys on the keyring and filters for
     non revoked, expired, disabled, or invalid keys'''
     log.debug('Retrieving keys for %s, %s', pattern, homedir)
-    ctx = DirectoryContext(homedir=homedir)
-    return get_usable_keys_from_context(ctx,
-    	pattern=pattern, secret=False)
+
+    def list_keys(pattern):
+        ctx = DirectoryContext(homedir=homedir)
+        return get_usable_keys_from_context(ctx, pattern=pattern,
+                                            secret=False)
+    return keyring_cache.get_keys(homedir, False, pattern, list_keys)
 
 def get_usable_secret_keys(pattern="", homedir=None):
     '''Returns all secret keys which can be used to sign a key'''
-    ctx = DirectoryContext(homedir=homedir)
-    return get_usable_keys_from_context(ctx,
-    	pattern=pattern, secret=True)
+    def list_keys(pattern):
+        ctx = DirectoryContext(homedir=homedir)
+        return get_usable_keys_from_context(ctx, pattern=pattern,
+                                            secret=True)
+    return keyring_cache.get_keys(homedir, True, pattern, list_keys)
 
 
 
 
 def minimise_key(keydata):
     "Returns the public key exported under the MINIMAL mode"
+    return key_cache.get(keydata, "gpgmeh.minimise_key", _minimise_key)
+
+def _minimise_key(keydata):
     ctx = TempContext()
     ctx.op_import(keydata)
     result = ctx.op_import_result()
@@ -358,14 +652,23 @@ def minimise_key(keydata):
         minimised_key = sink.read()
         return minimised_key
 
-def sign_keydata_and_encrypt(keydata, error_cb=None, homedir=None):
+def signing_context(homedir=None):
+    """Returns a TempContextWithAgent which signs with all
+    usable secret keys of the keyring in homedir"""
     oldctx = DirectoryContext(homedir)
     ctx = TempContextWithAgent(oldctx)
     # We're trying to sign with all available secret keys
     available_secret_keys = [key for key in ctx.keylist(secret=True)
         if not key.disabled or key.revoked or key.invalid or key.expired]
     ctx.signers = available_secret_keys
+    return ctx
+
+
+def sign_and_encrypt_with_context(ctx, keydata, error_cb=None):
+    """Signs keydata with the signers of ctx and encrypts each UID
 
+    yields (fingerprint, uid, ciphertext) triples
+    """
     ctx.op_import(minimise_key(keydata))
     result = ctx.op_import_result()
     if result.considered != 1 and result.imported != 1:
@@ -375,28 +678,18 @@ def sign_keydata_and_encrypt(keydata, error_cb=None, homedir=None):
         assert len(imports) == 1
         fpr = result.imports[0].fpr
         key = ctx.get_key(fpr)
-        sink = gpg.Data()
-        # There is op_keysign, but it's only available with gpg 2.1.12
-        ctx.interact(key, GenEdit(sign_key(error_cb=error_cb)).edit_cb, sink=sink)
-        sink.seek(0, 0)
-        log.debug("Sink after signing: %s", sink.read())
+        certify_key(ctx, key, error_cb=error_cb)
 
-        signed_sink = gpg.Data()
+        # Do I have to re-get the key to make the signatures known?
         ctx.set_keylist_mode(gpg.constants.KEYLIST_MODE_SIGS)
         ctx.armor = True
-        ctx.op_export_keys([key], 0, signed_sink)
-        signed_sink.seek(0, 0)
-        signed_keydata = signed_sink.read()
-        log.debug("Signed Key: %s", signed_keydata)
-        # Do I have to re-get the key to make the signatures known?
         key = ctx.get_key(fpr)
 
-        for i, uid in enumerate(key.uids, start=1):
+        for uid, uid_data in split_key_uids(ctx, key):
             if uid.revoked or uid.invalid:
                 continue
             else:
-                uid_data = UIDExport(signed_keydata, i)
-                log.debug("Data for uid %d: %r, sigs: %r %r", i, uid, uid.signatures, uid_data)
+                log.debug("Data for uid %r, sigs: %r %r", uid, uid.signatures, uid_data)
 
                 ciphertext, _, _ = ctx.encrypt(plaintext=uid_data,
                                                recipients=[key],
@@ -404,4 +697,35 @@ def sign_keydata_and_encrypt(keydata, error_cb=None, homedir=None):
                                                # in order for it to work out of the box
                                                always_trust=True,
                                                sign=False)
-                yield (UID.from_gpgme(uid), ciphertext)
+                yield (fpr, UID.from_gpgme(uid), ciphertext)
+
+
+def sign_keydata_and_encrypt(keydata, error_cb=None, homedir=None):
+    with signing_context(homedir) as ctx:
+        results = sign_and_encrypt_with_context(ctx, keydata,
+                                                error_cb=error_cb)
+        for _, uid, ciphertext in results:
+            yield (uid, ciphertext)
+
+
+def sign_keydatas_and_encrypt(keydatas, error_cb=None, homedir=None):
+    """Signs and encrypts many keys, setting up the signing context once
+
+    keydatas is an iterable of OpenPGP keydata.
+    yields (fingerprint, uid, ciphertext) triples.
+
+    A key failing to be signed does not stop the others from
+    being processed.  The exception is logged and given to error_cb,
+    if provided.
+    """
+    with signing_context(homedir) as ctx:
+        for keydata in keydatas:
+            try:
+                results = sign_and_encrypt_with_context(ctx, keydata,
+                                                        error_cb=error_cb)
+                for result in results:
+                    yield result
+            except Exception as e:
+                log.exception("Error signing and encrypting %r", keydata)
+                if error_cb:
+                    error_cb(e)
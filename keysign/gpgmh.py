@@ -19,13 +19,17 @@
 from datetime import datetime
 import logging
 import os  # The SigningKeyring uses os.symlink for the agent
-from tempfile import NamedTemporaryFile
+import shutil
+from subprocess import PIPE, Popen
+from tempfile import mkdtemp
 
 # The UID object is used in one place, at least,
 # to get display the name and email address.
 # The Key object is returned from a few functions, so it's
 # API is somewhat external.
 from .gpgkey import Key, UID
+from .keycache import key_cache, keyring_cache
+from . import openpgp
 log = logging.getLogger(__name__)
 
 
@@ -35,8 +39,22 @@ log = logging.getLogger(__name__)
 import sys
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(os.path.join(parent_dir, "monkeysign"))
-from monkeysign.gpg import Keyring, TempKeyring
-from monkeysign.gpg import GpgRuntimeError
+from monkeysign.gpg import Keyring
+from monkeysign.gpg import TempKeyring as MonkeysignTempKeyring
+from monkeysign.gpg import GpgProtocolError, GpgRuntimeError
+
+
+class TempKeyring(MonkeysignTempKeyring):
+    """A temporary keyring which never builds or checks a trustdb
+
+    gpg would otherwise issue stray "gpg: checking the trustdb"
+    messages which confuse the gnupg library, and spend time on
+    computing the trust of keys we throw away, anyway.
+    """
+    def __init__(self, *args, **kwargs):
+        # Not necessarily a new style class
+        MonkeysignTempKeyring.__init__(self, *args, **kwargs)
+        self.context.set_option('trust-model', 'always')
 
 
 
@@ -44,11 +62,14 @@ def UIDExport(uid, keydata):
     """Export only the UID of a key.
     Unfortunately, GnuPG does not provide smth like
     --export-uid-only in order to obtain a UID and its
-    signatures."""
+    signatures.  So we filter the packets ourselves and
+    only ask gpg to delete the other UIDs if we cannot."""
+    try:
+        return openpgp.filter_uid(keydata, uid)
+    except openpgp.ParseError as e:
+        log.debug("Could not filter UID %r natively (%s). Asking gpg", uid, e)
+
     tmp = TempKeyring()
-    # Hm, apparently this needs to be set, otherwise gnupg will issue
-    # a stray "gpg: checking the trustdb" which confuses the gnupg library
-    tmp.context.set_option('always-trust')
     tmp.import_data(keydata)
     for fpr, key in tmp.get_keys(uid).items():
         for u in key.uidslist:
@@ -65,6 +86,14 @@ def MinimalExport(keydata):
     '''Returns the minimised version of a key
 
     For now, you must provide one key only.'''
+    return key_cache.get(keydata, "gpgmh.MinimalExport", _MinimalExport)
+
+def _MinimalExport(keydata):
+    try:
+        return openpgp.minimise(keydata)
+    except openpgp.ParseError as e:
+        log.debug("Could not minimise keydata natively (%s). Asking gpg", e)
+
     tmpkeyring = TempKeyring()
     ret = tmpkeyring.import_data(keydata)
     log.debug("Returned %s after importing %r", ret, keydata)
@@ -103,26 +132,26 @@ class TempSplitKeyring(SplitKeyring):
     the user's secret keys (like creating signatures).
     """
     def __init__(self, *args, **kwargs):
-        # A NamedTemporaryFile deletes the backing file
-        self.kr_tempfile = NamedTemporaryFile(prefix='gpgpy-')
-        self.kr_fname = self.kr_tempfile.name
-        self.tdb_tempfile = NamedTemporaryFile(prefix='gpgpy-tdb-',
-                                               delete=True)
-        self.tdb_fname = self.tdb_tempfile.name
-        # This should delete the file.
-        # Why are we doing it?  Well...
-        # Turns out that if you run gpg --trustdb-name with an
-        # empty file, it complains about an invalid trustdb.
-        # If, however, you give it a non-existent filename,
-        # it'll happily create a new trustdb.
-        # FWIW: Am empty trustdb file seems to be 40 bytes long,
-        # but the contents seems to be non-deterministic.
-        # Anyway, we'll leak the file :-/
-        self.tdb_tempfile.close()
+        # gpg creates backups and lock files next to the keyring,
+        # so we put everything into a directory we remove later.
+        self.tempdir = mkdtemp(prefix='gpgpy-')
+        self.kr_fname = os.path.join(self.tempdir, 'pubring.gpg')
+        open(self.kr_fname, 'wb').close()
+        # If you run gpg --trustdb-name with an empty file, it
+        # complains about an invalid trustdb.  If, however, you
+        # give it a non-existent filename, it'll happily create a
+        # new trustdb.  With the trust model below, it should not
+        # even need to, but if it does, the file will be removed
+        # with the directory.
+        self.tdb_fname = os.path.join(self.tempdir, 'trustdb.gpg')
 
         SplitKeyring.__init__(self, primary_keyring_fname=self.kr_fname,
                                     trustdb_fname=self.tdb_fname,
                                     *args, **kwargs)
+        self.context.set_option('trust-model', 'always')
+
+    def __del__(self):
+        shutil.rmtree(self.tempdir, ignore_errors=True)
 
 
 class TempSigningKeyring(TempSplitKeyring):
@@ -148,11 +177,15 @@ class TempSigningKeyring(TempSplitKeyring):
         if base_keyring is None:
             base_keyring = Keyring()
 
-        # Copy the public parts of the secret keys to the tmpkeyring
-        for fpr, key in base_keyring.get_keys(None,
-                                              secret=True,
-                                              public=False).items():
-            self.import_data (base_keyring.export_data (fpr))
+        # Copy the public parts of the secret keys to the tmpkeyring.
+        # We export all of them with a single gpg call.
+        secret_keys = base_keyring.get_keys(None, secret=True,
+                                            public=False) or {}
+        self.secret_keys = list(secret_keys.values())
+        if secret_keys:
+            fingerprints = list(secret_keys.keys())
+            base_keyring.context.call_command(['export'] + fingerprints)
+            self.import_data(base_keyring.context.stdout)
 
         ## We don't copy the config file, because we're not using a separate
         ## homedir. So we expect gpg to still use it's normal homedir and thus
@@ -184,14 +217,27 @@ class TempSigningKeyring(TempSplitKeyring):
 
 
 from monkeysign.gpg import Keyring
+def parse_colons(lines):
+    """Yields the records of GnuPG's --with-colons output as lists of fields
+
+    lines can be any iterable, e.g. a pipe, so that records can be
+    processed while gpg is still producing them.
+    """
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", "replace")
+        line = line.rstrip("\r\n")
+        if line:
+            yield line.split(":")
+
+
 def parse_sig_list(text):
     '''Parses GnuPG's signature list (i.e. list-sigs)
     
     The format is described in the GnuPG man page'''
     sigslist = []
-    for block in text.split("\n"):
-        if block.startswith("sig"):
-            record = block.split(":")
+    for record in parse_colons(text.split("\n")):
+        if record[0] == "sig":
             log.debug("sig record (%d) %s", len(record), record)
             keyid, timestamp, uid = record[4], record[5], record[9]
             sigslist.append((keyid, timestamp, uid))
@@ -199,25 +245,81 @@ def parse_sig_list(text):
     return sigslist
 
 
+class SignatureIndex(object):
+    """The signatures of many keys, gathered with a single gpg call
+
+    The signatures are (keyid, timestamp, uid) tuples as returned
+    by parse_sig_list.  They are indexed by the fingerprint of the
+    signed key, but can be looked up by key id, too.
+    """
+    def __init__(self, keyids=(), keyring=None):
+        self.keyring = keyring
+        self.index = {}
+        if keyids:
+            self.update(keyids)
+
+    def update(self, keyids):
+        "Adds the signatures of the given keys to the index"
+        kr = self.keyring if self.keyring is not None else Keyring()
+        cmd = kr.context.build_command(['list-sigs'] + list(keyids))
+        with open(os.devnull, "r+b") as devnull:
+            proc = Popen(cmd, stdin=devnull, stdout=PIPE, stderr=devnull)
+            try:
+                self._consume(parse_colons(proc.stdout))
+            finally:
+                proc.stdout.close()
+                ret = proc.wait()
+        if ret:
+            # gpg fails if one of the keys is unknown,
+            # but it still lists all the others.
+            log.info("gpg returned %d listing signatures of %s", ret, keyids)
+
+    def _consume(self, records):
+        sigs = None
+        keyid = None
+        for record in records:
+            rtype = record[0]
+            if rtype == "pub":
+                sigs = []
+                # We index by key id until we see the fingerprint
+                keyid = record[4]
+                self.index[keyid] = sigs
+            elif rtype == "fpr" and keyid is not None:
+                # The first fpr record after pub is that of the key,
+                # the others are the subkeys'.
+                del self.index[keyid]
+                self.index[record[9]] = sigs
+                keyid = None
+            elif rtype == "sig" and sigs is not None:
+                sigs.append((record[4], record[5], record[9]))
+
+    def signatures(self, keyid):
+        "Returns the list of signatures for a key id or fingerprint"
+        keyid = keyid.upper()
+        if keyid.startswith("0X"):
+            keyid = keyid[2:]
+        sigs = self.index.get(keyid)
+        if sigs is None:
+            for fpr, fpr_sigs in self.index.items():
+                if fpr.endswith(keyid):
+                    sigs = fpr_sigs
+                    break
+            else:
+                sigs = []
+        return list(sigs)
+
+
 def signatures_for_keyid(keyid, keyring=None):
     '''Returns the list of signatures for a given key id
     
     This will call out to GnuPG list-sigs, using Monkeysign,
-    and parse the resulting string into a list of signatures.
+    and parse the resulting output into a list of signatures.
     
     A default Keyring will be used unless you pass an instance
-    as keyring argument.
+    as keyring argument.  If you are interested in the signatures
+    of many keys, use a SignatureIndex instead.
     '''
-    if keyring is None:
-        kr = Keyring()
-    else:
-        kr = keyring
-
-    # FIXME: this would be better if it was done in monkeysign
-    kr.context.call_command(['list-sigs', keyid])
-    siglist = parse_sig_list(kr.context.stdout)
-
-    return siglist
+    return SignatureIndex([keyid], keyring=keyring).signatures(keyid)
 
 
 
@@ -247,83 +349,110 @@ def filter_usable_keys(keys):
 
 def get_usable_keys_from_keyring(keyring, pattern, public, secret):
     keys_dict = keyring.get_keys(pattern=pattern,
-    							 public=public,
-    							 secret=secret) or {}
+                                 public=public,
+                                 secret=secret) or {}
     assert keys_dict is not None, keyring.context.stderr
     # keys_fpr = keys_dict.items()
     keys = keys_dict.values()
     return filter_usable_keys(keys)
 
 
-def sign_keydata(keydata, error_cb=None, homedir=None):
+def import_for_signing(tmpkeyring, keydata):
+    """Imports the minimised keydata into tmpkeyring
+
+    We import the minimised key, so whatever we export later on
+    is minimal except for our new signatures.  We must not use
+    export-minimal for exporting, because it removes those.
+
+    Returns the fingerprint and the monkeysign key or (None, None)
+    if the key could not be imported.
+    """
+    stripped_key = MinimalExport(keydata)
+    fingerprint = fingerprint_from_keydata(stripped_key)
+
+    log.debug('Trying to import key\n%s', stripped_key)
+    if not tmpkeyring.import_data(stripped_key):
+        return None, None
+    keys = tmpkeyring.get_keys(fingerprint)
+    log.info("Found keys %s for fp %s", keys, fingerprint)
+    if len(keys) != 1:
+        raise ValueError("We received multiple keys for fp %s: %s"
+                         % (fingerprint, keys))
+    return fingerprint, keys[fingerprint]
+
+
+def sign_with_key(tmpkeyring, fingerprint, uidlist, secret_key, error_cb=None):
+    """Signs all UIDs of the key with the given secret key
+
+    Monkeysign answers gpg's prompts for a single signer only,
+    so we have to call it once per secret key.
+    """
+    secret_fpr = secret_key.fpr
+    log.info('Setting up to sign with %s', secret_fpr)
+    tmpkeyring.context.set_option('local-user', secret_fpr)
+    # FIXME: For now, we sign all UIDs. This is bad.
+    try:
+        ret = tmpkeyring.sign_key(fingerprint, signall=True)
+    except (GpgRuntimeError, GpgProtocolError) as e:
+        uid = uidlist[0].uid
+        log.exception("Error signing %r with secret key %r. stdout: %r, stderr: %r",
+            uid, secret_key, tmpkeyring.context.stdout, tmpkeyring.context.stderr)
+        if error_cb:
+            e.uid = uid
+            error_cb (e)
+        else:
+            raise
+    else:
+        log.info("Result of signing %s on key %s: %s", uidlist[0].uid, fingerprint, ret)
+
+
+def sign_keydata(keydata, error_cb=None, homedir=None, tmpkeyring=None):
     """Signs OpenPGP keydata with your regular GnuPG secret keys
     
     If error_cb is provided, that function is called with any exception
     occuring during signing of the key.  If error_cb is False, any
     exception is raised.
+    If you pass a TempSigningKeyring, it is used for signing such
+    that you can continue to use it, e.g. for encrypting to the key.
     
     yields pairs of (uid, signed_uid)
     """
     log = logging.getLogger(__name__ + ':sign_keydata_encrypt')
 
-    tmpkeyring = TempSigningKeyring(homedir=homedir,
-        base_keyring=Keyring(homedir=homedir))
-    tmpkeyring.context.set_option('export-options', 'export-minimal')
+    if tmpkeyring is None:
+        tmpkeyring = TempSigningKeyring(homedir=homedir,
+            base_keyring=Keyring(homedir=homedir))
     # Eventually, we want to let the user select their keys to sign with
     # For now, we just take whatever is there.
-    secret_keys = get_usable_keys_from_keyring(keyring=tmpkeyring,
-    	pattern="", public=False, secret=True)
+    secret_keys = filter_usable_keys(tmpkeyring.secret_keys)
     log.info('Signing with these keys: %s', secret_keys)
 
-    stripped_key = MinimalExport(keydata)
-    fingerprint = fingerprint_from_keydata(stripped_key)
-
-    log.debug('Trying to import key\n%s', stripped_key)
-    if tmpkeyring.import_data(stripped_key):
-        # 3. for every user id (or all, if -a is specified)
-        # 3.1. sign the uid, using gpg-agent
-        keys = tmpkeyring.get_keys(fingerprint)
-        log.info("Found keys %s for fp %s", keys, fingerprint)
-        if len(keys) != 1:
-            raise ValueError("We received multiple keys for fp %s: %s"
-                             % (fingerprint, keys))
-        key = keys[fingerprint]
-        uidlist = key.uidslist
-        
-        for secret_key in secret_keys:
-            secret_fpr = secret_key.fpr
-            log.info('Setting up to sign with %s', secret_fpr)
-            # We need to --always-trust, because GnuPG would print
-            # warning about the trustdb.  I think this is because
-            # we have a newly signed key whose trust GnuPG wants to
-            # incorporate into the trust decision.
-            tmpkeyring.context.set_option('always-trust')
-            tmpkeyring.context.set_option('local-user', secret_fpr)
-            # FIXME: For now, we sign all UIDs. This is bad.
-            try:
-                ret = tmpkeyring.sign_key(fingerprint, signall=True)
-            except GpgRuntimeError as e:
-                uid = uidlist[0].uid
-                log.exception("Error signing %r with secret key %r. stdout: %r, stderr: %r",
-                    uid, secret_key, tmpkeyring.context.stdout, tmpkeyring.context.stderr)
-                if error_cb:
-                    e.uid = uid
-                    error_cb (e)
-                else:
-                    raise
-                continue
-            log.info("Result of signing %s on key %s: %s", uidlist[0].uid, fingerprint, ret)
-
-
-        for uid in uidlist:
-            uid_str = uid.uid
-            log.info("Processing uid %r %s", uid, uid_str)
-
-            # 3.2. export and encrypt the signature
-            # 3.3. mail the key to the user
-            signed_key = UIDExport(uid_str, tmpkeyring.export_data(uid_str))
-            log.info("Exported %d bytes of signed key", len(signed_key))
-            yield (uid, signed_key)
+    fingerprint, key = import_for_signing(tmpkeyring, keydata)
+    if key is None:
+        return
+    # 3. for every user id (or all, if -a is specified)
+    # 3.1. sign the uid, using gpg-agent
+    uidlist = key.uidslist
+    for secret_key in secret_keys:
+        sign_with_key(tmpkeyring, fingerprint, uidlist, secret_key, error_cb)
+
+    signed_keydata = tmpkeyring.export_data(fingerprint)
+    for uid in uidlist:
+        uid_str = uid.uid
+        log.info("Processing uid %r %s", uid, uid_str)
+
+        # 3.2. export and encrypt the signature
+        # 3.3. mail the key to the user
+        # We split the key we have exported once rather
+        # than asking gpg to export every UID.
+        try:
+            signed_key = openpgp.filter_uid(signed_keydata, uid_str)
+        except openpgp.ParseError as e:
+            log.debug("Could not filter %r natively (%s)", uid_str, e)
+            signed_key = UIDExport(uid_str,
+                                   tmpkeyring.export_data(uid_str))
+        log.info("Exported %d bytes of signed key", len(signed_key))
+        yield (uid, signed_key)
 
 ##
 ## END OF INTERNAL API
@@ -335,6 +464,11 @@ def sign_keydata(keydata, error_cb=None, homedir=None):
 
 def openpgpkey_from_data(keydata):
     "Creates an OpenPGP object from given data"
+    return key_cache.get(keydata, "key", _openpgpkey_from_data)
+
+def _openpgpkey_from_data(keydata):
+    # We cannot verify the self signatures natively, so only gpg
+    # can tell us which UIDs and which expiry are genuine.
     keyring = TempKeyring()
     if not keyring.import_data(keydata):
         raise ValueError("Could not import %r  -  stdout: %r, stderr: %r",
@@ -346,7 +480,7 @@ def openpgpkey_from_data(keydata):
     if len(keys) != 1:
         log.debug('Operation on keydata "%s" failed', keydata)
         raise ValueError("Expected exactly one key, but got %d: %r" % (
-        				 len(keys), keys))
+                         len(keys), keys))
     else:
         # The first (key, value) pair in the keys dict
         # next(iter(keys.items()))[0] might be semantically
@@ -365,6 +499,11 @@ def get_public_key_data(fpr, homedir=None):
     
     In fact, fpr could be anything that gpg happily exports.
     """
+    def export(pattern):
+        return _get_public_key_data(pattern, homedir=homedir)
+    return keyring_cache.get_keydata(homedir, fpr, export)
+
+def _get_public_key_data(fpr, homedir=None):
     keyring = Keyring(homedir=homedir)
     keydata = keyring.export_data(fpr)
     if not keydata:
@@ -377,6 +516,12 @@ def get_public_key_data(fpr, homedir=None):
 
 def fingerprint_from_keydata(keydata):
     '''Returns the OpenPGP Fingerprint for a given key'''
+    try:
+        # The fingerprint is computed from the key material,
+        # so we do not need gpg to trust it.
+        return openpgp.key_fingerprint(keydata)
+    except openpgp.ParseError as e:
+        log.debug("Could not compute the fingerprint natively (%s)", e)
     openpgpkey = openpgpkey_from_data(keydata)
     return openpgpkey.fpr
 
@@ -385,16 +530,21 @@ def get_usable_keys(pattern="", homedir=None):
     '''Uses get_keys on the keyring and filters for
     non revoked, expired, disabled, or invalid keys'''
     log.debug('Retrieving keys for %s, %s', pattern, homedir)
-    keyring = Keyring(homedir=homedir)
-    return get_usable_keys_from_keyring(keyring=keyring,
-    	pattern=pattern, public=True, secret=False)
+
+    def list_keys(pattern):
+        keyring = Keyring(homedir=homedir)
+        return get_usable_keys_from_keyring(keyring=keyring, pattern=pattern,
+                                            public=True, secret=False)
+    return keyring_cache.get_keys(homedir, False, pattern, list_keys)
 
 
 def get_usable_secret_keys(pattern="", homedir=None):
     '''Returns all secret keys which can be used to sign a key'''
-    keyring = Keyring(homedir=homedir)
-    return get_usable_keys_from_keyring(keyring=keyring,
-    	pattern=pattern, public=False, secret=True)
+    def list_keys(pattern):
+        keyring = Keyring(homedir=homedir)
+        return get_usable_keys_from_keyring(keyring=keyring, pattern=pattern,
+                                            public=False, secret=True)
+    return keyring_cache.get_keys(homedir, True, pattern, list_keys)
 
 
 
@@ -405,29 +555,16 @@ def sign_keydata_and_encrypt(keydata, error_cb=None, homedir=None):
     error_cb can be a function that is called with any exception
     occuring during signing of the key.
     """
-    tmpkeyring = TempKeyring()
-    tmpkeyring.import_data(keydata)
-    tmpkeyring.context.set_option('always-trust')
+    # The key is in the signing keyring, anyway, so we
+    # encrypt with that rather than importing it elsewhere.
+    tmpkeyring = TempSigningKeyring(homedir=homedir,
+        base_keyring=Keyring(homedir=homedir))
+    # The keyring has our own keys, too, so we must not let gpg
+    # pick the recipient by a substring of the UID.
+    fingerprint = fingerprint_from_keydata(keydata)
     for (uid, signed_key) in sign_keydata(keydata,
-        error_cb=error_cb, homedir=homedir):
+        error_cb=error_cb, homedir=homedir, tmpkeyring=tmpkeyring):
             if not uid.revoked:
                 encrypted_key = tmpkeyring.encrypt_data(data=signed_key,
-                    recipient=uid.uid)
+                    recipient=fingerprint)
                 yield (UID.from_monkeysign(uid), encrypted_key)
-
-
-
-GPGME = int(os.environ.get("KEYSIGN_GPGME", 0))
-if GPGME:
-    del openpgpkey_from_data
-    del get_public_key_data
-    del fingerprint_from_keydata
-    del get_usable_keys
-    del get_usable_secret_keys
-    del sign_keydata_and_encrypt
-
-
-    from .gpgmeh import (get_usable_keys, openpgpkey_from_data,
-        get_public_key_data, fingerprint_from_keydata,
-        get_usable_secret_keys, sign_keydata_and_encrypt,
-        )
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+#    Copyright 2017 Tobias Mueller <muelli@cryptobitch.de>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+"""Caches for things we would otherwise have to ask gpg for repeatedly
+
+A received key travels through verification, display, and signing,
+each of which wants to parse or minimise the very same keydata.
+Likewise, the user's keyring gets listed and exported over and over
+again while the user clicks through their keys.
+"""
+
+from collections import OrderedDict
+from hashlib import sha256
+import logging
+import os
+import re
+from threading import Lock
+import time
+
+log = logging.getLogger(__name__)
+
+
+class KeyCache(object):
+    """A bounded LRU cache for artefacts derived from keydata
+
+    Entries are keyed by the SHA-256 of the keydata.  Each entry holds
+    the artefacts, e.g. the parsed Key or the minimised export, under
+    a name chosen by the caller.  Once more than maxsize keydata have
+    been seen, the least recently used one is evicted.
+    """
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    @staticmethod
+    def digest(keydata):
+        "Returns the cache key for keydata or None if it cannot be hashed"
+        if not isinstance(keydata, bytes):
+            try:
+                keydata = keydata.encode("utf-8")
+            except AttributeError:
+                return None
+        return sha256(keydata).hexdigest()
+
+    def get(self, keydata, artefact, create):
+        """Returns the artefact for the keydata
+
+        If it is not cached, yet, create(keydata) is called and its
+        result is stored.  Exceptions raised by create are not cached.
+        """
+        digest = self.digest(keydata)
+        if digest is None:
+            return create(keydata)
+
+        with self.lock:
+            entry = self.entries.pop(digest, None)
+            if entry is not None:
+                # Re-inserting marks the entry as most recently used
+                self.entries[digest] = entry
+                if artefact in entry:
+                    self.hits += 1
+                    return entry[artefact]
+            self.misses += 1
+
+        value = create(keydata)
+
+        with self.lock:
+            entry = self.entries.pop(digest, {})
+            entry[artefact] = value
+            self.entries[digest] = entry
+            while len(self.entries) > self.maxsize:
+                evicted, _ = self.entries.popitem(last=False)
+                log.debug("Evicted %s from the key cache", evicted)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# Shared by both gpgmh and gpgmeh
+key_cache = KeyCache()
+
+
+
+# The files whose change means that the keyring has changed.
+# With use-keyboxd, the public keys live in keyboxd's SQLite database
+# whose changes may linger in the write-ahead log for a while.
+KEYRING_FILES = ("pubring.kbx", "pubring.gpg", "secring.gpg",
+                 "trustdb.gpg", "private-keys-v1.d",
+                 os.path.join("public-keys.d", "pubring.db"),
+                 os.path.join("public-keys.d", "pubring.db-wal"))
+
+# Fingerprints or key ids, optionally prefixed with 0x
+KEYID_PATTERN = re.compile(r"^(0x)?([0-9A-Fa-f]{8}|[0-9A-Fa-f]{16}|[0-9A-Fa-f]{40})$")
+
+
+def resolve_homedir(homedir=None):
+    "Returns the directory gpg uses if given homedir"
+    if homedir:
+        return os.path.abspath(os.path.expanduser(homedir))
+    return os.environ.get("GNUPGHOME") or os.path.expanduser("~/.gnupg")
+
+
+def next_expiry(keys, now=None):
+    """Returns the time of the earliest expiry of the keys still to come
+
+    Returns None if none of the keys is going to expire.
+    """
+    now = time.time() if now is None else now
+    expiries = []
+    for key in keys:
+        expiry = getattr(key, "expiry", None)
+        if expiry is None or not hasattr(expiry, "timetuple"):
+            continue
+        # parse_expiry gives us the local time
+        timestamp = time.mktime(expiry.timetuple())
+        if timestamp > now:
+            expiries.append(timestamp)
+    return min(expiries) if expiries else None
+
+
+class KeyringCache(object):
+    """Snapshots of keyring listings and exports
+
+    A snapshot is valid as long as the keyring files in the homedir
+    have not changed, as determined by their mtime, size, and inode,
+    and none of its keys has expired since it was taken.
+    Looking up keys by fingerprint or key id is then a dictionary
+    operation rather than a gpg invocation.  Key ids which are not
+    those of a primary key, e.g. those of subkeys, are left to gpg.
+    """
+    def __init__(self):
+        self.listings = {}
+        self.exports = {}
+        self.lock = Lock()
+
+    @staticmethod
+    def stamp(homedir):
+        "Returns something which changes when the keyring changes"
+        stamps = []
+        for name in KEYRING_FILES:
+            try:
+                st = os.stat(os.path.join(homedir, name))
+            except OSError:
+                stamps.append(None)
+            else:
+                stamps.append((st.st_mtime, st.st_size, st.st_ino))
+        return tuple(stamps)
+
+    def _lookup(self, store, key, stamp):
+        with self.lock:
+            cached = store.get(key)
+        if not cached or cached[0] != stamp:
+            return None
+        valid_until = cached[2]
+        if valid_until is not None and time.time() >= valid_until:
+            log.debug("A key of snapshot %r has expired", key)
+            return None
+        return cached[1]
+
+    def _store(self, store, key, stamp, value, valid_until=None):
+        with self.lock:
+            store[key] = (stamp, value, valid_until)
+
+    def get_keys(self, homedir, secret, pattern, list_keys):
+        """Returns the list of keys matching pattern
+
+        list_keys(pattern) must return the list of keys in the keyring
+        matching the pattern.  It is called with an empty pattern to
+        take a snapshot of the whole keyring.  Patterns other than
+        fingerprints or key ids are passed to list_keys directly.
+        """
+        match = KEYID_PATTERN.match(pattern or "")
+        if pattern and not match:
+            return list_keys(pattern)
+
+        homedir = resolve_homedir(homedir)
+        stamp = self.stamp(homedir)
+        snapshot = self._lookup(self.listings, (homedir, secret), stamp)
+        if snapshot is None:
+            log.debug("Taking a snapshot of keyring %r (secret: %r)",
+                      homedir, secret)
+            keys = list_keys("")
+            snapshot = OrderedDict((key.fingerprint, key) for key in keys)
+            self._store(self.listings, (homedir, secret), stamp, snapshot,
+                        next_expiry(keys))
+
+        if not pattern:
+            return list(snapshot.values())
+        keyid = match.group(2).upper()
+        if len(keyid) == 40:
+            keys = [snapshot[keyid]] if keyid in snapshot else []
+        else:
+            keys = [key for fpr, key in snapshot.items()
+                    if fpr.endswith(keyid)]
+        if not keys:
+            # We only know the primary keys' fingerprints, but
+            # gpg finds keys by their subkeys, too.
+            return list_keys(pattern)
+        return keys
+
+    def get_keydata(self, homedir, pattern, export):
+        """Returns the exported keydata for pattern
+
+        export(pattern) must return the keydata.  Exceptions are
+        not cached.
+        """
+        homedir = resolve_homedir(homedir)
+        stamp = self.stamp(homedir)
+        with self.lock:
+            cached = self.exports.get(homedir)
+            if not cached or cached[0] != stamp:
+                cached = self.exports[homedir] = (stamp, {}, None)
+            exports = cached[1]
+            if pattern in exports:
+                return exports[pattern]
+        # Exporting takes a while, so we do not hold the lock
+        keydata = export(pattern)
+        with self.lock:
+            exports[pattern] = keydata
+        return keydata
+
+    def invalidate(self, homedir=None):
+        "Forgets the snapshots of homedir or of all keyrings"
+        with self.lock:
+            if homedir is None:
+                self.listings.clear()
+                self.exports.clear()
+            else:
+                homedir = resolve_homedir(homedir)
+                for key in [k for k in self.listings if k[0] == homedir]:
+                    del self.listings[key]
+                self.exports.pop(homedir, None)
+
+
+# Shared by both gpgmh and gpgmeh
+keyring_cache = KeyringCache()
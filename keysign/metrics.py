@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+#    Copyright 2017 Tobias Mueller <muelli@cryptobitch.de>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+"""Counters of what the Keyserver does
+
+Every thread counts into a dictionary of its own, so that serving a
+request does not contend for a lock.  The dictionaries are summed up
+when somebody asks for the numbers, e.g. via the /metrics path of the
+Keyserver, which uses the text format of Prometheus.
+"""
+
+from bisect import bisect_left
+import logging
+from threading import Lock, current_thread, local
+
+log = logging.getLogger(__name__)
+
+
+# Upper bounds, in seconds, of the buckets of the latency histograms
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+PREFIX = 'keysign_keyserver'
+CTYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# The keys of the counters
+REQUESTS = 'requests'
+BYTES_SENT = 'bytes_sent'
+OPENED = 'opened'
+CLOSED = 'closed'
+REJECTED = 'rejected'
+TIMED_OUT = 'timed_out'
+BUCKET = 'bucket'
+SUM = 'sum'
+COUNT = 'count'
+
+
+def status_class(status):
+    "Returns the class we count the status in, e.g. 2xx"
+    if status == 304:
+        # Those are the cheap ones, so we want to see them
+        return '304'
+    return '%dxx' % (status // 100)
+
+
+def is_local(host):
+    "Returns whether the address is one of the loopback interface"
+    host = host.lower()
+    if host.startswith('::ffff:'):
+        host = host[len('::ffff:'):]
+    return host == '::1' or host.startswith('127.')
+
+
+def _add(total, counters):
+    for key, value in counters.items():
+        total[key] = total.get(key, 0) + value
+
+
+class Metrics(object):
+    '''Counters sharded by thread
+
+    A thread only ever writes to its own shard.  When a thread has
+    finished, its shard is folded into the retired counters, so that
+    a server spawning a thread per connection does not pile them up.
+    '''
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.local = local()
+        self.lock = Lock()
+        # (thread, counters) for each thread which has counted
+        self.shards = []
+        self.retired = {}
+
+    def _shard(self):
+        try:
+            return self.local.counters
+        except AttributeError:
+            pass
+        counters = self.local.counters = {}
+        with self.lock:
+            alive = []
+            for thread, shard in self.shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    _add(self.retired, shard)
+            alive.append((current_thread(), counters))
+            self.shards = alive
+        return counters
+
+    def inc(self, key, value=1):
+        counters = self._shard()
+        counters[key] = counters.get(key, 0) + value
+
+    def connection_opened(self):
+        self.inc(OPENED)
+
+    def connection_closed(self):
+        self.inc(CLOSED)
+
+    def record(self, status, nbytes, fingerprint=None, seconds=None):
+        "Counts a response and how long it took to produce it"
+        counters = self._shard()
+        for key, value in (((REQUESTS, status), 1), (BYTES_SENT, nbytes)):
+            counters[key] = counters.get(key, 0) + value
+        if seconds is not None:
+            fingerprint = fingerprint or ''
+            for key, value in (
+                    ((BUCKET, fingerprint,
+                      bisect_left(self.buckets, seconds)), 1),
+                    ((SUM, fingerprint), seconds),
+                    ((COUNT, fingerprint), 1)):
+                counters[key] = counters.get(key, 0) + value
+
+    def totals(self):
+        "Returns the sum of all counters"
+        with self.lock:
+            total = dict(self.retired)
+            # Copying a dict is atomic, even if its thread counts on
+            shards = [shard.copy() for _, shard in self.shards]
+        for shard in shards:
+            _add(total, shard)
+        return total
+
+    def snapshot(self):
+        "Returns the numbers as a dict"
+        total = self.totals()
+        requests = {}
+        responses = {}
+        latency = {}
+        for key, value in total.items():
+            if not isinstance(key, tuple):
+                continue
+            if key[0] == REQUESTS:
+                status = key[1]
+                requests[status] = value
+                cls = status_class(status)
+                responses[cls] = responses.get(cls, 0) + value
+            elif key[0] in (BUCKET, SUM, COUNT):
+                histogram = latency.setdefault(key[1], {
+                    'buckets': [0] * (len(self.buckets) + 1),
+                    'sum': 0.0,
+                    'count': 0,
+                })
+                if key[0] == BUCKET:
+                    histogram['buckets'][key[2]] += value
+                else:
+                    histogram[key[0]] = value
+        opened = total.get(OPENED, 0)
+        return {
+            'requests': sum(requests.values()),
+            'statuses': requests,
+            'responses': responses,
+            'bytes_sent': total.get(BYTES_SENT, 0),
+            'in_flight': opened - total.get(CLOSED, 0),
+            'connections': opened,
+            'rejected': total.get(REJECTED, 0),
+            'timed_out': total.get(TIMED_OUT, 0),
+            'latency': latency,
+        }
+
+    def render(self):
+        "Returns the numbers in the text format of Prometheus"
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, kind, help, samples):
+            name = PREFIX + '_' + name
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for suffix, labels, value in samples:
+                labels = ','.join('%s="%s"' % label for label in labels)
+                if labels:
+                    labels = '{%s}' % labels
+                lines.append('%s%s%s %s' % (name, suffix, labels, value))
+
+        metric('requests_total', 'counter', 'Requests answered by status',
+               [('', [('code', status)], count) for status, count
+                in sorted(snapshot['statuses'].items())])
+        metric('responses_total', 'counter',
+               'Requests answered by class of status',
+               [('', [('class', cls)], count) for cls, count
+                in sorted(snapshot['responses'].items())])
+        metric('sent_bytes_total', 'counter', 'Bytes sent in responses',
+               [('', [], snapshot['bytes_sent'])])
+        metric('connections_total', 'counter', 'Connections accepted',
+               [('', [], snapshot['connections'])])
+        metric('connections_in_flight', 'gauge', 'Connections open',
+               [('', [], snapshot['in_flight'])])
+        metric('rejected_connections_total', 'counter',
+               'Connections turned away', [('', [], snapshot['rejected'])])
+        metric('timed_out_connections_total', 'counter',
+               'Connections shut down for being too slow',
+               [('', [], snapshot['timed_out'])])
+
+        samples = []
+        for fpr, histogram in sorted(snapshot['latency'].items()):
+            cumulative = 0
+            bounds = ['%g' % b for b in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, histogram['buckets']):
+                cumulative += count
+                samples.append(('_bucket',
+                                [('fingerprint', fpr), ('le', bound)],
+                                cumulative))
+            samples.append(('_sum', [('fingerprint', fpr)],
+                            '%g' % histogram['sum']))
+            samples.append(('_count', [('fingerprint', fpr)],
+                            histogram['count']))
+        metric('request_duration_seconds', 'histogram',
+               'Time taken to answer requests by fingerprint', samples)
+        return '\n'.join(lines) + '\n'
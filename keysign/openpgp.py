@@ -0,0 +1,546 @@
+#!/usr/bin/env python
+#    Copyright 2017 Tobias Mueller <muelli@cryptobitch.de>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+"""Minimal handling of OpenPGP packets as described in RFC 4880
+
+We only care about transferable keys, i.e. what gpg --export
+gives us.  The functions here do not verify any signatures, so
+they cannot tell whether a UID or an expiry date has been made
+by the key's owner.  Anybody can append a UID with a copy of
+another UID's self signature to a key.  So whatever is shown to
+the user or decides what gets signed needs to come from gpg.
+We do compute the fingerprint, though, which is what we check
+downloaded keys against.
+
+Anything we do not understand raises a ParseError, so callers
+can fall back to asking gpg.
+"""
+
+import base64
+import binascii
+from collections import namedtuple
+from hashlib import sha1
+import logging
+import sys
+
+log = logging.getLogger(__name__)
+
+# Indexing a memoryview gives a str of length one on Python 2
+_ord = ord if sys.version_info.major < 3 else int
+
+
+TAG_SIGNATURE = 2
+TAG_SECRET_KEY = 5
+TAG_PUBLIC_KEY = 6
+TAG_SECRET_SUBKEY = 7
+TAG_TRUST = 12
+TAG_USER_ID = 13
+TAG_PUBLIC_SUBKEY = 14
+TAG_USER_ATTRIBUTE = 17
+
+SIG_UID_CERTIFICATIONS = (0x10, 0x11, 0x12, 0x13)
+SIG_SUBKEY_BINDING = 0x18
+SIG_SUBKEY_REVOCATION = 0x28
+SIG_UID_REVOCATION = 0x30
+
+SUBPACKET_CREATION_TIME = 2
+SUBPACKET_KEY_EXPIRATION_TIME = 9
+SUBPACKET_ISSUER = 16
+SUBPACKET_PRIMARY_USER_ID = 25
+SUBPACKET_ISSUER_FINGERPRINT = 33
+
+# The number of MPIs making up the public key material per algorithm
+PUBKEY_ALGO_MPIS = {
+    1: 2,  # RSA
+    2: 2,  # RSA encrypt only
+    3: 2,  # RSA sign only
+    16: 3,  # Elgamal
+    17: 4,  # DSA
+}
+PUBKEY_ALGO_ECDH = 18
+# ECDSA and EdDSA have an OID followed by one MPI
+PUBKEY_ALGO_EC = (19, 22)
+
+ARMOR_BEGIN = b"-----BEGIN PGP "
+ARMOR_KEY_BLOCKS = (b"PUBLIC KEY BLOCK-----", b"PRIVATE KEY BLOCK-----")
+ARMOR_END = b"-----END PGP "
+ARMOR_LINE_LENGTH = 64
+
+PRIMARY_KEY_TAGS = (TAG_PUBLIC_KEY, TAG_SECRET_KEY)
+SUBKEY_TAGS = (TAG_PUBLIC_SUBKEY, TAG_SECRET_SUBKEY)
+UID_TAGS = (TAG_USER_ID, TAG_USER_ATTRIBUTE)
+
+
+class ParseError(ValueError):
+    "Raised when the data is not something we can handle"
+
+
+
+class Packet(namedtuple("Packet", "tag raw body")):
+    """A single OpenPGP packet
+
+    raw is the whole packet including the header, body is
+    the packet's content only.  Both are memoryviews into the
+    data that was parsed.
+    """
+
+
+
+def _packet_header(mv, offset):
+    """Returns the tag, the header length, and the body length
+    of the packet starting at offset"""
+    ctb = _ord(mv[offset])
+    if not ctb & 0x80:
+        raise ParseError("Invalid packet header %r at offset %d"
+                         % (ctb, offset))
+    if not ctb & 0x40:
+        # Old format packet
+        length_type = ctb & 0x03
+        if length_type == 3:
+            raise ParseError("Indeterminate lengths are not supported")
+        nbytes = 1 << length_type
+        return (ctb >> 2) & 0x0f, 1 + nbytes, _read_int(mv, offset+1, nbytes)
+
+    # New format packet
+    tag = ctb & 0x3f
+    first = _read_int(mv, offset+1, 1)
+    if first < 192:
+        return tag, 2, first
+    elif first < 224:
+        return tag, 3, ((first - 192) << 8) + _read_int(mv, offset+2, 1) + 192
+    elif first == 255:
+        return tag, 6, _read_int(mv, offset+2, 4)
+    raise ParseError("Partial body lengths are not supported")
+
+
+def parse_packets(data):
+    """Yields the Packets contained in the given binary data
+
+    Partial body lengths and indeterminate lengths are not
+    supported as they do not occur in exported keys.
+    """
+    mv = memoryview(data)
+    length = len(mv)
+    offset = 0
+    while offset < length:
+        tag, hlen, plen = _packet_header(mv, offset)
+        end = offset + hlen + plen
+        if end > length:
+            raise ParseError("Packet at %d exceeds the data (%d > %d)"
+                             % (offset, end, length))
+        yield Packet(tag, mv[offset:end], mv[offset+hlen:end])
+        offset = end
+
+
+def _read_int(mv, offset, nbytes):
+    "Reads a big endian unsigned integer"
+    if offset + nbytes > len(mv):
+        raise ParseError("Truncated data at %d" % offset)
+    value = 0
+    for i in range(offset, offset + nbytes):
+        value = (value << 8) | _ord(mv[i])
+    return value
+
+
+def _join(packets):
+    "Concatenates the raw bytes of the given packets"
+    if sys.version_info.major < 3:
+        # Python 2's str.join cannot deal with memoryviews
+        return b''.join(p.raw.tobytes() for p in packets)
+    # Copies the packets exactly once, straight into the result
+    return b''.join(p.raw for p in packets)
+
+
+
+class KeyBlock(namedtuple("KeyBlock", "primary uids subkeys")):
+    """A transferable key split into its components
+
+    primary is the list of the primary key packet and its direct
+    signatures.  uids and subkeys are lists of lists, each starting
+    with the UID (or user attribute) or subkey packet, respectively,
+    followed by its signatures.
+    """
+
+
+
+def parse_keyblock(data):
+    """Splits binary data containing exactly one key into a KeyBlock
+
+    Trust packets are dropped as gpg does not export them either.
+    """
+    primary = []
+    uids = []
+    subkeys = []
+    current = None
+    for packet in parse_packets(data):
+        tag = packet.tag
+        if tag in PRIMARY_KEY_TAGS:
+            if primary:
+                raise ParseError("Expected exactly one key")
+            primary.append(packet)
+            current = primary
+        elif not primary:
+            raise ParseError("Expected a key packet, got tag %d" % tag)
+        elif tag in UID_TAGS:
+            current = [packet]
+            uids.append(current)
+        elif tag in SUBKEY_TAGS:
+            current = [packet]
+            subkeys.append(current)
+        elif tag == TAG_SIGNATURE:
+            current.append(packet)
+        elif tag == TAG_TRUST:
+            continue
+        else:
+            raise ParseError("Unexpected packet with tag %d" % tag)
+
+    if not primary:
+        raise ParseError("No key found")
+    return KeyBlock(primary, uids, subkeys)
+
+
+
+def split_uids(data):
+    """Yields a (uid, keydata) pair for every UID in the binary key data
+
+    The keydata contains the primary key, the UID with all of its
+    signatures, the user attributes, e.g. photo IDs, and the subkeys.
+    That is exactly what gpg exports after deleting all the other UIDs,
+    as deluid leaves the user attributes alone.
+    The uid is the raw bytes of the UID packet.
+    """
+    keyblock = parse_keyblock(data)
+    subkey_packets = [p for subkey in keyblock.subkeys for p in subkey]
+    for uid_packets in keyblock.uids:
+        if uid_packets[0].tag != TAG_USER_ID:
+            continue
+        packets = list(keyblock.primary)
+        for other in keyblock.uids:
+            if other is uid_packets or other[0].tag != TAG_USER_ID:
+                packets += other
+        packets += subkey_packets
+        yield (uid_packets[0].body.tobytes(), _join(packets))
+
+
+
+def crc24(data):
+    "The checksum used by ASCII armor, see RFC 4880 Section 6.1"
+    crc = 0xB704CE
+    for byte in bytearray(data):
+        crc ^= byte << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= 0x1864CFB
+    return crc & 0xFFFFFF
+
+
+def _as_bytes(data):
+    "Returns data as bytes, encoding text as ASCII"
+    if data is None:
+        raise ParseError("No data given")
+    if isinstance(data, bytes):
+        return data
+    try:
+        return data.encode("ascii")
+    except (AttributeError, UnicodeError):
+        raise ParseError("Cannot handle %r" % type(data))
+
+
+def _skip_armor_header(lines):
+    "Consumes the armor's BEGIN line and its headers from lines"
+    begin = next(lines).strip()
+    if not begin[len(ARMOR_BEGIN):] in ARMOR_KEY_BLOCKS:
+        raise ParseError("Not an armored key: %r" % begin)
+    for line in lines:
+        if not line.strip():
+            return
+    raise ParseError("Armor ended prematurely")
+
+
+def _read_armor_body(lines):
+    """Consumes the armor's body and tail from lines
+
+    Returns the base64 encoded body and checksum, which is None
+    if the armor has none.
+    """
+    body = []
+    checksum = None
+    for line in lines:
+        line = line.strip()
+        if line.startswith(ARMOR_END):
+            break
+        elif line.startswith(b"="):
+            checksum = line[1:]
+        elif line:
+            body.append(line)
+    else:
+        raise ParseError("No armor tail found")
+    if any(line.strip() for line in lines):
+        # Probably another key which gpg should deal with
+        raise ParseError("Unexpected data after the armor")
+    return b"".join(body), checksum
+
+
+def _decode_armor_body(body, checksum):
+    "Returns the binary data of the body after checking its CRC"
+    try:
+        binary = base64.b64decode(body)
+        crc = bytearray(base64.b64decode(checksum or b""))
+    except (binascii.Error, TypeError) as e:
+        raise ParseError("Invalid armor: %s" % e)
+    if checksum is None:
+        return binary
+    if len(crc) != 3 or (crc[0] << 16 | crc[1] << 8 | crc[2]) != crc24(binary):
+        raise ParseError("Armor checksum mismatch")
+    return binary
+
+
+def dearmor(data):
+    """Returns the binary data of ASCII armored key data
+
+    Binary data is returned unchanged.
+    """
+    data = _as_bytes(data)
+    stripped = data.lstrip()
+    if not stripped.startswith(ARMOR_BEGIN):
+        if stripped and _ord(memoryview(stripped)[0]) & 0x80:
+            return data
+        raise ParseError("Data is neither armored nor binary")
+
+    lines = iter(stripped.splitlines())
+    _skip_armor_header(lines)
+    body, checksum = _read_armor_body(lines)
+    return _decode_armor_body(body, checksum)
+
+
+def is_armored(data):
+    "Returns whether data looks like ASCII armored rather than binary data"
+    if not isinstance(data, bytes):
+        return True
+    return data.lstrip().startswith(ARMOR_BEGIN)
+
+
+def armor(data, block=b"PUBLIC KEY BLOCK"):
+    "Returns the binary data ASCII armored the way gpg does it"
+    encoded = base64.b64encode(data)
+    lines = [ARMOR_BEGIN + block + b"-----", b""]
+    lines += [encoded[i:i+ARMOR_LINE_LENGTH]
+              for i in range(0, len(encoded), ARMOR_LINE_LENGTH)]
+    crc = crc24(data)
+    lines.append(b"=" + base64.b64encode(bytes(bytearray(
+        [crc >> 16, (crc >> 8) & 0xff, crc & 0xff]))))
+    lines.append(ARMOR_END + block + b"-----")
+    return b"\n".join(lines) + b"\n"
+
+
+
+def _skip_mpis(mv, offset, count):
+    "Returns the offset after count MPIs starting at offset"
+    for _ in range(count):
+        bits = _read_int(mv, offset, 2)
+        offset += 2 + (bits + 7) // 8
+    return offset
+
+
+def _skip_length_prefixed(mv, offset):
+    "Skips a field with a one octet length, like a curve OID"
+    return offset + 1 + _read_int(mv, offset, 1)
+
+
+def public_key_material(body):
+    """Returns the public part of a (secret) key packet's body
+
+    Only version 4 keys are supported.
+    """
+    if len(body) < 6:
+        raise ParseError("Key packet too short")
+    version = _ord(body[0])
+    if version != 4:
+        raise ParseError("Unsupported key version %d" % version)
+    algo = _ord(body[5])
+    offset = 6
+    if algo in PUBKEY_ALGO_MPIS:
+        offset = _skip_mpis(body, offset, PUBKEY_ALGO_MPIS[algo])
+    elif algo in PUBKEY_ALGO_EC:
+        offset = _skip_length_prefixed(body, offset)
+        offset = _skip_mpis(body, offset, 1)
+    elif algo == PUBKEY_ALGO_ECDH:
+        offset = _skip_length_prefixed(body, offset)
+        offset = _skip_mpis(body, offset, 1)
+        offset = _skip_length_prefixed(body, offset)
+    else:
+        raise ParseError("Unsupported public key algorithm %d" % algo)
+    if offset > len(body):
+        raise ParseError("Key material exceeds the packet")
+    return body[:offset]
+
+
+def fingerprint(body):
+    "Computes the v4 fingerprint of a (secret) key packet's body"
+    material = public_key_material(body)
+    length = len(material)
+    header = bytearray([0x99, (length >> 8) & 0xff, length & 0xff])
+    return sha1(bytes(header) + material.tobytes()).hexdigest().upper()
+
+
+
+SIGNATURE_FIELDS = "sigclass created issuer issuer_fpr expires_in is_primary"
+
+
+class Signature(namedtuple("Signature", SIGNATURE_FIELDS)):
+    """The bits of a version 4 signature packet that we care about
+
+    expires_in is the key expiration time subpacket, i.e. the number of
+    seconds after the key's creation.  The issuer, if present, is the
+    hex keyid.
+    """
+
+
+def _subpackets(mv):
+    "Yields (type, data) of the signature subpackets in mv"
+    offset = 0
+    length = len(mv)
+    while offset < length:
+        first = _ord(mv[offset])
+        if first < 192:
+            hlen, plen = 1, first
+        elif first < 255:
+            hlen = 2
+            plen = ((first - 192) << 8) + _read_int(mv, offset+1, 1) + 192
+        else:
+            hlen = 5
+            plen = _read_int(mv, offset+1, 4)
+        if plen < 1 or offset + hlen + plen > length:
+            raise ParseError("Invalid subpacket length")
+        type_ = _ord(mv[offset+hlen]) & 0x7f
+        yield (type_, mv[offset+hlen+1:offset+hlen+plen])
+        offset += hlen + plen
+
+
+def parse_signature(body):
+    "Parses a version 4 signature packet body into a Signature"
+    if len(body) < 6 or _ord(body[0]) != 4:
+        raise ParseError("Unsupported signature packet")
+    sigclass = _ord(body[1])
+    hashed_len = _read_int(body, 4, 2)
+    hashed = body[6:6+hashed_len]
+    unhashed_len = _read_int(body, 6+hashed_len, 2)
+    unhashed = body[8+hashed_len:8+hashed_len+unhashed_len]
+
+    created = None
+    issuer = None
+    issuer_fpr = None
+    expires_in = None
+    is_primary = False
+    # Only the hashed subpackets are protected by the signature
+    for area_is_hashed, area in ((True, hashed), (False, unhashed)):
+        for type_, data in _subpackets(area):
+            if type_ == SUBPACKET_ISSUER and len(data) == 8:
+                issuer = binascii.hexlify(data.tobytes()).decode("ascii").upper()
+            elif type_ == SUBPACKET_ISSUER_FINGERPRINT and len(data) == 21:
+                issuer_fpr = binascii.hexlify(data[1:].tobytes()).decode("ascii").upper()
+            elif not area_is_hashed:
+                continue
+            elif type_ == SUBPACKET_CREATION_TIME:
+                created = _read_int(data, 0, 4)
+            elif type_ == SUBPACKET_KEY_EXPIRATION_TIME:
+                expires_in = _read_int(data, 0, 4)
+            elif type_ == SUBPACKET_PRIMARY_USER_ID:
+                is_primary = bool(_ord(data[0])) if len(data) else False
+    return Signature(sigclass, created, issuer, issuer_fpr,
+                     expires_in, is_primary)
+
+
+
+def key_fingerprint(data):
+    "Returns the fingerprint of the one key in the binary or armored data"
+    keyblock = parse_keyblock(dearmor(data))
+    return fingerprint(keyblock.primary[0].body)
+
+
+
+def _only_self_signature(packets, fpr, sigclasses):
+    """Returns the packet of the one signature in packets by fpr
+
+    Returns None if there is no such signature.  If there are several,
+    we would have to tell the valid ones from those copied from
+    elsewhere, so a ParseError is raised to have gpg deal with it.
+    """
+    keyid = fpr[-16:]
+    found = None
+    for packet in packets:
+        if packet.tag != TAG_SIGNATURE:
+            continue
+        sig = parse_signature(packet.body)
+        if sig.sigclass not in sigclasses:
+            continue
+        if sig.issuer_fpr != fpr and sig.issuer != keyid:
+            continue
+        if found is not None:
+            raise ParseError("More than one self signature")
+        found = packet
+    return found
+
+
+def _export(binary, armored):
+    "Returns the binary data armored if requested"
+    return armor(binary) if armored else binary
+
+
+def filter_uid(data, uid):
+    """Returns the key in data with uid as its only UID
+
+    That is what split_uids yields for the UID.  The result is
+    armored if the data was armored.
+    """
+    if not isinstance(uid, bytes):
+        uid = uid.encode("utf-8")
+    armored = is_armored(data)
+    for key_uid, keydata in split_uids(dearmor(data)):
+        if key_uid == uid:
+            return _export(keydata, armored)
+    raise ParseError("UID %r not found" % uid)
+
+
+def minimise(data):
+    """Returns the key in data as gpg's export-minimal would export it
+
+    Only the self signature or revocation of every UID is retained as
+    are the binding and revocation signatures of the subkeys.  The
+    result is armored if the data was armored.  We cannot verify
+    signatures, so we cannot pick the latest valid one like gpg does.
+    If there is more than one to choose from, we raise a ParseError.
+    """
+    armored = is_armored(data)
+    keyblock = parse_keyblock(dearmor(data))
+    fpr = fingerprint(keyblock.primary[0].body)
+
+    uid_sigclasses = SIG_UID_CERTIFICATIONS + (SIG_UID_REVOCATION,)
+    packets = list(keyblock.primary)
+    for uid_packets in keyblock.uids:
+        selfsig = _only_self_signature(uid_packets[1:], fpr, uid_sigclasses)
+        if selfsig is None:
+            # gpg would have to clean that UID up
+            raise ParseError("UID without self signature")
+        packets += [uid_packets[0], selfsig]
+    for subkey_packets in keyblock.subkeys:
+        keep = [_only_self_signature(subkey_packets[1:], fpr, (sigclass,))
+                for sigclass in (SIG_SUBKEY_BINDING, SIG_SUBKEY_REVOCATION)]
+        packets.append(subkey_packets[0])
+        packets += [p for p in subkey_packets[1:] if any(p is k for k in keep)]
+    return _export(_join(packets), armored)
@@ -22,8 +22,8 @@ from subprocess import call
 from string import Template
 from tempfile import NamedTemporaryFile
 
-from .gpgmh import fingerprint_from_keydata
-from .gpgmh import sign_keydata_and_encrypt
+from .gpgbackend import fingerprint_from_keydata
+from .gpgbackend import sign_keydata_and_encrypt
 
 log = logging.getLogger(__name__)
 
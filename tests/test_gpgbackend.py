@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#    Copyright 2017 Tobias Mueller <muelli@cryptobitch.de>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+import os
+import shutil
+import sys
+import tempfile
+
+from nose.tools import *
+
+from keysign import gpgbackend
+from keysign.gpgbackend import benchmark
+from keysign.gpgbackend import choose_auto
+from keysign.gpgbackend import choose_fastest
+from keysign.gpgbackend import load
+from keysign.gpgbackend import read_cached_choice
+from keysign.gpgbackend import requested_backend
+from keysign.gpgbackend import write_cached_choice
+from keysign.keycache import keyring_cache
+
+
+def test_requested_backend():
+    assert_equals("monkeysign", requested_backend({}))
+    assert_equals("gpgme", requested_backend({"KEYSIGN_GPGME": "1"}))
+    assert_equals("monkeysign", requested_backend({"KEYSIGN_GPGME": "0"}))
+    assert_equals("auto", requested_backend({"KEYSIGN_BACKEND": "auto",
+                                             "KEYSIGN_GPGME": "1"}))
+
+
+def test_lazy_import():
+    "Importing the registry does not import any backend"
+    assert_equals(None, gpgbackend._backend)
+
+
+@raises(ValueError)
+def test_unknown_backend():
+    load("no such backend")
+
+
+class FakeBackend(object):
+    def __init__(self):
+        self.listed = 0
+        self.homedirs = set()
+
+    def get_usable_keys(self, *args, **kwargs):
+        self.listed += 1
+        self.homedirs.add(kwargs.get("homedir"))
+        return []
+
+    get_usable_secret_keys = get_usable_keys
+
+
+def test_benchmark_leaves_cache_alone():
+    "The benchmark lists a temporary keyring, not the user's cached one"
+    homedir = tempfile.mkdtemp()
+    keys = keyring_cache.get_keys(homedir, False, "", lambda pattern: [])
+    backend = FakeBackend()
+    benchmark(backend, rounds=2)
+    assert_equals(4, backend.listed)
+    assert_equals(1, len(backend.homedirs))
+    tmp = backend.homedirs.pop()
+    assert_not_equal(homedir, tmp)
+    assert_false(os.path.exists(tmp))
+    # The snapshot of the other keyring survived
+    assert_equals(keys, keyring_cache.get_keys(homedir, False, "", None))
+    shutil.rmtree(homedir)
+
+
+class TestChooseFastest:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.tmpdir, "sub", "backend.json")
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_single_backend(self):
+        backend = FakeBackend()
+        name = choose_fastest({"fake": backend}, self.cache_file)
+        assert_equals("fake", name)
+        # No need to benchmark if there is no choice
+        assert_equals(0, backend.listed)
+
+    @raises(ImportError)
+    def test_no_backend(self):
+        choose_fastest({}, self.cache_file)
+
+    def test_choice_is_cached(self):
+        backends = OrderedDict([("a", FakeBackend()), ("b", FakeBackend())])
+        name = choose_fastest(backends, self.cache_file)
+        assert_in(name, backends)
+        assert_true(all(b.listed for b in backends.values()))
+
+        backends = OrderedDict([("a", FakeBackend()), ("b", FakeBackend())])
+        assert_equals(name, choose_fastest(backends, self.cache_file))
+        assert_false(any(b.listed for b in backends.values()))
+
+    def test_auto_benchmarks_in_background(self):
+        backends = OrderedDict([("a", FakeBackend()), ("b", FakeBackend())])
+        # We get a backend without waiting for the benchmark
+        assert_equals("a", choose_auto(backends, self.cache_file))
+        gpgbackend._benchmark.join()
+        assert_true(all(b.listed for b in backends.values()))
+
+        name = read_cached_choice(gpgbackend.cache_key(backends),
+                                  self.cache_file)
+        assert_in(name, backends)
+        assert_equals(name, choose_auto(backends, self.cache_file))
+
+    def test_broken_cache_file(self):
+        os.makedirs(os.path.dirname(self.cache_file))
+        with open(self.cache_file, "w") as f:
+            f.write("{not json")
+        assert_equals(None, read_cached_choice({}, self.cache_file))
+        write_cached_choice({}, "a", {}, self.cache_file)
+        assert_equals("a", read_cached_choice({}, self.cache_file))
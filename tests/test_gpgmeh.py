@@ -18,23 +18,30 @@
 
 import logging
 import os, sys
-from subprocess import CalledProcessError, check_call
+from subprocess import CalledProcessError, check_call, check_output
 import tempfile
 
 from nose.tools import *
 
 import gpg
 
+from keysign import gpgmeh
+from keysign.gpgmeh import HomedirPool
 from keysign.gpgmeh import TempContext
 from keysign.gpgmeh import DirectoryContext
 from keysign.gpgmeh import UIDExport
 from keysign.gpgmeh import export_uids
+from keysign.gpgmeh import split_uids
 from keysign.gpgmeh import fingerprint_from_keydata
 from keysign.gpgmeh import openpgpkey_from_data
 from keysign.gpgmeh import get_usable_keys
 from keysign.gpgmeh import get_usable_secret_keys
 from keysign.gpgmeh import get_public_key_data
 from keysign.gpgmeh import sign_keydata_and_encrypt
+from keysign.gpgmeh import sign_keydatas_and_encrypt
+from keysign.gpgmeh import signing_context
+from keysign.gpgmeh import certify_key
+from keysign.gpgmeh import parse_version
 
 log = logging.getLogger(__name__)
 thisdir = os.path.dirname(os.path.realpath(__file__))
@@ -502,3 +509,179 @@ class TestSignAndEncrypt:
         sigs_after = [sig for signatures in sigs for sig in signatures]
         assert_greater(len(sigs_after), len(sigs_before))
 
+
+    def test_sign_and_encrypt_batch(self):
+        "A broken key in the batch should not affect the others"
+        sender = DirectoryContext(homedir=self.key_sender_homedir)
+        sender_key = list(sender.keylist())[0]
+        sink = gpg.Data()
+        sender.op_export_keys([sender_key], 0, sink)
+        sink.seek(0, 0)
+        public_sender_key = sink.read()
+
+        errors = []
+        results = list(sign_keydatas_and_encrypt(
+            [b"This is not a key", public_sender_key],
+            error_cb=errors.append, homedir=self.key_receiver_homedir))
+        assert_equals(1, len(errors))
+        assert_equals(len(sender_key.uids), len(results))
+        for fpr, uid, ciphertext in results:
+            assert_equals(sender_key.fpr, fpr)
+            plaintext, _, _ = sender.decrypt(ciphertext)
+            sender.op_import(plaintext)
+            assert_equals(1, sender.op_import_result().new_signatures)
+
+    def test_certify_selected_uid(self):
+        "Only the selected UID should get a signature"
+        sender = DirectoryContext(homedir=self.key_sender_homedir)
+        sender_key = list(sender.keylist())[0]
+        uid_to_sign = sender_key.uids[-1].uid
+        sink = gpg.Data()
+        sender.op_export_keys([sender_key], 0, sink)
+        sink.seek(0, 0)
+
+        ctx = signing_context(homedir=self.key_receiver_homedir)
+        ctx.op_import(sink)
+        ctx.set_keylist_mode(gpg.constants.KEYLIST_MODE_SIGS)
+        key = ctx.get_key(sender_key.fpr)
+        certify_key(ctx, key, uids=[uid_to_sign])
+
+        key = ctx.get_key(sender_key.fpr)
+        for uid in key.uids:
+            signers = {sig.keyid for sig in uid.signatures}
+            if uid.uid == uid_to_sign:
+                assert_equals(2, len(signers))
+            else:
+                assert_equals(1, len(signers))
+
+    def test_certify_unknown_uid(self):
+        "The edit-key fallback must not sign all UIDs if none matches"
+        sender = DirectoryContext(homedir=self.key_sender_homedir)
+        sender_key = list(sender.keylist())[0]
+        sink = gpg.Data()
+        sender.op_export_keys([sender_key], 0, sink)
+        sink.seek(0, 0)
+
+        ctx = signing_context(homedir=self.key_receiver_homedir)
+        ctx.op_import(sink)
+        ctx.set_keylist_mode(gpg.constants.KEYLIST_MODE_SIGS)
+        key = ctx.get_key(sender_key.fpr)
+        supported = gpgmeh._engine_supports_keysign
+        gpgmeh._engine_supports_keysign = False
+        try:
+            assert_raises(ValueError, certify_key, ctx, key,
+                          uids=["Mallory <mallory@example.org>"])
+        finally:
+            gpgmeh._engine_supports_keysign = supported
+
+        key = ctx.get_key(sender_key.fpr)
+        for uid in key.uids:
+            signers = {sig.keyid for sig in uid.signatures}
+            assert_equals(1, len(signers))
+
+
+def test_split_uids_alpha():
+    "Every UID should be split off from one single import"
+    data = read_fixture_file("alpha.asc")
+    c = TempContext()
+    c.op_import(data)
+    result = c.op_import_result()
+    fpr = result.imports[0].fpr
+    uids = c.get_key(fpr).uids
+
+    split = list(split_uids(data))
+    assert_equals(len(uids), len(split))
+    for uid, (split_uid, uid_data) in zip(uids, split):
+        assert_equals(uid.uid, split_uid.uid)
+        tmp = TempContext()
+        tmp.op_import(uid_data)
+        result = tmp.op_import_result()
+        uid_key = tmp.get_key(result.imports[0].fpr)
+        assert_equals(fpr, uid_key.fpr)
+        assert_equals(1, len(uid_key.uids))
+        assert_equals(uid.uid, uid_key.uids[0].uid)
+
+
+def test_homedir_pool_reuse():
+    pool = HomedirPool(max_kept=1, basedir=tempfile.mkdtemp())
+    homedir = pool.acquire()
+    open(os.path.join(homedir, "pubring.kbx"), "w").close()
+    # The pool is exhausted now, so we get an extra homedir
+    extra = pool.acquire()
+    assert_not_equal(homedir, extra)
+    pool.release(extra)
+    assert_false(os.path.exists(extra))
+
+    pool.release(homedir)
+    reused = pool.acquire()
+    assert_equals(homedir, reused)
+    assert_equals(["gpg.conf"], os.listdir(reused))
+
+    pool.reap()
+    assert_false(os.path.exists(homedir))
+
+
+def test_homedir_pool_spares_linked_agent():
+    "Discarding a homedir does not kill the agent it links to"
+    agent_homedir = tempfile.mkdtemp()
+    check_call(["gpg-connect-agent", "--homedir", agent_homedir, "/bye"])
+    agent_socket = os.path.join(agent_homedir, "S.gpg-agent")
+    pool = HomedirPool(max_kept=1, basedir=tempfile.mkdtemp())
+    homedir = pool.acquire()
+    os.symlink(agent_socket, os.path.join(homedir, "S.gpg-agent"))
+    try:
+        pool.reap()
+        assert_false(os.path.exists(homedir))
+        # The agent is still there to tell us its pid
+        output = check_output(["gpg-connect-agent", "--homedir",
+                               agent_homedir, "--no-autostart",
+                               "GETINFO pid", "/bye"])
+        assert_true(output.startswith(b"D "))
+    finally:
+        check_call(["gpgconf", "--homedir", agent_homedir,
+                    "--kill", "gpg-agent"])
+
+
+def test_homedir_pool_stops_agent_on_release():
+    "The agents started for a homedir do not outlive its reuse"
+    pool = HomedirPool(max_kept=1, basedir=tempfile.mkdtemp())
+    homedir = pool.acquire()
+    calls = []
+    call = gpgmeh.call
+    gpgmeh.call = calls.append
+    try:
+        pool.release(homedir)
+    finally:
+        gpgmeh.call = call
+        pool.reap()
+    assert_in(["gpgconf", "--homedir", homedir, "--kill", "all"], calls)
+
+
+def test_homedir_pool_release_after_reap():
+    pool = HomedirPool(max_kept=1, basedir=tempfile.mkdtemp())
+    homedir = pool.acquire()
+    pool.reap()
+
+    def reset(homedir):
+        assert False, "A reaped homedir must not be reset"
+    pool.reset = reset
+    pool.release(homedir)
+    assert_equals([], pool.free)
+    assert_false(os.path.exists(homedir))
+
+
+def test_temp_context_releases_homedir():
+    pool = HomedirPool(max_kept=1, basedir=tempfile.mkdtemp())
+    with TempContext(pool=pool) as ctx:
+        homedir = ctx.homedir
+        ctx.op_import(read_fixture_file("pubkey-1.asc"))
+        assert_equals(1, ctx.op_import_result().imported)
+    assert_equals([homedir], pool.free)
+    assert_equals(["gpg.conf"], os.listdir(homedir))
+    pool.reap()
+
+
+def test_parse_version():
+    assert_equals((2, 1, 12), parse_version("2.1.12"))
+    assert_equals((2, 2, 0), parse_version("2.2.0-beta1"))
+    assert_true(parse_version("2.1.12") > parse_version("2.1.9"))
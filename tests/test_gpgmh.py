@@ -18,7 +18,7 @@
 
 import logging
 import os, sys
-from subprocess import CalledProcessError, check_call
+from subprocess import CalledProcessError, PIPE, Popen, check_call
 import tempfile
 
 from nose.tools import *
@@ -32,7 +32,16 @@ from keysign.gpgmh import fingerprint_from_keydata
 from keysign.gpgmh import get_public_key_data
 from keysign.gpgmh import get_usable_keys
 from keysign.gpgmh import get_usable_secret_keys
+from keysign.gpgmh import sign_keydata
 from keysign.gpgmh import sign_keydata_and_encrypt
+from keysign.gpgmh import Keyring
+from keysign.gpgmh import MinimalExport
+from keysign.gpgmh import UIDExport
+from keysign.gpgmh import SignatureIndex
+from keysign.gpgmh import signatures_for_keyid
+from keysign.openpgp import TAG_SIGNATURE
+from keysign.openpgp import dearmor
+from keysign.openpgp import parse_packets
 
 log = logging.getLogger(__name__)
 
@@ -98,6 +107,34 @@ class TestKey1:
         assert_equals('joe@example.com',
                       uid.email)
 
+
+def test_uid_export():
+    data = read_fixture_file("alpha.asc")
+    exported = UIDExport("Alice (demo key)", data)
+    key = openpgpkey_from_data(exported)
+    assert_equals("A0FF4590BB6122EDEF6E3C542D727CC768697734",
+                  key.fingerprint)
+    assert_equals(["Alice (demo key)"], [u.uid for u in key.uidslist])
+
+
+def test_minimal_export():
+    data = read_fixture_file("alpha.asc")
+    minimal = MinimalExport(data)
+    assert_equals(fingerprint_from_keydata(data),
+                  fingerprint_from_keydata(minimal))
+
+
+def test_minimal_export_several_self_signatures():
+    # The subkey is bound twice, so gpg has to pick the binding
+    minimal = MinimalExport(read_fixture_file("pubkey-1.asc"))
+    signatures = [p for p in parse_packets(dearmor(minimal))
+                  if p.tag == TAG_SIGNATURE]
+    # The UID's self signature and one binding
+    assert_equals(2, len(signatures))
+    assert_equals("ADAB7FCC1F4DE2616ECFA402AF82244F9CD9FD55",
+                  fingerprint_from_keydata(minimal))
+
+
 @raises(ValueError)
 def test_get_public_key_no_data():
     tmp = tempfile.mkdtemp()
@@ -146,6 +183,29 @@ class TestGetPublicKeyData:
 
 
 
+class TestSignatureIndex:
+    def setup(self):
+        self.homedir = tempfile.mkdtemp()
+        gpgcmd = ["gpg", "--homedir={}".format(self.homedir)]
+        check_call(gpgcmd + ["--import", get_fixture_file("pubkey-1.asc"),
+                                         get_fixture_file("alpha.asc")])
+        self.keyring = Keyring(homedir=self.homedir)
+
+    def test_index(self):
+        fpr = "ADAB7FCC1F4DE2616ECFA402AF82244F9CD9FD55"
+        other = "A0FF4590BB6122EDEF6E3C542D727CC768697734"
+        index = SignatureIndex([fpr, other], keyring=self.keyring)
+        sigs = index.signatures(fpr)
+        assert_true(sigs)
+        assert_true(index.signatures(other))
+        assert_equals(sigs, index.signatures(fpr[-16:]))
+        assert_equals(sigs, signatures_for_keyid(fpr, keyring=self.keyring))
+
+    def test_unknown_key(self):
+        index = SignatureIndex(["DEADBEEF"], keyring=self.keyring)
+        assert_equals([], index.signatures("DEADBEEF"))
+
+
 def test_get_empty_usable_keys():
     homedir = tempfile.mkdtemp()
     keys = get_usable_keys(homedir=homedir)
@@ -254,3 +314,40 @@ class TestSignAndEncrypt:
             pass
         # Ideally, we could decrypt the message, parse the email,
         # extract the attached key, and check the signatures...
+
+
+
+def signature_issuers(keydata):
+    "Returns the key ids of the signatures in the keydata"
+    p = Popen(["gpg", "--list-packets"], stdin=PIPE, stdout=PIPE)
+    out, _ = p.communicate(keydata.encode("ascii")
+                           if not isinstance(keydata, bytes) else keydata)
+    return set(line.split(b"keyid ")[1].decode("ascii").strip()
+               for line in out.splitlines()
+               if line.startswith(b":signature packet:"))
+
+
+class TestSignWithTwoKeys:
+    def setup(self):
+        self.homedir = tempfile.mkdtemp()
+        gpgcmd = ["gpg", "--homedir={}".format(self.homedir)]
+        self.signers = []
+        for fixture in ("seckey-no-pw-1.asc", "seckey-no-pw-2.asc"):
+            fname = get_fixture_file(fixture)
+            check_call(gpgcmd + ["--import", fname])
+            self.signers.append(fingerprint_from_keydata(open(fname).read()))
+
+    def teardown(self):
+        # shutil.rmtree(self.homedir)
+        pass
+
+    def test_sign_keydata(self):
+        "Every UID is certified by each of the secret keys"
+        keydata = read_fixture_file("alpha.asc")
+        signed = list(sign_keydata(keydata, error_cb=None,
+                                   homedir=self.homedir))
+        assert_equals(3, len(signed))
+        for uid, signed_key in signed:
+            issuers = signature_issuers(signed_key)
+            for fpr in self.signers:
+                assert_in(fpr[-16:], issuers)
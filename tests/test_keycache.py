@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+#    Copyright 2017 Tobias Mueller <muelli@cryptobitch.de>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import namedtuple
+from datetime import datetime
+import os
+import tempfile
+import time
+
+from nose.tools import *
+
+from keysign.keycache import KeyCache
+from keysign.keycache import KeyringCache
+
+
+def test_cache_hit():
+    cache = KeyCache()
+    calls = []
+    def create(keydata):
+        calls.append(keydata)
+        return keydata.upper()
+
+    assert_equals("KEY", cache.get("key", "upper", create))
+    assert_equals("KEY", cache.get(b"key", "upper", create))
+    assert_equals(["key"], calls)
+    assert_equals(1, cache.hits)
+    assert_equals(1, cache.misses)
+
+
+def test_cache_evicts_least_recently_used():
+    cache = KeyCache(maxsize=2)
+    create = lambda keydata: keydata
+    cache.get("a", "x", create)
+    cache.get("b", "x", create)
+    # Touch a, so that b is the least recently used
+    cache.get("a", "x", create)
+    cache.get("c", "x", create)
+    assert_equals(2, len(cache.entries))
+    assert_in(cache.digest("a"), cache.entries)
+    assert_not_in(cache.digest("b"), cache.entries)
+
+
+def test_cache_does_not_store_errors():
+    cache = KeyCache()
+    def create(keydata):
+        raise ValueError(keydata)
+    assert_raises(ValueError, cache.get, "bad", "x", create)
+    assert_raises(ValueError, cache.get, None, "x", create)
+    assert_equals(0, cache.hits)
+
+
+
+FakeKey = namedtuple("FakeKey", "fingerprint expiry")
+
+class TestKeyringCache:
+    def setup(self):
+        self.homedir = tempfile.mkdtemp()
+        self.pubring = os.path.join(self.homedir, "pubring.kbx")
+        open(self.pubring, "w").close()
+        self.cache = KeyringCache()
+        self.keys = [FakeKey("A" * 40, None),
+                     FakeKey("B" * 32 + "12345678", None)]
+        # subkey id -> the primary key as gpg would find it
+        self.subkeys = {"0xDDDDDDDDDDDDDDDD": self.keys[0]}
+        self.listings = []
+
+    def list_keys(self, pattern):
+        self.listings.append(pattern)
+        if pattern:
+            return [self.subkeys[pattern]] if pattern in self.subkeys else []
+        return list(self.keys)
+
+    def test_lookups_use_snapshot(self):
+        cache = self.cache
+        keys = cache.get_keys(self.homedir, False, "", self.list_keys)
+        assert_equals(self.keys, keys)
+        keys = cache.get_keys(self.homedir, False, "A" * 40, self.list_keys)
+        assert_equals([self.keys[0]], keys)
+        keys = cache.get_keys(self.homedir, False, "0x12345678", self.list_keys)
+        assert_equals([self.keys[1]], keys)
+        assert_equals([""], self.listings)
+
+    def test_subkeys_are_left_to_gpg(self):
+        cache = self.cache
+        keys = cache.get_keys(self.homedir, False, "0xDDDDDDDDDDDDDDDD",
+                              self.list_keys)
+        assert_equals([self.keys[0]], keys)
+        keys = cache.get_keys(self.homedir, False, "C" * 40, self.list_keys)
+        assert_equals([], keys)
+        assert_equals(["", "0xDDDDDDDDDDDDDDDD", "C" * 40], self.listings)
+
+    def test_changed_keyboxd_invalidates(self):
+        cache = self.cache
+        os.mkdir(os.path.join(self.homedir, "public-keys.d"))
+        cache.get_keys(self.homedir, False, "", self.list_keys)
+        db = os.path.join(self.homedir, "public-keys.d", "pubring.db")
+        with open(db, "w") as f:
+            f.write("keys")
+        cache.get_keys(self.homedir, False, "", self.list_keys)
+        assert_equals(["", ""], self.listings)
+
+    def test_expired_key_invalidates(self):
+        soon = datetime.fromtimestamp(int(time.time()) + 1)
+        self.keys.append(FakeKey("C" * 40, soon))
+        cache = self.cache
+        cache.get_keys(self.homedir, False, "", self.list_keys)
+        cache.get_keys(self.homedir, False, "", self.list_keys)
+        assert_equals([""], self.listings)
+        time.sleep(1.1)
+        cache.get_keys(self.homedir, False, "", self.list_keys)
+        assert_equals(["", ""], self.listings)
+
+    def test_other_patterns_are_not_cached(self):
+        self.cache.get_keys(self.homedir, False, "joe@example.com",
+                            self.list_keys)
+        self.cache.get_keys(self.homedir, False, "joe@example.com",
+                            self.list_keys)
+        assert_equals(["joe@example.com"] * 2, self.listings)
+
+    def test_changed_keyring_invalidates(self):
+        cache = self.cache
+        cache.get_keys(self.homedir, False, "", self.list_keys)
+        # Simulate gpg replacing the keyring
+        new_pubring = self.pubring + ".tmp"
+        with open(new_pubring, "w") as f:
+            f.write("changed")
+        os.rename(new_pubring, self.pubring)
+        cache.get_keys(self.homedir, False, "", self.list_keys)
+        assert_equals(["", ""], self.listings)
+
+    def test_keydata(self):
+        exports = []
+        def export(pattern):
+            exports.append(pattern)
+            return "keydata for %s" % pattern
+        data = self.cache.get_keydata(self.homedir, "A" * 40, export)
+        data = self.cache.get_keydata(self.homedir, "A" * 40, export)
+        assert_equals("keydata for " + "A" * 40, data)
+        assert_equals(1, len(exports))
+        self.cache.invalidate(self.homedir)
+        self.cache.get_keydata(self.homedir, "A" * 40, export)
+        assert_equals(2, len(exports))
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+#    Copyright 2017 Tobias Mueller <muelli@cryptobitch.de>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+from io import BytesIO
+import logging
+import os
+import socket
+import threading
+import time
+from threading import Thread
+from unittest import SkipTest
+try:
+    from http.client import HTTPConnection
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    from httplib import HTTPConnection
+    from urllib2 import urlopen, HTTPError
+
+from nose.tools import *
+
+from keysign.Keyserver import KeyRequestHandlerBase
+from keysign.Keyserver import KeyStore
+from keysign.Keyserver import ServeKeyThread
+from keysign.Keyserver import ServedKey
+from keysign.Keyserver import send_parts
+from keysign.Keyserver import ThreadedKeyserver
+from keysign.Keyserver import create_keyserver
+from keysign.PooledKeyserver import PooledKeyserver
+from keysign.metrics import Metrics
+try:
+    from keysign.AsyncKeyserver import AsyncKeyserver
+except ImportError:
+    # We don't have asyncio on Python 2
+    AsyncKeyserver = None
+
+log = logging.getLogger(__name__)
+thisdir = os.path.dirname(os.path.realpath(__file__))
+
+
+def read_fixture_file(fixture):
+    fname = os.path.join(thisdir, "fixtures", fixture)
+    return open(fname, 'rb').read()
+
+
+FPR1 = "ADAB7FCC1F4DE2616ECFA402AF82244F9CD9FD55"
+FPR2 = "A0FF4590BB6122EDEF6E3C542D727CC768697734"
+
+
+def test_keystore_default():
+    store = KeyStore()
+    assert_equals(None, store.get())
+    store.add(b"one", FPR1)
+    store.add(b"two", FPR2.lower())
+    assert_equals(b"one", store.get())
+    assert_equals(b"two", store.get(FPR2))
+    assert_in(FPR2, store)
+    assert_equals(b"one", store.remove(FPR1))
+    # The next key becomes the default
+    assert_equals(b"two", store.get())
+    assert_equals(None, store.remove(FPR1))
+
+
+def test_served_key_select():
+    keydata = read_fixture_file("pubkey-1.asc")
+    served = ServedKey(keydata)
+    assert_equals(None, served.select(None)[0])
+    assert_equals("gzip", served.select("deflate, gzip")[0])
+    assert_equals("deflate", served.select("gzip;q=0.5, deflate")[0])
+    assert_equals(None, served.select("gzip;q=0, br")[0])
+    encoding, body, etag = served.select("*")
+    assert_equals("gzip", encoding)
+    assert served.matches('"foo", W/%s' % etag)
+    assert not served.matches('"foo"')
+
+
+def test_send_parts():
+    a, b = socket.socketpair()
+    # Bigger than the socket buffers, so that sends are partial
+    body = os.urandom(4 * 1024 * 1024)
+    received = []
+    def receive():
+        while True:
+            data = b.recv(65536)
+            if not data:
+                break
+            received.append(data)
+    t = Thread(target=receive)
+    t.start()
+    send_parts(a, [b"head", b"", memoryview(body)])
+    a.close()
+    t.join()
+    b.close()
+    assert_equals(b"head" + body, b"".join(received))
+
+
+class FakePublisher(object):
+    "Records the services instead of announcing them via Avahi"
+    services = []
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    def add_service(self):
+        self.services.append(self.kwargs)
+
+    def remove_service(self):
+        self.services.remove(self.kwargs)
+
+
+def test_serve_key_thread():
+    "The kernel picks the port and each key is published once"
+    keydata = read_fixture_file("pubkey-1.asc")
+    t = ServeKeyThread(keydata, FPR1, publisher=FakePublisher)
+    t.start()
+    try:
+        port = t.httpd.socket.getsockname()[1]
+        assert port
+        assert_equals(port, t.port)
+        assert_equals(1, len(FakePublisher.services))
+        assert_equals(port, FakePublisher.services[0]["service_port"])
+        url = "http://[::1]:%d/%s" % (port, FPR1)
+        assert_equals(keydata, urlopen(url, timeout=5).read())
+    finally:
+        t.shutdown()
+    assert_equals([], FakePublisher.services)
+
+
+def check_shutdown(engine):
+    threads = threading.active_count()
+    t = create_keyserver(read_fixture_file("pubkey-1.asc"), FPR1,
+                         engine=engine, publisher=FakePublisher)
+    t.start()
+    port = t.port
+    t.shutdown()
+    assert_equals(threads, threading.active_count())
+    # Nobody is listening anymore
+    assert_raises(socket.error, socket.create_connection,
+                  ("::1", port), 5)
+
+
+def test_shutdown():
+    "Shutting down stops the engine's threads and closes the socket"
+    engines = ["threaded", "pooled"]
+    if AsyncKeyserver is not None:
+        engines.append("asyncio")
+    for engine in engines:
+        check_shutdown(engine)
+
+
+def check_shutdown_with_idle_client(engine):
+    t = create_keyserver(read_fixture_file("pubkey-1.asc"), FPR1,
+                         engine=engine, publisher=FakePublisher)
+    t.start()
+    conn = HTTPConnection("::1", t.port, timeout=60)
+    try:
+        conn.request("GET", "/" + FPR1)
+        response = conn.getresponse()
+        response.read()
+        assert_equals(200, response.status)
+        # The connection stays open, waiting for the next request
+        start = time.time()
+        t.shutdown()
+        assert_less(time.time() - start, 5)
+    finally:
+        conn.close()
+
+
+def test_shutdown_with_idle_client():
+    "An idle persistent connection does not hold the shutdown up"
+    engines = ["threaded", "pooled"]
+    if AsyncKeyserver is not None:
+        engines.append("asyncio")
+    for engine in engines:
+        check_shutdown_with_idle_client(engine)
+
+
+class TestKeyserver:
+    def create_server(self):
+        return ThreadedKeyserver(('', 0), KeyRequestHandlerBase,
+                                 keystore=self.keystore, metrics=self.metrics)
+
+    def setup(self):
+        self.keystore = KeyStore()
+        self.metrics = Metrics()
+        self.keydata = read_fixture_file("pubkey-1.asc")
+        self.keystore.add(self.keydata, FPR1)
+        self.httpd = self.create_server()
+        self.port = self.httpd.socket.getsockname()[1]
+        self.thread = Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def teardown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def get(self, path):
+        url = "http://[::1]:%d%s" % (self.port, path)
+        return urlopen(url, timeout=5).read()
+
+    def request(self, method, path, headers={}):
+        "Returns the status, the headers, and the body of the response"
+        conn = HTTPConnection("::1", self.port, timeout=5)
+        try:
+            conn.request(method, path, headers=headers)
+            response = conn.getresponse()
+            return response.status, response, response.read()
+        finally:
+            conn.close()
+
+    def test_default_key(self):
+        assert_equals(self.keydata, self.get("/"))
+
+    def test_key_by_fingerprint(self):
+        other = read_fixture_file("alpha.asc")
+        self.keystore.add(other, FPR2)
+        assert_equals(other, self.get("/" + FPR2))
+        assert_equals(self.keydata, self.get("/" + FPR1.lower()))
+
+    def test_unknown_key(self):
+        try:
+            self.get("/" + FPR2)
+        except HTTPError as e:
+            assert_equals(404, e.code)
+        else:
+            raise AssertionError("Expected a 404")
+
+    def test_not_modified(self):
+        status, response, body = self.request("GET", "/")
+        etag = response.getheader("ETag")
+        assert etag
+        status, response, body = self.request("GET", "/",
+            {"If-None-Match": etag})
+        assert_equals(304, status)
+        assert_equals(b"", body)
+
+    def test_gzip(self):
+        status, response, body = self.request("GET", "/",
+            {"Accept-Encoding": "gzip"})
+        assert_equals(200, status)
+        assert_equals("gzip", response.getheader("Content-Encoding"))
+        data = gzip.GzipFile(fileobj=BytesIO(body)).read()
+        assert_equals(self.keydata, data)
+
+    def test_keep_alive(self):
+        conn = HTTPConnection("::1", self.port, timeout=5)
+        try:
+            conn.request("GET", "/")
+            assert_equals(self.keydata, conn.getresponse().read())
+            sock = conn.sock
+            conn.request("GET", "/" + FPR1)
+            assert_equals(self.keydata, conn.getresponse().read())
+            # No new connection has been made
+            assert sock is conn.sock
+        finally:
+            conn.close()
+
+    def test_pipelining(self):
+        sock = socket.create_connection(("::1", self.port), timeout=5)
+        try:
+            sock.sendall(b"GET / HTTP/1.1\r\nHost: x\r\n\r\n"
+                         b"HEAD / HTTP/1.1\r\nHost: x\r\n"
+                         b"Connection: close\r\n\r\n")
+            received = []
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                received.append(data)
+        finally:
+            sock.close()
+        response = b"".join(received)
+        assert_equals(2, response.count(b"HTTP/1.1 200 OK\r\n"))
+        assert_equals(1, response.count(self.keydata))
+        assert response.endswith(b"\r\n\r\n")
+
+    def test_metrics(self):
+        self.get("/")
+        self.request("HEAD", "/" + FPR2)
+        text = self.get("/metrics").decode("utf-8")
+        assert_in('keysign_keyserver_requests_total{code="200"} 1', text)
+        assert_in('keysign_keyserver_requests_total{code="404"} 1', text)
+        assert_in('_count{fingerprint="%s"} 1' % FPR1, text)
+
+    def test_head(self):
+        status, response, body = self.request("HEAD", "/")
+        assert_equals(200, status)
+        assert_equals(str(len(self.keydata)),
+                      response.getheader("Content-Length"))
+        assert_equals(b"", body)
+
+
+class TestAsyncKeyserver(TestKeyserver):
+    def create_server(self):
+        if AsyncKeyserver is None:
+            raise SkipTest("asyncio is not available")
+        return AsyncKeyserver(('', 0), self.keystore, metrics=self.metrics)
+
+
+class TestPooledKeyserver(TestKeyserver):
+    def create_server(self):
+        return PooledKeyserver(('', 0), keystore=self.keystore,
+                               metrics=self.metrics, workers=2, queue_size=2, max_per_client=2,
+                               header_timeout=1)
+
+    def connect(self):
+        return socket.create_connection(("::1", self.port), timeout=5)
+
+    def test_max_per_client(self):
+        idle = [self.connect() for _ in range(2)]
+        try:
+            sock = self.connect()
+            try:
+                response = sock.recv(65536)
+            finally:
+                sock.close()
+            assert response.startswith(b"HTTP/1.1 503 ")
+            assert_equals(1, self.httpd.stats()["rejected"])
+        finally:
+            for sock in idle:
+                sock.close()
+
+    def test_header_timeout(self):
+        sock = self.connect()
+        try:
+            # An incomplete request
+            sock.sendall(b"GET / HTTP/1.1\r\n")
+            assert_equals(b"", sock.recv(65536))
+        finally:
+            sock.close()
+        assert_equals(1, self.httpd.stats()["timed_out"])
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+#    Copyright 2017 Tobias Mueller <muelli@cryptobitch.de>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+
+from threading import Thread
+
+from nose.tools import *
+
+from keysign.metrics import Metrics
+from keysign.metrics import is_local
+
+
+FPR = "ADAB7FCC1F4DE2616ECFA402AF82244F9CD9FD55"
+
+
+def test_snapshot():
+    metrics = Metrics(buckets=(0.01, 0.1))
+    metrics.connection_opened()
+    metrics.record(200, 100, FPR, 0.005)
+    metrics.record(304, 10, FPR, 0.05)
+    metrics.record(404, 20)
+    snapshot = metrics.snapshot()
+    assert_equals(3, snapshot["requests"])
+    assert_equals({"2xx": 1, "304": 1, "4xx": 1}, snapshot["responses"])
+    assert_equals(130, snapshot["bytes_sent"])
+    assert_equals(1, snapshot["in_flight"])
+    assert_equals([1, 1, 0], snapshot["latency"][FPR]["buckets"])
+    assert_equals(2, snapshot["latency"][FPR]["count"])
+
+
+def test_threads():
+    "The counts of finished threads are kept"
+    metrics = Metrics()
+    def count():
+        for _ in range(1000):
+            metrics.record(200, 1)
+    threads = [Thread(target=count) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # Counting from a new thread folds the finished ones
+    t = Thread(target=count)
+    t.start()
+    t.join()
+    assert_equals(5000, metrics.snapshot()["requests"])
+    assert_equals(1, len(metrics.shards))
+
+
+def test_render():
+    metrics = Metrics(buckets=(0.01,))
+    metrics.record(200, 100, FPR, 0.5)
+    text = metrics.render()
+    assert_in('keysign_keyserver_request_duration_seconds_bucket'
+              '{fingerprint="%s",le="0.01"} 0' % FPR, text)
+    assert_in('keysign_keyserver_request_duration_seconds_bucket'
+              '{fingerprint="%s",le="+Inf"} 1' % FPR, text)
+    assert_in('keysign_keyserver_sent_bytes_total 100', text)
+
+
+def test_is_local():
+    assert is_local("::1")
+    assert is_local("127.0.0.1")
+    assert is_local("::ffff:127.0.0.1")
+    assert not is_local("192.168.1.2")
+    assert not is_local("fe80::1")
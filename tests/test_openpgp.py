@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#    Copyright 2017 Tobias Mueller <muelli@cryptobitch.de>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+
+from nose.tools import *
+
+from keysign.openpgp import ParseError
+from keysign.openpgp import TAG_USER_ATTRIBUTE
+from keysign.openpgp import TAG_USER_ID
+from keysign.openpgp import armor
+from keysign.openpgp import dearmor
+from keysign.openpgp import filter_uid
+from keysign.openpgp import is_armored
+from keysign.openpgp import key_fingerprint
+from keysign.openpgp import minimise
+from keysign.openpgp import parse_packets
+from keysign.openpgp import split_uids
+
+log = logging.getLogger(__name__)
+thisdir = os.path.dirname(os.path.realpath(__file__))
+
+
+def get_fixture_file(fixture):
+    fname = os.path.join(thisdir, "fixtures", fixture)
+    return fname
+
+def read_fixture_file(fixture):
+    fname = get_fixture_file(fixture)
+    data = open(fname, 'r').read()
+    return data
+
+
+def user_ids(data):
+    "Returns the UIDs in the binary or armored data"
+    return [p.body.tobytes().decode("utf-8")
+            for p in parse_packets(dearmor(data)) if p.tag == TAG_USER_ID]
+
+
+def test_key_fingerprint():
+    data = read_fixture_file("alpha.asc")
+    assert_equals("A0FF4590BB6122EDEF6E3C542D727CC768697734",
+                  key_fingerprint(data))
+    assert_equals(key_fingerprint(data), key_fingerprint(dearmor(data)))
+
+
+def test_secret_key():
+    "The fingerprint of a secret key is that of its public part"
+    assert_equals("CFD49FE68C0924D830BE4BFDA5C89B8B383EE754",
+                  key_fingerprint(read_fixture_file("seckey-2.asc")))
+
+
+@raises(ParseError)
+def test_no_data():
+    key_fingerprint(None)
+
+@raises(ParseError)
+def test_wrong_data():
+    key_fingerprint("this is no key!!1")
+
+@raises(ParseError)
+def test_bad_checksum():
+    data = read_fixture_file("pubkey-1.asc")
+    lines = data.splitlines()
+    # Flip a character in the first line of the base64 body
+    i = lines.index("") + 1
+    lines[i] = ("B" if lines[i][0] == "A" else "A") + lines[i][1:]
+    key_fingerprint("\n".join(lines))
+
+@raises(ParseError)
+def test_two_keys():
+    data = read_fixture_file("pubkey-1.asc")
+    key_fingerprint(data + read_fixture_file("alpha.asc"))
+
+
+def test_split_uids():
+    data = dearmor(read_fixture_file("alpha.asc"))
+    uids = list(split_uids(data))
+    assert_equals(3, len(uids))
+    for uid, uid_data in uids:
+        assert_equals("A0FF4590BB6122EDEF6E3C542D727CC768697734",
+                      key_fingerprint(uid_data))
+        assert_equals([uid.decode("utf-8")], user_ids(uid_data))
+
+
+def test_split_uids_keeps_user_attributes():
+    "Like gpg's deluid, we only drop the other UIDs, not the photo IDs"
+    data = dearmor(read_fixture_file("pubkey-photo.asc"))
+    uids = list(split_uids(data))
+    assert_equals(2, len(uids))
+    for uid, uid_data in uids:
+        tags = [p.tag for p in parse_packets(uid_data)]
+        assert_equals(1, tags.count(TAG_USER_ID))
+        assert_equals(1, tags.count(TAG_USER_ATTRIBUTE))
+        assert_equals(uid_data, filter_uid(data, uid))
+
+
+def test_filter_uid():
+    data = read_fixture_file("alpha.asc")
+    filtered = filter_uid(data, "Alice (demo key)")
+    assert is_armored(filtered)
+    assert_equals("A0FF4590BB6122EDEF6E3C542D727CC768697734",
+                  key_fingerprint(filtered))
+    assert_equals(["Alice (demo key)"], user_ids(filtered))
+
+@raises(ParseError)
+def test_filter_unknown_uid():
+    filter_uid(read_fixture_file("alpha.asc"), "Mallory <m@example.org>")
+
+
+def test_minimise():
+    data = dearmor(read_fixture_file("alpha.asc"))
+    minimal = minimise(data)
+    assert not is_armored(minimal)
+    assert len(minimal) <= len(data)
+    assert_equals(minimal, minimise(minimal))
+    assert_equals(key_fingerprint(data), key_fingerprint(minimal))
+    assert_equals(user_ids(data), user_ids(minimal))
+
+
+@raises(ParseError)
+def test_minimise_several_self_signatures():
+    # The subkey is bound twice, and which binding is valid is for gpg to say
+    minimise(dearmor(read_fixture_file("pubkey-1.asc")))
+
+
+def test_armor_roundtrip():
+    data = dearmor(read_fixture_file("pubkey-1.asc"))
+    assert_equals(data, dearmor(armor(data)))